@@ -1,221 +1,346 @@
 import streamlit as st
-from openai import OpenAI
 from dotenv import dotenv_values
-import instructor
-from pydantic import BaseModel, Field
-from typing import List
+from typing import Callable, List, Optional, Tuple
+import json
 import os
-import requests # Do pobierania obrazów
-from io import BytesIO # Do obsługi obrazów w pamięci
-from fpdf import FPDF # Do generowania PDF
-import io
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime # Do generowania unikalnej nazwy pliku
+from llm_cache import LLMCache # Cache wyników LLM na dysku
+from blob_store import BlobStore # Lokalne kopie ilustracji
+from artifact_store import ArtifactStore # Pliki audio i PDF sesji na dysku zamiast w pamięci
+from story_engine import (Scene, StoryEngine, StoryStyle, create_api_clients, create_rate_limiter, STYLE_OPTIONS, IMAGE_STYLE_OPTIONS,
+                          ATMOSPHERE_OPTIONS, WRITER_PROFILES, writer_description, scene_prompts,
+                          illustration_key, default_pdf_name, default_epub_name)
+from story_epub import create_story_epub # Eksport EPUB zapisywany strumieniowo
+from metrics import MetricsRecorder, MetricsRegistry # Czas, tokeny i koszt etapów
+from prefetch import Prefetcher, SharedCalls, job_key # Spekulatywne liczenie kolejnych kroków w tle
+# story_pdf (fpdf) i tts są importowane dopiero w zakładkach PDF i audio - szybszy pierwszy start
+from job_store import JobStore, audio_segment_name # Trwałe zadania z punktami kontrolnymi
+from request_policy import CancelToken, RequestRunner, load_policies # Terminy, ponowienia i anulowanie zapytań
 
 # Ładowanie klucza API z pliku .env
 env = dotenv_values(".env")
 
+# Liczba równoległych zapytań do DALL-E w jednej sesji oraz globalny limit zapytań "w locie"
+# (wspólny dla wszystkich sesji w procesie). Można nadpisać w pliku .env.
+ILLUSTRATION_WORKERS = int(env.get("ILLUSTRATION_WORKERS") or 4)
+ILLUSTRATION_MAX_IN_FLIGHT = int(env.get("ILLUSTRATION_MAX_IN_FLIGHT") or 8)
 
+# Liczba równoległych zapytań TTS przy generowaniu audio
+TTS_WORKERS = int(env.get("TTS_WORKERS") or 4)
 
+# Liczba rozdziałów pisanych jednocześnie w trybie długiej formy (rozdział na scenę)
+CHAPTER_WORKERS = int(env.get("CHAPTER_WORKERS") or 8)
 
-# --- Modele Pydantic do strukturyzacji danych ---
+# Rozdzielczość (DPI) i jakość JPEG ilustracji osadzanych w PDF
+PDF_IMAGE_DPI = int(env.get("PDF_IMAGE_DPI") or 150)
+PDF_IMAGE_QUALITY = int(env.get("PDF_IMAGE_QUALITY") or 80)
 
-class TitleAndSummary(BaseModel):
-    """Model do przechowywania tytułu i zarysu fabuły."""
-    title: str = Field(..., description="Kreatywny i chwytliwy tytuł opowiadania.")
-    summary: str = Field(..., description="Zwięzły, jednoakapitowy opis fabuły opowiadania.")
+# Pliki z metrykami: log JSONL wszystkich etapów i plik tekstowy w formacie Prometheusa
+METRICS_LOG_PATH = env.get("METRICS_LOG_PATH") or os.path.join(".cache", "metrics.jsonl")
+METRICS_PROMETHEUS_PATH = env.get("METRICS_PROMETHEUS_PATH") or os.path.join(".cache", "metrics.prom")
 
-class Scene(BaseModel):
-    """Model pojedynczej sceny w opowiadaniu."""
-    scene_title: str = Field(..., description="Tytuł sceny, np. 'Tajemnicze odkrycie'.")
-    scene_description: str = Field(..., description="Szczegółowy opis tego, co dzieje się w scenie, kto bierze w niej udział i gdzie się rozgrywa.")
+# Liczenie kolejnego kroku w tle, zanim użytkownik go zatwierdzi (domyślnie włączone)
+# oraz rozmiar wspólnej puli wątków dla takich zadań
+PREFETCH_ENABLED = (env.get("PREFETCH_ENABLED") or "1") not in ("0", "false", "False")
+PREFETCH_WORKERS = int(env.get("PREFETCH_WORKERS") or 8)
 
-class StoryScenes(BaseModel):
-    """Lista kluczowych scen w opowiadaniu."""
-    scenes: List[Scene] = Field(..., description="Lista 5 do 7 kluczowych scen, które tworzą spójną historię.")
+# Ładowanie w tle (raz na proces) modułów i czcionek potrzebnych dopiero w dalszych krokach
+WARM_UP_ENABLED = (env.get("WARM_UP_ENABLED") or "1") not in ("0", "false", "False")
+
+# Limit miejsca na pliki jednej sesji (MB) i czas, po którym pliki nieaktywnej sesji są usuwane (godziny)
+ARTIFACT_QUOTA_MB = float(env.get("ARTIFACT_QUOTA_MB") or 200)
+ARTIFACT_IDLE_HOURS = float(env.get("ARTIFACT_IDLE_HOURS") or 24)
+
+# Czas życia zadań bez zmian (dni; potem znikają z punktami kontrolnymi) oraz limit magazynu
+# ilustracji i audio (MB) i wiek (godziny), po którym usuwane są bloby nieużywane przez zadania
+JOB_TTL_DAYS = float(env.get("JOB_TTL_DAYS") or 30)
+BLOB_STORE_MAX_MB = float(env.get("BLOB_STORE_MAX_MB") or 1024)
+BLOB_MAX_AGE_HOURS = float(env.get("BLOB_MAX_AGE_HOURS") or 24)
+
+# Limity zapytań i tokenów na minutę wspólne dla sesji z tym samym kluczem API, np. {"gpt-4o": [500, 30000]}
+# (brak = orientacyjne limity z rate_limit.py), oraz rozmiar wspólnej puli połączeń HTTP
+RATE_LIMITS = json.loads(env["RATE_LIMITS"]) if env.get("RATE_LIMITS") else None
+HTTP_MAX_CONNECTIONS = int(env.get("HTTP_MAX_CONNECTIONS") or 100)
+
+# Terminy i ponowienia zapytań per etap, np. {"story": {"deadline": 900, "max_attempts": 3}}
+# (brak = wartości domyślne z request_policy.py), oraz czas w sekundach, po którym wolne
+# zapytanie o ilustrację dostaje równoległy duplikat (0 = wyłączone)
+REQUEST_POLICIES = load_policies(json.loads(env["REQUEST_POLICIES"]) if env.get("REQUEST_POLICIES") else None,
+                                 float(env.get("ILLUSTRATION_HEDGE_SECONDS") or 0))
+
+# Po tylu sekundach bez połączenia z przeglądarką praca sesji jest przerywana (krótkie zerwanie
+# połączenia, po którym karta wraca do tej samej sesji, niczego nie anuluje)
+DISCONNECT_GRACE_SECONDS = float(env.get("DISCONNECT_GRACE_SECONDS") or 60)
+
+# Ustawienia cache odpowiedzi LLM (rozmiar w MB, czas życia w godzinach)
+LLM_CACHE_MAX_MB = float(env.get("LLM_CACHE_MAX_MB") or 50)
+LLM_CACHE_TTL_HOURS = float(env.get("LLM_CACHE_TTL_HOURS") or 7 * 24)
 
-# --- Funkcje pomocnicze ---
 
-def generate_title_and_summary(topic: str):
+# --- Funkcje pomocnicze ---
+# Właściwe wywołania API są w story_engine.py; tutaj tylko wyświetlamy błędy w interfejsie.
+
+@st.cache_resource
+def get_llm_cache():
+    """Wspólny dla wszystkich sesji cache odpowiedzi LLM."""
+    return LLMCache(max_bytes=int(LLM_CACHE_MAX_MB * 1024 * 1024), ttl_seconds=LLM_CACHE_TTL_HOURS * 3600)
+
+@st.cache_resource
+def get_blob_store():
+    """Wspólny magazyn pobranych ilustracji i fragmentów audio."""
+    return BlobStore(max_bytes=int(BLOB_STORE_MAX_MB * 1024 * 1024), max_age_seconds=BLOB_MAX_AGE_HOURS * 3600)
+
+@st.cache_resource
+def get_artifact_store():
+    """Wspólny katalog na pliki wynikowe sesji (audio, PDF)."""
+    return ArtifactStore(quota_bytes=int(ARTIFACT_QUOTA_MB * 1024 * 1024), idle_seconds=ARTIFACT_IDLE_HOURS * 3600)
+
+@st.cache_resource
+def get_job_store():
+    """Baza zadań i ich punktów kontrolnych (przetrwa zamknięcie karty i restart serwera)."""
+    return JobStore()
+
+@st.cache_resource
+def get_metrics_registry():
+    """Metryki zagregowane ze wszystkich sesji (eksport w formacie Prometheusa)."""
+    return MetricsRegistry(prometheus_path=METRICS_PROMETHEUS_PATH)
+
+@st.cache_resource
+def get_illustration_slots(limit: int):
+    """Semafor ograniczający liczbę jednoczesnych zapytań do DALL-E w całym procesie."""
+    return threading.BoundedSemaphore(limit)
+
+@st.cache_resource
+def get_rate_limiter(api_key: str):
+    """Kolejka limitów API wspólna dla sesji z tym samym kluczem (limity OpenAI liczone są per klucz/organizację)."""
+    return create_rate_limiter(RATE_LIMITS)
+
+@st.cache_resource
+def get_api_clients(api_key: str):
+    """Klienci OpenAI tworzeni raz na klucz API; połączenia HTTP są utrzymywane i współdzielone."""
+    return create_api_clients(api_key, rate_limiter=get_rate_limiter(api_key), max_connections=HTTP_MAX_CONNECTIONS)
+
+@st.cache_resource
+def get_prefetch_executor(workers: int):
+    """Wspólna pula wątków dla zadań liczonych w tle przez wszystkie sesje."""
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+
+def warm_up():
+    """Importuje ciężkie biblioteki i parsuje czcionki PDF, zanim będą potrzebne (bez wywołań st.*)."""
+    try:
+        import instructor, openai, requests # noqa: F401 - klienci API i pobieranie ilustracji
+        import tts # noqa: F401
+        from story_pdf import warm_fonts
+        warm_fonts()
+    except Exception:
+        pass # Nieudane rozgrzewanie niczego nie psuje - moduły załadują się przy pierwszym użyciu
+
+@st.cache_resource
+def start_warm_up():
+    """Wątek rozgrzewający proces: startuje przy pierwszej sesji i nie opóźnia pierwszego wyświetlenia."""
+    thread = threading.Thread(target=warm_up, name="warm-up", daemon=True)
+    thread.start()
+    return thread
+
+# --- Ustawienia z panelu bocznego ---
+# Panel boczny jest osobnym fragmentem, więc pozostałe części aplikacji czytają ustawienia
+# ze stanu sesji (klucze widżetów), a nie ze zmiennych ostatniego pełnego przebiegu skryptu.
+
+DEFAULT_TOPIC = "Zaginiony artefakt w magicznym lesie, strzeżony przez starożytne stworzenia."
+
+def option(key: str, default=None):
+    """Wartość widżetu z panelu bocznego (lub domyślna, zanim panel zostanie narysowany)."""
+    return st.session_state.get(key, default)
+
+def selected_style() -> str:
+    """Styl opowiadania; "INNE" oznacza styl wpisany ręcznie (o ile nie jest pusty)."""
+    style = option("style_choice", STYLE_OPTIONS[0])
+    if style == "INNE" and option("custom_style"):
+        return option("custom_style")
+    return style
+
+def current_story_style() -> StoryStyle:
+    """Bieżące ustawienia stylu wpływające na prompty wszystkich etapów."""
+    style = selected_style()
+    return StoryStyle(style=style, writer_desc=writer_description(option("writer", next(iter(WRITER_PROFILES))), style),
+                      image_style=option("image_style", IMAGE_STYLE_OPTIONS[0]),
+                      atmosphere=option("atmosphere", ATMOSPHERE_OPTIONS[0]))
+
+# Ustawienia z panelu bocznego zapisywane w zadaniu - po wznowieniu odtwarzają ten sam styl
+JOB_OPTION_KEYS = ("topic", "style_choice", "custom_style", "writer", "image_style", "atmosphere", "long_form",
+                   "smooth_chapters", "fast_plan")
+
+def checkpoint(name: str, value) -> None:
+    """Zapisuje wynik etapu w zadaniu bieżącej historii (jeśli historia jest już zadaniem)."""
+    if st.session_state.get('job_id'):
+        jobs.save(st.session_state.job_id, name, value)
+
+def generate_title_and_summary(topic: str, refresh: bool = False):
     """Generuje tytuł i podsumowanie na podstawie tematu."""
     try:
-        response = instructor_openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            response_model=TitleAndSummary,
-            messages=[
-                {"role": "system", "content": f"{writer_desc}."},
-                {"role": "user", "content": f"Wygeneruj tytuł i zarys fabuły dla opowiadania o tematyce: {topic}"}
-            ]
-        )
-        return response.title, response.summary
+        return engine.generate_title_and_summary(topic, current_story_style(), refresh=refresh)
     except Exception as e:
         st.error(f"Błąd podczas generowania tytułu i opisu: {e}")
         return None, None
 
-def generate_scenes(title: str, summary: str):
-    """Generuje listę scen na podstawie tytułu i podsumowania."""
-    try:
-        response = instructor_openai_client.chat.completions.create(
-            model="gpt-4o-mini",
-            response_model=StoryScenes,
-            messages=[
-                {"role": "system", "content": f"Jesteś scenarzystą. Twoim zadaniem jest podzielenie historii na kluczowe sceny. Zachowaj styl {style}"},
-                {"role": "user", "content": f"Na podstawie poniższego tytułu i opisu, stwórz listę 5-7 kluczowych scen, które budują narrację.\n\nTytuł: {title}\n\nOpis: {summary}"}
-            ]
-        )
-        return response.scenes
-    except Exception as e:
-        st.error(f"Błąd podczas generowania scen: {e}")
-        return []
-
-def generate_story(title: str, scenes: List[Scene]):
-    """Generuje pełne opowiadanie na podstawie scen."""
-    scenes_description = "\n".join([f"**Scena: {s.scene_title}**\n{s.scene_description}" for s in scenes])
+def generate_plan(topic: str, refresh: bool = False):
+    """Generuje tytuł, opis i sceny jednym zapytaniem (tryb szybkiego planu)."""
     try:
-        response = client.chat.completions.create(
-            model="gpt-4o",
-            messages=[
-                {"role": "system", "content": f"{writer_desc}."},
-                {"role": "user", "content": f"Napisz pełne opowiadanie bez tytułu na podstawie poniższych wytycznych.\n\nTytuł: {title}\n\nSceny:\n{scenes_description}"}
-            ]
-        )
-        return response.choices[0].message.content
+        return engine.generate_plan(topic, current_story_style(), refresh=refresh)
     except Exception as e:
-        st.error(f"Błąd podczas generowania opowiadania: {e}")
-        return ""
-
-def generate_illustration(prompt: str):
-    """Generuje ilustrację za pomocą DALL-E 3."""
-    try:
-        response = instructor_openai_client.images.generate(
-            model="dall-e-3",
-            prompt=f"Utwórz cyfrową ilustrację w stylu {Image_style}, oddającą atmosferę i nastrój: {atmospher_style}. Opis sceny: {prompt}",
-            n=1,
-            size="1024x1024", # Można zmienić na "1024x1792" lub "1792x1024" dla innych proporcji
-            quality="standard" # lub "hd" dla lepszej jakości (droższe)
-        )
-        return response.data[0].url
-    except Exception as e:
-        st.error(f"Błąd podczas generowania ilustracji: {e}")
-        return None
-
-# --- Funkcja do generowania PDF ---
-class PDF(FPDF):
-    def header(self):
-        pass # Można dodać niestandardowy nagłówek
-
-    def footer(self):
-        self.set_y(-15)
-        # Użycie czcionki dodanej w `create_story_pdf`
-        # Sprawdzenie czy czcionka DejaVu została dodana
-        font_name = "DejaVu" if "dejavu" in self.font_family.lower() else self.font_family
-        self.set_font(font_name, "I", 8)
-        self.cell(0, 10, f"Strona {self.page_no()}/{{nb}}", 0, 0, "C")
-
-def create_story_pdf(title, story_text, scenes, illustration_urls):
-    pdf = PDF()
-    pdf.set_auto_page_break(auto=True, margin=15)
-    pdf.alias_nb_pages()
-
-    # Ścieżki do plików czcionek (umieść pliki .ttf w katalogu ze skryptem)
-    font_regular_path = "DejaVuSans.ttf"
-    font_bold_path = "DejaVuSans-Bold.ttf"
-    font_italic_path = "DejaVuSans-Oblique.ttf"
-    font_to_use = "Arial" # Domyślna, jeśli DejaVu nie jest dostępna
-
-    try:
-        if os.path.exists(font_regular_path) and os.path.exists(font_bold_path) and os.path.exists(font_italic_path):
-            pdf.add_font("DejaVu", "", font_regular_path, uni=True)
-            pdf.add_font("DejaVu", "B", font_bold_path, uni=True)
-            pdf.add_font("DejaVu", "I", font_italic_path, uni=True)
-            font_to_use = "DejaVu"
-        else:
-            st.warning(
-                "Nie znaleziono plików czcionek DejaVu (np. DejaVuSans.ttf) w katalogu projektu. "
-                "Polskie znaki w PDF mogą nie być wyświetlane poprawnie. "
-                "Pobierz czcionki DejaVu i umieść je w głównym katalogu projektu."
-            )
-    except RuntimeError as e:
-        st.warning(f"Błąd podczas ładowania czcionki DejaVu: {e}. Używam domyślnej czcionki (Arial).")
-
-    pdf.add_page()
-
-    # Tytuł opowiadania
-    pdf.set_font(font_to_use, "B", 20)
-    pdf.multi_cell(0, 10, title, 0, "C")
-    pdf.ln(10)
-
-    # Tekst opowiadania
-    pdf.set_font(font_to_use, "", 12)
-    pdf.multi_cell(0, 10, story_text)
-    pdf.ln(10)
-    if pdf.get_y() > (pdf.h - pdf.b_margin - 270 ): # Sprawdzenie miejsca przed nową sceną (wysokość orientacyjna)
-             pdf.add_page()
-    # Sceny i Ilustracje
-    pdf.set_font(font_to_use, "B", 16)
-    pdf.multi_cell(0, 10, "Rozdziały i Ilustracje", 0, "L")
-    pdf.ln(5)
-
-    for i, scene in enumerate(scenes):
-        if pdf.get_y() > (pdf.h - pdf.b_margin - 70): # Sprawdzenie miejsca przed nową sceną (wysokość orientacyjna)
-             pdf.add_page()
-
-        # Tytuł sceny
-        pdf.set_font(font_to_use, "B", 14)
-        pdf.multi_cell(0, 10, f"{i+1}. {scene.scene_title}", 0, "L")
-        pdf.ln(2)
-
-        # Opis sceny
-        pdf.set_font(font_to_use, "", 12)
-        pdf.multi_cell(0, 8, scene.scene_description)
-        pdf.ln(5)
-
-        # Ilustracja
-        if i < len(illustration_urls) and illustration_urls[i]:
-            try:
-                if pdf.get_y() > (pdf.h - pdf.b_margin - 80): # Sprawdzenie miejsca na obraz (orientacyjnie 80mm)
-                    pdf.add_page()
-
-                response = requests.get(illustration_urls[i], timeout=20) # Zwiększony timeout
-                response.raise_for_status()
-                img_bytes = BytesIO(response.content)
-                
-                img_max_width = pdf.w - pdf.l_margin - pdf.r_margin - 10 # Z marginesami
-                
-                # FPDF może mieć problem z niektórymi obrazami bez rozszerzenia, spróbujmy nadać mu nazwę
-                # Dodajemy obraz bezpośrednio z BytesIO
-                pdf.image(img_bytes, x=None, y=None, w=img_max_width, type='JPEG' if illustration_urls[i].lower().endswith(".jpg") or illustration_urls[i].lower().endswith(".jpeg") else 'PNG' if illustration_urls[i].lower().endswith(".png") else '')
-                pdf.ln(5)
-            except requests.exceptions.RequestException as e:
-                pdf.set_font(font_to_use, "I", 10)
-                pdf.multi_cell(0, 8, f"[Nie udało się załadować ilustracji: {e}]")
-                pdf.ln(5)
-            except Exception as e: # Inne błędy związane z obrazem
-                pdf.set_font(font_to_use, "I", 10)
-                pdf.multi_cell(0, 8, f"[Błąd podczas przetwarzania ilustracji: {e}]")
-                pdf.ln(5)
-        pdf.ln(5) # Dodatkowy odstęp po scenie
-
-# Zwraca bajty PDF
-    try:
-        output = pdf.output(dest="S")
-        if isinstance(output, bytearray):
-            pdf_output_bytes = bytes(output) # Konwersja bytearray na bytes
-        elif isinstance(output, str): # Na wypadek, gdyby zwracał string (mało prawdopodobne z dest="S" w fpdf2)
-            pdf_output_bytes = output.encode('latin1') # lub 'utf-8'
-        elif isinstance(output, bytes):
-             pdf_output_bytes = output # Już jest w poprawnym formacie
-        else:
-            st.error(f"Nieoczekiwany typ danych z pdf.output: {type(output)}")
-            return None
-    except Exception as e:
-        st.error(f"Błąd podczas finalizowania PDF: {e}")
-        return None
-    return pdf_output_bytes
+        st.error(f"Błąd podczas planowania opowiadania: {e}")
+        return None, None, []
+
+# Kolejne etapy działają jako zadania w tle (prefetch.py). Klucz zadania obejmuje tylko dane,
+# od których zależy wynik - zmiana czegokolwiek innego nie unieważnia gotowego wyniku.
+
+def job_engine() -> Tuple[StoryEngine, CancelToken]:
+    """Silnik z własnym tokenem zadania w tle (powiązanym z tokenem sesji).
+
+    Zastąpienie lub odrzucenie zadania anuluje token, więc zapytania, które jeszcze
+    czekają w kolejce, ponowienia i duplikaty tego zadania nie są już wysyłane.
+    """
+    token = CancelToken(parent=st.session_state.cancel_token)
+    return engine.with_token(token), token
+
+def scenes_job(title: str, summary: str, refresh: bool = False, speculative: bool = False):
+    """Zadanie generowania scen dla bieżącego tytułu i opisu."""
+    story_style = current_story_style()
+    key = job_key("scenes", title, summary, story_style.style, refresh)
+    task_engine, token = job_engine()
+    return prefetch.start("scenes", key, task_engine.generate_scenes, title, summary, story_style, refresh,
+                          speculative=speculative, token=token)
+
+def story_mode() -> dict:
+    """Tryb pisania opowiadania: jedno zapytanie albo rozdział na scenę (wtedy liczy się też zarys)."""
+    if not option("long_form", False):
+        return {"long_form": False}
+    return {"long_form": True, "summary": st.session_state.get('summary', ""),
+            "smooth": option("smooth_chapters", False)}
+
+def story_inputs(title: str, scenes: List[Scene]) -> str:
+    """Skrót danych, od których zależy treść opowiadania."""
+    return job_key("story", title, scenes, current_story_style().writer_desc, story_mode())
+
+def story_is_current(title: str, scenes: List[Scene]) -> bool:
+    """Czy istniejące (być może edytowane) opowiadanie powstało z tych samych scen i stylu."""
+    return bool(st.session_state.get('story')) and st.session_state.get('story_inputs') == story_inputs(title, scenes)
+
+def story_job(title: str, scenes: List[Scene], refresh: bool = False, speculative: bool = False):
+    """Zadanie pisania opowiadania; kolejne fragmenty tekstu trafiają do `job.progress`."""
+    key = job_key(story_inputs(title, scenes), refresh)
+    mode = story_mode()
+    task_engine, token = job_engine()
+    if mode["long_form"]:
+        # Rozdziały powstają równolegle i trafiają do `job.progress` w kolejności scen
+        return prefetch.start("story", key, task_engine.stream_long_story, title, mode["summary"], scenes,
+                              current_story_style(), refresh, mode["smooth"], stream=True, speculative=speculative,
+                              token=token)
+    return prefetch.start("story", key, task_engine.stream_story, title, scenes, current_story_style(), refresh,
+                          stream=True, speculative=speculative, token=token)
+
+def create_illustrations(task_engine: StoryEngine, prompts: List[str], style: StoryStyle, completed: list,
+                         previous: dict, shared: SharedCalls, job_store: JobStore, job_id: Optional[str]):
+    """Generuje ilustracje i od razu pobiera ich bajty (w wątku tła, bez wywołań st.*).
+
+    Każda nowa ilustracja jest pobierana i zapisywana w zadaniu `job_id` zaraz po
+    wygenerowaniu, więc błąd innej sceny lub przerwanie nie marnuje opłaconych obrazów.
+    Ilustracje generowane jeszcze przez zastąpione zadanie są przejmowane przez `shared`.
+    """
+    def on_url(i: int, url: str) -> None:
+        try:
+            blob = task_engine.blob_store.fetch(url)
+        except Exception:
+            blob = None # Pobranie zostanie ponowione w `fetch_many`; URL jest już zapisany
+        job_store.save_illustration(job_id, illustration_key(prompts[i], style), url, blob)
+
+    urls = task_engine.generate_illustrations(prompts, style, previous=previous, on_url=on_url if job_id else None,
+                                              on_done=lambda i, done, error: completed.append((i, error)),
+                                              shared=shared)
+    return urls, task_engine.blob_store.fetch_many(urls)
+
+def illustrations_job(scenes: List[Scene], refresh: bool = False, speculative: bool = False):
+    """Zadanie generowania ilustracji; `job.progress` zawiera pary (scena, błąd) gotowych ilustracji.
+
+    Sceny, których opis i styl ilustracji się nie zmieniły, dostają wcześniejszą ilustrację
+    (chyba że `refresh`) - edycja jednej sceny to jedno zapytanie do DALL-E.
+    """
+    story_style = current_story_style()
+    prompts = scene_prompts(scenes)
+    key = job_key("illustrations", prompts, story_style.image_style, story_style.atmosphere, refresh)
+    previous = {}
+    job_id = st.session_state.get('job_id')
+    if not refresh:
+        # Ilustracje zapisane w zadaniu (także sprzed przerwania) i wcześniejsze z tej sesji
+        if job_id:
+            previous.update({key: value["url"] for key, value in jobs.illustrations(job_id).items()})
+        previous.update(st.session_state.get('illustration_index', {}))
+    completed = []
+    task_engine, token = job_engine()
+    return prefetch.start("illustrations", key, create_illustrations, task_engine, prompts, story_style, completed,
+                          previous, shared_calls, jobs, job_id, progress=completed, speculative=speculative,
+                          token=token)
+
+def prefetch_from_scenes():
+    """Spekulatywnie zaczyna opowiadanie dla bieżących scen (gdy włączone w panelu).
+
+    Ilustracje startują w tle dopiero po napisaniu opowiadania (etap 6) - każda edycja
+    sceny zmienia ich zadanie, a zapytania do DALL-E są najdroższe.
+    """
+    if st.session_state.stage != 4 or not option("prefetch_next", PREFETCH_ENABLED):
+        return
+    regenerate = option("regenerate", False)
+    if regenerate or not story_is_current(st.session_state.title, st.session_state.scenes):
+        story_job(st.session_state.title, st.session_state.scenes, refresh=regenerate, speculative=True)
+
+def build_pdf(session_id: str, name: str, title: str, story: str, scenes: List[Scene], blobs: list,
+              warnings: list) -> str:
+    """Składa PDF do artefaktu sesji `name` (w wątku tła, bez wywołań st.*); gotowy plik nie jest budowany ponownie."""
+    if artifacts.exists(session_id, name):
+        return name
+    from story_pdf import create_story_pdf # fpdf ładowany dopiero przy pierwszym PDF
+
+    blob_store = get_blob_store()
+    # Bajty ilustracji z lokalnego magazynu (bez zapytań sieciowych); brakujące obrazy to None
+    images = [blob_store.get(digest) for digest in blobs]
+    with metrics.stage("pdf"):
+        pdf_bytes = create_story_pdf(title, story, scenes, images, on_warning=warnings.append,
+                                     image_dpi=PDF_IMAGE_DPI, image_quality=PDF_IMAGE_QUALITY)
+    return artifacts.put(session_id, name, pdf_bytes)
+
+def pdf_job():
+    """Zadanie składania PDF dla bieżących danych; `job.progress` zawiera ostrzeżenia.
+
+    Nazwa pliku pochodzi ze skrótu tytułu, opowiadania, scen i ilustracji, więc PDF
+    jest składany ponownie tylko wtedy, gdy któreś z nich zostanie zmienione.
+    """
+    blobs = list(st.session_state.get('illustration_blobs', []))
+    key = job_key("pdf", st.session_state.title, st.session_state.story, st.session_state.scenes, blobs,
+                  PDF_IMAGE_DPI, PDF_IMAGE_QUALITY)
+    warnings = []
+    return prefetch.start("pdf", key, build_pdf, artifact_session, f"story-{key[:16]}.pdf", st.session_state.title,
+                          st.session_state.story, list(st.session_state.scenes), blobs, warnings, progress=warnings)
+
+def prefetch_pdf():
+    """Zaczyna składanie PDF w tle, gdy ilustracje są gotowe (i od nowa po każdej zmianie danych)."""
+    if st.session_state.stage >= 8 and all(key in st.session_state for key in ('title', 'story', 'scenes')):
+        pdf_job()
+
+def stop_story():
+    """Przerywa pisanie opowiadania i wraca do scen."""
+    prefetch.discard("story")
+    set_stage(4)
 
 
 # --- Interfejs użytkownika Streamlit ---
 
 st.set_page_config(page_title="Generator Opowiadań AI", layout="wide", initial_sidebar_state="expanded")
+if WARM_UP_ENABLED:
+    start_warm_up()
 
 # OpenAI API key protection
 if not st.session_state.get("openai_api_key"):
@@ -231,11 +356,153 @@ if not st.session_state.get("openai_api_key"):
 if not st.session_state.get("openai_api_key"):
     st.stop()
 
-# Inicjalizacja klienta OpenAI z biblioteką instructor
-# Umożliwia to strukturyzowane odpowiedzi w formacie Pydantic
+# Klienci OpenAI (zwykły i z biblioteką instructor) są wspólni dla procesu - silnik sesji jest lekki
+
+# Metryki sesji przetrwają kolejne uruchomienia skryptu
+if 'metrics' not in st.session_state:
+    st.session_state.metrics = MetricsRecorder(log_path=METRICS_LOG_PATH, registry=get_metrics_registry())
+metrics = st.session_state.metrics
+
+def session_alive() -> Callable[[], bool]:
+    """Sprawdza, czy bieżąca sesja przeglądarki nadal istnieje (praca w tle zamkniętej karty jest przerywana).
+
+    Sesja uznawana jest za zamkniętą dopiero po DISCONNECT_GRACE_SECONDS bez połączenia.
+    """
+    try:
+        from streamlit.runtime import Runtime
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+        runtime, session_id = Runtime.instance(), get_script_run_ctx().session_id
+    except Exception:
+        return lambda: True
+    disconnected = {"since": None}
+
+    def alive() -> bool:
+        if runtime.is_active_session(session_id):
+            disconnected["since"] = None
+            return True
+        since = disconnected["since"] = disconnected["since"] or time.monotonic()
+        return time.monotonic() - since < DISCONNECT_GRACE_SECONDS
+    return alive
+
+# Token anulowania sesji: reset historii lub zamknięcie karty przerywa jej zapytania do API
+if 'cancel_token' not in st.session_state:
+    st.session_state.cancel_token = CancelToken(alive=session_alive())
+
+def cancel_requests():
+    """Przerywa zapytania bieżącej historii (także liczone w tle) i zakłada nowy token."""
+    st.session_state.cancel_token.cancel("nowa historia")
+    st.session_state.cancel_token = CancelToken(alive=session_alive())
+
+api_key = st.session_state["openai_api_key"]
+engine = StoryEngine(
+    clients=lambda: get_api_clients(api_key), # Klienci (i import openai) dopiero przy pierwszym zapytaniu
+    metrics=metrics,
+    cache=get_llm_cache(),
+    blob_store=get_blob_store(),
+    illustration_workers=ILLUSTRATION_WORKERS,
+    illustration_slots=get_illustration_slots(ILLUSTRATION_MAX_IN_FLIGHT),
+    chapter_workers=CHAPTER_WORKERS,
+    runner=RequestRunner(REQUEST_POLICIES, token=st.session_state.cancel_token),
+)
+
+# Zadania w tle tej sesji (wyniki kolejnych kroków liczone z wyprzedzeniem)
+if 'prefetch' not in st.session_state:
+    st.session_state.prefetch = Prefetcher(get_prefetch_executor(PREFETCH_WORKERS))
+prefetch = st.session_state.prefetch
+# Zapytania w locie (ilustracje scen), które nowe zadanie przejmuje od zastąpionego
+if 'shared_calls' not in st.session_state:
+    st.session_state.shared_calls = SharedCalls()
+shared_calls = st.session_state.shared_calls
+
+# Pliki wynikowe sesji są na dysku; w stanie sesji trzymamy tylko ich nazwy
+if 'artifact_session' not in st.session_state:
+    st.session_state.artifact_session = uuid.uuid4().hex
+artifacts = get_artifact_store()
+artifact_session = st.session_state.artifact_session
+artifacts.touch(artifact_session)
+artifacts.evict_idle() # Najwyżej raz na kilka minut dla całego procesu
+
+# Każda historia jest trwałym zadaniem; jego ID jest w adresie strony (?job=...), więc po zamknięciu
+# karty lub restarcie serwera ten sam adres wznawia historię od ostatniego punktu kontrolnego
+jobs = get_job_store()
+
+def live_blobs() -> set:
+    """Usuwa wygasłe zadania i zwraca skróty blobów pozostałych (przegląd magazynu blobów)."""
+    jobs.expire(JOB_TTL_DAYS * 24 * 3600)
+    return jobs.blob_digests()
+
+get_blob_store().evict(live_blobs) # Najwyżej raz na kilka minut dla całego procesu
+
+STORY_STATE_KEYS = ['title', 'summary', 'scenes', 'story', 'story_inputs', 'illustrations', 'illustration_blobs',
+                    'illustration_index', 'pdf_artifact', 'epub_artifact', 'audio_artifact']
+
+def remember_job(job_id: str) -> None:
+    """Dopisuje zadanie na początek listy historii tej przeglądarki (tylko one są pokazywane w panelu)."""
+    own_jobs = [other for other in st.session_state.get('own_jobs', []) if other != job_id]
+    st.session_state.own_jobs = [job_id, *own_jobs][:20]
+
+def restore_job(job_id: str) -> bool:
+    """Odtwarza stan sesji z punktów kontrolnych zadania; zwraca False, jeśli zadania nie ma.
+
+    Etap przerwany w trakcie (np. część ilustracji) jest kontynuowany - zapisane wyniki
+    nie są liczone ponownie, a brakujące powstają od nowa.
+    """
+    job = jobs.get(job_id)
+    if job is None:
+        return False
+    prefetch.clear()
+    for key in STORY_STATE_KEYS:
+        st.session_state.pop(key, None)
+    for key, value in job["options"].items():
+        st.session_state[key] = value
+    st.session_state.job_id = job_id
+    remember_job(job_id)
+    st.session_state.illustrations = []
+    stage = 1 # Bez punktów kontrolnych zaczynamy od tytułu
+
+    title_and_summary = jobs.load(job_id, "title_and_summary")
+    scenes = jobs.load(job_id, "scenes")
+    story = jobs.load(job_id, "story")
+    if title_and_summary:
+        st.session_state.title, st.session_state.summary = title_and_summary
+        stage = 2
+        if scenes:
+            st.session_state.scenes = [Scene.model_validate(scene) for scene in scenes]
+            stage = 4
+            if story:
+                st.session_state.story = story["text"]
+                st.session_state.story_inputs = story["inputs"]
+                stage = 6
+
+    saved = jobs.illustrations(job_id)
+    st.session_state.illustration_index = {key: value["url"] for key, value in saved.items()}
+    if stage == 6:
+        story_style = current_story_style()
+        entries = [saved.get(illustration_key(prompt, story_style)) for prompt in scene_prompts(st.session_state.scenes)]
+        if all(entries):
+            blob_store = get_blob_store()
+            st.session_state.illustrations = [entry["url"] for entry in entries]
+            st.session_state.illustration_blobs = [entry["blob"] or blob_store.digest_for_url(entry["url"])
+                                                   for entry in entries]
+            stage = 8
+
+    audio = jobs.load(job_id, "audio")
+    if audio and stage >= 6:
+        blob_store = get_blob_store()
+        if all(os.path.exists(blob_store.path(digest)) for digest in audio["blobs"]):
+            artifacts.put(artifact_session, "audio.mp3", (blob_store.get(digest) for digest in audio["blobs"]))
+            st.session_state.audio_artifact = "audio.mp3"
+
+    if jobs.load(job_id, "stage") == stage + 1:
+        stage += 1 # Krok był zatwierdzony, ale nie został ukończony - kontynuujemy go
+    st.session_state.stage = stage
+    return True
 
-instructor_openai_client = instructor.from_openai(OpenAI(api_key=st.session_state["openai_api_key"]))
-client = OpenAI(api_key=st.session_state["openai_api_key"])
+requested_job = st.query_params.get("job")
+if requested_job and requested_job != st.session_state.get('job_id'):
+    if not restore_job(requested_job):
+        st.warning(f"Nie znaleziono zadania {requested_job}.")
+        del st.query_params["job"]
 
 st.title("🧙‍♂️ Generator Opowiadań z Ilustracjami")
 st.markdown("Stwórz własne, unikalne opowiadanie z pomocą sztucznej inteligencji. Podaj temat, a my zajmiemy się resztą!")
@@ -246,181 +513,142 @@ if 'stage' not in st.session_state:
     st.session_state.stage = 0
 if 'illustrations' not in st.session_state: # Inicjalizacja listy ilustracji
     st.session_state.illustrations = []
+st.session_state.setdefault("topic", DEFAULT_TOPIC)
 
 
 def set_stage(stage):
     st.session_state.stage = stage
+    checkpoint("stage", stage) # Zatwierdzony krok jest wznawiany po przerwaniu
+
+def start_adventure():
+    """Zaczyna nową historię dla bieżącego tematu."""
+    # Resetowanie poprzednich danych jeśli zaczynamy od nowa z tym samym tematem
+    for key in STORY_STATE_KEYS:
+        if key in st.session_state:
+            del st.session_state[key]
+    st.session_state.illustrations = [] # Ponowna inicjalizacja
+    prefetch.clear() # Wyniki liczone w tle dotyczą poprzedniej historii
+    cancel_requests()
+    # Nowa historia to nowe zadanie z bieżącymi ustawieniami panelu
+    options = {key: st.session_state[key] for key in JOB_OPTION_KEYS if key in st.session_state}
+    st.session_state.job_id = jobs.create(option("topic", DEFAULT_TOPIC), options)
+    remember_job(st.session_state.job_id)
+    st.query_params["job"] = st.session_state.job_id
+    set_stage(1)
+
+# Części interfejsu z własnymi widżetami są fragmentami (st.fragment): zmiana w jednym z nich
+# uruchamia ponownie tylko ten fragment, a nie cały skrypt. Generowanie kolejnych kroków
+# odbywa się w pełnych przebiegach, uruchamianych przyciskami "Zatwierdź...".
 
 # KROK 1: Podanie tematu
-with st.sidebar:
+@st.fragment
+def sidebar_panel():
     st.header("Panel Sterowania")
-    topic = st.text_area("Wpisz tematykę opowiadania:", "Zaginiony artefakt w magicznym lesie, strzeżony przez starożytne stworzenia.", height=100)
+    st.text_area("Wpisz tematykę opowiadania:", height=100, key="topic") # Domyślny temat ustawiany w stanie sesji
 
     col1, col2 = st.columns(2)
 
     with col1:
         st.subheader("Wybierz styl opowiadania")
         # Pole wyboru dla zmiennej 'style'
-        style_options = ['Szekspira', 'Fantasy', 'Science-fiction', 'Norwida', 'Zbigniewa Herberta', 'INNE']
-        style = st.selectbox("Wybierz styl:", style_options)
+        style_options = STYLE_OPTIONS + ['INNE']
+        st.selectbox("Wybierz styl:", style_options, key="style_choice")
         # Jeśli wybrano "INNE", wyświetl pole tekstowe
-        if style == "INNE":
-            custom_style = st.text_input("Wprowadź własny styl:")
-            if custom_style:  # Upewnij się, że pole nie jest puste
-                style = custom_style
-        st.write(f"Wybrany styl: {style}")
+        if option("style_choice") == "INNE":
+            st.text_input("Wprowadź własny styl:", key="custom_style")
+        st.write(f"Wybrany styl: {selected_style()}")
 
     with col2:
         st.subheader("Wybierz pisarza")
         # Pole wyboru pisarza
-        writer_options = ["Innowacyjność i wszechstronność", "Głębia i unikalność", "Wizjonerstwo i dynamiczność", "Uniwersalność"]
-        writer = st.selectbox("Wybierz pisarza:", writer_options)
-        # Jeśli wybrano 
-        if writer == "Innowacyjność i wszechstronność":
-            writer_desc = f"Jesteś światowej klasy, wysoce kreatywnym pisarzem, zdolnym do generowania innowacyjnych treści w dowolnym stylu literackim. Twoje dzieła muszą być oryginalne, angażujące i inspirujące, przekraczając granice konwencji. Dąż do zaskoczenia i pobudzenia wyobraźni. Twórz w stylu {style}"
-        elif writer == "Głębia i unikalność":
-            writer_desc = f"Jesteś geniuszem literackim i niezrównanym pisarzem. Twoją misją jest tworzenie hipnotyzujących i intrygujących fabuł, które wyróżniają się głębią, oryginalnością i emocjonalnym rezonansem. Każde dzieło powinno zawierać ziarno nowej, nieodkrytej historii, gotowej do rozwinięcia. Twórz w stylu {style}"
-        elif writer == "Wizjonerstwo i dynamiczność":
-            writer_desc = f"Jesteś wizjonerskim i globalnie cenionym mistrzem pióra, który specjalizuje się w tworzeniu dynamicznych i porywających fabuł. Twoim zadaniem jest przekształcanie idei w iskrzące narracje, które natychmiastowo chwytają uwagę i pozostawiają niezatarte wrażenie. Skup się na innowacji i sile przekazu. Twórz w stylu {style}."
-        else:
-            writer_desc = f"Jesteś światowej sławy, niezmiernie kreatywnym pisarzem. Generujesz innowacyjne i porywające fabuły w stylu {style}, które inspirują i zaskakują swoją oryginalnością."
-
-        st.write(f"Wybrany pisarz: {writer_desc}")
-
-
-
-    if st.button("Rozpocznij przygodę!", on_click=set_stage, args=(1,)):
-        # Resetowanie poprzednich danych jeśli zaczynamy od nowa z tym samym tematem
-        keys_to_reset = ['title', 'summary', 'scenes', 'story', 'illustrations']
-        for key in keys_to_reset:
-            if key in st.session_state:
-                del st.session_state[key]
-        st.session_state.illustrations = [] # Ponowna inicjalizacja
-        pass
+        writer_options = list(WRITER_PROFILES)
+        st.selectbox("Wybierz pisarza:", writer_options, key="writer")
+        st.write(f"Wybrany pisarz: {current_story_style().writer_desc}")
+
+    # Pominięcie cache wymusza nowe zapytania do API (np. gdy chcemy inną wersję dla tego samego tematu)
+    st.checkbox("Generuj od nowa (pomiń zapisane wyniki)", value=False, key="regenerate")
+    st.checkbox("Pokazuj opowiadanie na bieżąco podczas pisania", value=True, key="stream_story_text")
+    # Szybki plan: tytuł, opis i sceny w jednym zapytaniu - wszystko nadal można edytować
+    st.checkbox("Szybki plan (tytuł, opis i sceny od razu)", value=False, key="fast_plan")
+    # Długa forma: osobny rozdział dla każdej sceny, wszystkie pisane jednocześnie
+    st.checkbox("Długa forma (rozdział na scenę)", value=False, key="long_form")
+    if option("long_form"):
+        st.checkbox("Wygładź przejścia między rozdziałami", value=False, key="smooth_chapters")
+    # Kolejny krok liczony jest już podczas przeglądania bieżącego; zmiana danych odrzuca taki wynik
+    st.checkbox("Przygotowuj kolejne kroki w tle", value=PREFETCH_ENABLED, key="prefetch_next")
+
+    if st.button("Rozpocznij przygodę!", on_click=start_adventure):
+        st.rerun() # Pełny przebieg - kolejne kroki są poza tym fragmentem
+
+    # Wznawianie przerwanych i otwieranie gotowych historii po ID zadania
+    with st.expander("Zapisane historie", expanded=False):
+        if st.session_state.get('job_id'):
+            st.caption(f"ID bieżącej historii: {st.session_state.job_id}")
+        # Tylko historie utworzone lub otwarte w tej przeglądarce - baza zadań jest wspólna dla wszystkich
+        # użytkowników, więc cudze zadania można otworzyć wyłącznie znając ich ID
+        own_jobs = [job for job in map(jobs.get, st.session_state.get('own_jobs', [])) if job is not None]
+        recent = {f"{job['topic'][:40]} ({job['id']}, {'gotowa' if job['status'] == 'done' else 'w toku'})": job["id"]
+                  for job in own_jobs}
+        chosen = st.selectbox("Ostatnie historie:", list(recent), index=None, key="recent_job")
+        job_id = st.text_input("lub ID historii:", key="job_id_input")
+        if st.button("Otwórz historię") and (job_id.strip() or chosen):
+            st.query_params["job"] = job_id.strip() or recent[chosen]
+            st.rerun() # Pełny przebieg odtwarza historię z zadania
 
     col1, col2 = st.columns(2)
 
     with col1:
         st.subheader("Wybierz styl Ilustracji")
         # Pole wyboru dla stylu ilustracji
-        Image_options = ['fantasy', 'fcience-fiction', 'steampunk', 'cyberpunk', 'fotorealizm', 'akwarela', 'komiks', 'manga', 'anime', 'Van Gogha', 'Salvadora Dalego']
-        Image_style = st.selectbox("Wybierz styl:", Image_options)
-        st.write(f"Styl ilustracji: {Image_style}")
+        st.selectbox("Wybierz styl:", IMAGE_STYLE_OPTIONS, key="image_style")
+        st.write(f"Styl ilustracji: {option('image_style')}")
 
     with col2:
         st.subheader("Wybierz atmosferę ilustracji")
         # Pole wyboru atmosfery ilustracji
-        atmospher_options = ["mroczny", "radosny", "tajemniczy", "epicki", "spokojny", "dynamiczny", "dramatyczny", "nostalgiczny"]
-        atmospher_style = st.selectbox("Wybierz atmosferę ilustracji:", atmospher_options)
-        st.write(f"Atmosfera i nastrój: {atmospher_style}")
-# Tworzenie zakładek
-tab1, tab2, tab3, tab4 = st.tabs(["Przygotowanie opowiadania", "Opowiadanie", "Tworzenie pdf", "Tworzenie audio"])
-
-with tab1:
-    # KROK 2: Generowanie i edycja tytułu/opisu
-    if st.session_state.stage >= 1:
-        st.header("Krok 1: Tytuł i Zarys Fabuły")
-        if 'title' not in st.session_state or st.session_state.stage == 1: # Generuj tylko raz lub gdy stage to wymusza
-            with st.spinner("Czaruję tytuł i zarys fabuły... ✨"):
-                title, summary = generate_title_and_summary(topic)
-                if title and summary:
-                    st.session_state.title = title
-                    st.session_state.summary = summary
-                    st.session_state.stage = 2 # Automatyczne przejście do następnego etapu
-                else:
-                    st.session_state.stage = 0 # Wróć jeśli błąd
-        
-        if 'title' in st.session_state and 'summary' in st.session_state:
-            st.session_state.title = st.text_input("Tytuł:", st.session_state.title)
-            st.session_state.summary = st.text_area("Opis:", st.session_state.summary, height=150)
-            
-            if st.button("Zatwierdź i generuj sceny ➡️", on_click=set_stage, args=(3,)):
-                pass
-
-    # KROK 3: Generowanie i edycja scen
-    if st.session_state.stage >= 3:
-        st.header("Krok 2: Kluczowe Sceny")
-        if 'scenes' not in st.session_state or st.session_state.stage == 3:
-            with st.spinner("Kreuję kluczowe sceny opowieści... 🎬"):
-                scenes = generate_scenes(st.session_state.title, st.session_state.summary)
-                if scenes:
-                    st.session_state.scenes = scenes
-                    st.session_state.stage = 4
-                else:
-                    st.session_state.stage = 2 # Wróć jeśli błąd
-        
-        if 'scenes' in st.session_state:
-            for i, scene in enumerate(st.session_state.scenes):
-                with st.expander(f"Rozdział {i+1}: {scene.scene_title}", expanded=True):
-                    new_title = st.text_input(f"Rozdział {i+1}", scene.scene_title, key=f"title_{i}")
-                    new_desc = st.text_area(f"Opis rozdziału {i+1}", scene.scene_description, key=f"desc_{i}", height=120)
-                    # Aktualizacja w locie może być problematyczna bez odpowiedniego callbacka,
-                    # lepiej aktualizować listę obiektów Scene
-                    if new_title != scene.scene_title or new_desc != scene.scene_description:
-                        st.session_state.scenes[i] = Scene(scene_title=new_title, scene_description=new_desc)
-            
-            if st.button("Zatwierdź i napisz opowiadanie ➡️", on_click=set_stage, args=(5,)):
-                pass
-
-    # KROK 4: Generowanie i edycja opowiadania
-    if st.session_state.stage >= 5:
-        st.header("Krok 3: Twoje Opowiadanie")
-        if 'story' not in st.session_state or st.session_state.stage == 5:
-            with st.spinner("Pióro samo pisze historię... 📜"):
-                story = generate_story(st.session_state.title, st.session_state.scenes)
-                if story:
-                    st.session_state.story = story
-                    st.session_state.stage = 6
-                else:
-                    st.session_state.stage = 4 # Wróć jeśli błąd
-        
-        if 'story' in st.session_state:
-            st.session_state.story = st.text_area("Edytuj swoje opowiadanie:", st.session_state.story, height=400)
-            col1, col2 = st.columns(2)
-            with col1:
-                if st.button("Zatwierdź i generuj ilustracje ➡️", on_click=set_stage, args=(7,)):
-                    pass
-            with col2:
-                # Przycisk do rozpoczęcia od nowa
-                st.markdown("---")
-                if st.button("✨ Stwórz nową historię od początku ✨"):
-                    keys_to_clear = list(st.session_state.keys())
-                    for key in keys_to_clear:
-                        if key != 'stage': # Zachowaj 'stage' aby uniknąć pętli
-                                del st.session_state[key]
-                    st.session_state.illustrations = [] # Wyraźnie wyczyść listę
-                    set_stage(0) # Zresetuj etap
-                    st.rerun()  
-
-
-    # KROK 5: Generowanie ilustracji
-    if st.session_state.stage >= 7:
-        st.header("Krok 4: Ilustracje")
-        # Generuj ilustracje tylko jeśli jeszcze nie istnieją lub jeśli etap został jawnie ustawiony na 7
-        if 'illustrations' not in st.session_state or not st.session_state.illustrations or st.session_state.stage == 7:
-            if 'scenes' in st.session_state:
-                with st.spinner("Artysta-mag maluje obrazy... 🎨 (To może chwilę potrwać)"):
-                    illustrations_temp = []
-                    prompts = [f"{s.scene_title}: {s.scene_description}" for s in st.session_state.scenes]
-                    
-                    progress_bar = st.progress(0)
-                    total_scenes = len(prompts)
-
-                    for i, prompt in enumerate(prompts):
-                        st.info(f"Generowanie ilustracji do sceny {i+1}/{total_scenes}: {st.session_state.scenes[i].scene_title}...")
-                        image_url = generate_illustration(prompt)
-                        # Nawet jeśli image_url jest None, dodajemy placeholder, aby zachować kolejność
-                        illustrations_temp.append(image_url if image_url else "error") # "error" lub None jako placeholder
-                        progress_bar.progress((i + 1) / total_scenes)
-
-                    st.session_state.illustrations = illustrations_temp
-                    st.session_state.stage = 8 # Przejdź do następnego etapu po zakończeniu generowania
-                    st.success("Wszystkie ilustracje zostały (lub próbowano je) wygenerować!")
-                    st.balloons()
-            else:
-                st.error("Brak scen do wygenerowania ilustracji.")
-                st.session_state.stage = 6 # Wróć, jeśli nie ma scen
-with tab2:
+        st.selectbox("Wybierz atmosferę ilustracji:", ATMOSPHERE_OPTIONS, key="atmosphere")
+        st.write(f"Atmosfera i nastrój: {option('atmosphere')}")
+
+@st.fragment
+def title_editor():
+    """Edycja tytułu i opisu; przy przeglądaniu sceny liczą się już w tle."""
+    title = st.text_input("Tytuł:", st.session_state.title)
+    summary = st.text_area("Opis:", st.session_state.summary, height=150)
+    if title != st.session_state.title or summary != st.session_state.summary:
+        st.session_state.title, st.session_state.summary = title, summary
+        checkpoint("title_and_summary", [title, summary])
+        prefetch_pdf()
+
+    if st.session_state.stage == 2 and option("prefetch_next", PREFETCH_ENABLED):
+        scenes_job(st.session_state.title, st.session_state.summary, refresh=option("regenerate", False),
+                   speculative=True)
+
+@st.fragment
+def scene_editor(i: int):
+    """Edycja jednej sceny - zmiana odświeża tylko jej panel."""
+    scene = st.session_state.scenes[i]
+    with st.expander(f"Rozdział {i+1}: {scene.scene_title}", expanded=True):
+        new_title = st.text_input(f"Rozdział {i+1}", scene.scene_title, key=f"title_{i}")
+        new_desc = st.text_area(f"Opis rozdziału {i+1}", scene.scene_description, key=f"desc_{i}", height=120)
+        # Aktualizacja w locie może być problematyczna bez odpowiedniego callbacka,
+        # lepiej aktualizować listę obiektów Scene
+        if new_title != scene.scene_title or new_desc != scene.scene_description:
+            st.session_state.scenes[i] = Scene(scene_title=new_title, scene_description=new_desc)
+            checkpoint("scenes", [scene.model_dump() for scene in st.session_state.scenes])
+            prefetch_from_scenes() # Dane się zmieniły - zadania w tle zaczynają od nowa
+            prefetch_pdf()
+
+@st.fragment
+def story_editor():
+    """Edycja gotowego opowiadania."""
+    story = st.text_area("Edytuj swoje opowiadanie:", st.session_state.story, height=400)
+    if story != st.session_state.story:
+        st.session_state.story = story
+        checkpoint("story", {"text": story, "inputs": st.session_state.get('story_inputs')})
+        prefetch_pdf() # Gotowy PDF dotyczy poprzedniej wersji tekstu
+
+@st.fragment
+def results_panel():
     # KROK 6: Wyświetlanie finalnego rezultatu
     if st.session_state.stage >= 8:
         st.header("🎉 Twoja Ukończona Historia! 🎉")
@@ -439,6 +667,7 @@ with tab2:
         # Wyświetl Sceny i Ilustracje
         st.subheader("Sceny i Ilustracje")
         if 'scenes' in st.session_state:
+            blob_store = get_blob_store()
             for i, scene in enumerate(st.session_state.scenes):
                 st.markdown(f"### Scena {i+1}: {scene.scene_title}")
                 st.write(scene.scene_description)
@@ -446,9 +675,13 @@ with tab2:
                 # Sprawdzenie, czy ilustracje istnieją i czy jest ilustracja dla tej sceny
                 if 'illustrations' in st.session_state and i < len(st.session_state.illustrations):
                     img_url = st.session_state.illustrations[i]
+                    blobs = st.session_state.get('illustration_blobs', [])
+                    # Ścieżka do lokalnej kopii - bajty nie są wczytywane do pamięci skryptu
+                    img_path = blob_store.path(blobs[i]) if i < len(blobs) and blobs[i] else None
                     if img_url and img_url != "error":
                         try:
-                            st.image(img_url, caption=f"Ilustracja do sceny: {scene.scene_title}", use_column_width=True)
+                            # Preferuj lokalną kopię; URL tylko jako rezerwa (może już wygasnąć)
+                            st.image(img_path or img_url, caption=f"Ilustracja do sceny: {scene.scene_title}", use_column_width=True)
                         except Exception as e:
                             st.warning(f"Nie udało się wyświetlić ilustracji dla sceny '{scene.scene_title}'. URL: {img_url}. Błąd: {e}")
                     elif img_url == "error":
@@ -460,37 +693,79 @@ with tab2:
                 st.markdown("---") # Separator po każdej scenie
         else:
             st.warning("Brak scen do wyświetlenia.")
-with tab3:   
+
+@st.fragment
+def pdf_panel():
     # Przycisk pobierania PDF
     if 'title' in st.session_state and 'story' in st.session_state and 'scenes' in st.session_state and 'illustrations' in st.session_state:
-        if st.button("Pobierz opowiadanie jako PDF 📄"):
-            with st.spinner("Przygotowuję PDF... Może to chwilę potrwać, zwłaszcza z obrazami. ⏳"):
-                pdf_file_name = f"{st.session_state.title.replace(' ', '_').replace('.', '').lower()}_opowiadanie.pdf"
-                
-                # Filtrujemy ilustracje, które nie są 'error' lub None
-                valid_illustrations = [url for url in st.session_state.illustrations if url and url != "error"]
-                
-                # Jeśli sceny i ilustracje mają różne długości (np. błędy w generowaniu),
-                # musimy przekazać do PDF tylko te ilustracje, które faktycznie istnieją
-                # Dla uproszczenia, create_story_pdf obsłuży brakujące URL-e
-                
-                pdf_bytes = create_story_pdf(
-                    st.session_state.title,
-                    st.session_state.story,
-                    st.session_state.scenes, # Przekazujemy wszystkie sceny
-                    st.session_state.illustrations # Przekazujemy wszystkie URL-e (funkcja PDF obsłuży błędy)
+        # PDF składa się w tle od zakończenia ilustracji; po kliknięciu czekamy tylko na jego dokończenie.
+        # Wcześniej (bez ilustracji) jest składany dopiero na żądanie.
+        job = pdf_job() if st.session_state.stage >= 8 else None
+        if job is None or not job.future.done():
+            if job is not None:
+                st.caption("PDF przygotowuje się w tle...")
+            if st.button("Pobierz opowiadanie jako PDF 📄"):
+                with st.spinner("Przygotowuję PDF... Może to chwilę potrwać, zwłaszcza z obrazami. ⏳"):
+                    job = job or pdf_job()
+                    try:
+                        job.wait()
+                    except Exception:
+                        pass # Błąd wyświetlany poniżej
+
+        if job is not None and job.future.done():
+            for warning in job.progress:
+                st.warning(warning)
+            error = job.future.exception()
+            if error is not None:
+                st.error(f"Błąd podczas finalizowania PDF: {error}")
+                st.error("Nie udało się wygenerować pliku PDF.")
+                prefetch.pop("pdf") # Kolejne odświeżenie spróbuje ponownie
+            else:
+                pdf_artifact = job.future.result()
+                if st.session_state.get('pdf_artifact') not in (None, pdf_artifact):
+                    artifacts.delete(artifact_session, st.session_state.pdf_artifact) # PDF nieaktualnej wersji
+                st.session_state.pdf_artifact = pdf_artifact
+                st.download_button(
+                    label="Pobierz PDF gotowy!",
+                    # Plik czytany po kliknięciu w wątku Streamlita bez kontekstu sesji - tylko gotowa nazwa artefaktu
+                    data=lambda: artifacts.read(artifact_session, pdf_artifact),
+                    file_name=default_pdf_name(st.session_state.title),
+                    mime="application/pdf"
                 )
-                if pdf_bytes:
-                    st.download_button(
-                        label="Pobierz PDF gotowy!",
-                        data=pdf_bytes,
-                        file_name=pdf_file_name,
-                        mime="application/pdf"
-                    )
-                else:
-                    st.error("Nie udało się wygenerować pliku PDF.")
 
-with tab4:
+        # EPUB ma ten sam układ co PDF; ilustracje są kopiowane z magazynu bez ponownego kodowania
+        if st.button("Pobierz opowiadanie jako EPUB 📚"):
+            with st.spinner("Przygotowuję EPUB... ⏳"):
+                blob_store = get_blob_store()
+                illustration_files = [blob_store.path(digest) if digest else None
+                                      for digest in st.session_state.get('illustration_blobs', [])]
+                try:
+                    with metrics.stage("epub"), artifacts.writer(artifact_session, "story.epub") as epub_file:
+                        create_story_epub(
+                            st.session_state.title,
+                            st.session_state.story,
+                            st.session_state.scenes,
+                            illustration_files,
+                            output=epub_file,
+                            on_warning=st.warning
+                        )
+                    st.session_state.epub_artifact = "story.epub"
+                    st.session_state.epub_file_name = default_epub_name(st.session_state.title)
+                except Exception as e:
+                    st.error(f"Błąd podczas tworzenia EPUB: {e}")
+                    st.session_state.pop('epub_artifact', None)
+
+        if artifacts.exists(artifact_session, st.session_state.get('epub_artifact')):
+            epub_artifact = st.session_state.epub_artifact
+            st.download_button(
+                label="Pobierz EPUB gotowy!",
+                data=lambda: artifacts.read(artifact_session, epub_artifact), # Plik czytany dopiero po kliknięciu
+                file_name=st.session_state.epub_file_name,
+                mime="application/epub+zip"
+            )
+
+@st.fragment
+def audio_panel():
     # KROK 7: Audio
 
     # Opcje głosu
@@ -511,40 +786,68 @@ with tab4:
         if st.button("Generuj Audio"):
             with st.spinner("Generowanie audio... proszę czekać."):
                 try:
-                    # Generowanie audio za pomocą OpenAI TTS
+                    from tts import split_for_tts, synthesize_chunks # Ładowane dopiero przy generowaniu audio
+
+                    # Generowanie audio za pomocą OpenAI TTS: tekst dzielony jest na fragmenty
+                    # poniżej limitu API, syntezowane równolegle i łączone w kolejności.
                     # Domyślny model to 'tts-1', ale możesz użyć 'tts-1-hd' dla wyższej jakości
-                    response = client.audio.speech.create(
-                        model="tts-1",
-                        voice=voice_options[selected_voice],
-                        input=st.session_state.story,
-                    )
-
-                    # Zapisanie audio do zmiennej w pamięci (obiekt BytesIO)
-                    # Zamiast zapisywać do pliku, co jest bardziej efektywne w Streamlit
-                    audio_bytes_io = io.BytesIO()
-                    for chunk in response.iter_bytes(chunk_size=4096):
-                        audio_bytes_io.write(chunk)
-                    audio_bytes_io.seek(0) # Przewiń na początek pliku
-
-                    # Zapisz audio w session_state
-                    st.session_state['audio_data'] = audio_bytes_io
-                    st.session_state['audio_generated'] = True
+                    tts_chunks = split_for_tts(st.session_state.story)
+                    audio_progress = st.progress(0)
+                    # Podpis i odtwarzacz początku są osobnymi elementami: zmiana podpisu nie przerywa odtwarzania
+                    preview_caption, preview_player = st.empty(), st.empty()
+                    voice = voice_options[selected_voice]
+
+                    # Każdy zsyntezowany fragment trafia od razu do magazynu i zadania historii,
+                    # więc ponowienie po błędzie lub przerwaniu nie płaci drugi raz za gotowe fragmenty
+                    blob_store = get_blob_store()
+                    job_id = st.session_state.get('job_id')
+                    load_segment = save_segment = None
+                    if job_id:
+                        def load_segment(text):
+                            return blob_store.get(jobs.load(job_id, audio_segment_name(text, voice, "tts-1")))
+
+                        def save_segment(text, segment):
+                            jobs.save(job_id, audio_segment_name(text, voice, "tts-1"), blob_store.put(segment))
+
+                    # Fragmenty audio są dopisywane strumieniowo do pliku sesji na dysku,
+                    # więc w pamięci jest naraz najwyżej kilka fragmentów, a nie całe nagranie
+                    segments = synthesize_chunks(engine.client, tts_chunks, voice, model="tts-1", max_workers=TTS_WORKERS,
+                                                 metrics=metrics, load_segment=load_segment, save_segment=save_segment,
+                                                 runner=engine.runner)
+                    with artifacts.writer(artifact_session, "audio.mp3") as audio_file:
+                        for i, segment in enumerate(segments):
+                            audio_file.write(segment)
+                            if i == 0 and len(tts_chunks) > 1:
+                                # Odtwarzanie początku, zanim gotowa będzie reszta opowiadania
+                                preview_caption.caption("Początek opowiadania (reszta w przygotowaniu):")
+                                preview_player.audio(segment, format="audio/mpeg", autoplay=True)
+                            audio_progress.progress((i + 1) / len(tts_chunks))
+                    if len(tts_chunks) > 1:
+                        # Odtwarzacz początku zostaje do następnej interakcji - usunięcie go przerwałoby słuchanie
+                        preview_caption.caption("Początek opowiadania (pełne nagranie w odtwarzaczu poniżej):")
+
+                    # W session_state zapisujemy tylko nazwę pliku
+                    st.session_state['audio_artifact'] = "audio.mp3"
+                    if job_id:
+                        checkpoint("audio", {"voice": voice, "blobs": [
+                            jobs.load(job_id, audio_segment_name(text, voice, "tts-1")) for text in tts_chunks]})
                     st.success("Audio wygenerowane pomyślnie!")
 
                 except Exception as e:
                     st.error(f"Wystąpił błąd podczas generowania audio: {e}")
-                    st.session_state['audio_generated'] = False
+                    st.session_state.pop('audio_artifact', None)
 
     # Wyświetlanie odtwarzacza audio, jeśli audio zostało wygenerowane
-    if 'audio_generated' in st.session_state and st.session_state['audio_generated']:
-        if 'audio_data' in st.session_state:
+    if st.session_state.get('audio_artifact'):
+        if artifacts.exists(artifact_session, st.session_state['audio_artifact']):
+            audio_artifact = st.session_state['audio_artifact']
             st.subheader("Odtwarzacz Opowiadania")
-            st.audio(st.session_state['audio_data'], format="audio/mpeg")
+            st.audio(artifacts.path(artifact_session, audio_artifact), format="audio/mpeg")
             st.write("Możesz teraz odtworzyć wygenerowane audio.")
 
             # --- Przycisk do pobierania pliku ---
-            # Użyj kopii danych, aby nie zakłócać odtwarzania, jeśli BytesIO jest używane do pobierania
-            audio_data_for_download = st.session_state['audio_data'].getvalue()
+            # Plik czytany jest z dysku dopiero po kliknięciu, a nie przy każdym odświeżeniu strony
+            audio_data_for_download = lambda: artifacts.read(artifact_session, audio_artifact)
 
             # Generuj unikalną nazwę pliku
             current_time = datetime.now().strftime("%Y%m%d_%H%M%S")
@@ -559,13 +862,210 @@ with tab4:
             # --- Koniec przycisku do pobierania ---
 
         else:
-            st.error("Błąd: Dane audio nie zostały znalezione w sesji.")
+            st.error("Błąd: Plik audio tej sesji nie został znaleziony (mógł zostać usunięty po okresie bezczynności).")
 
     st.markdown("---")
 
 
+with st.sidebar:
+    sidebar_panel()
 
+regenerate = option("regenerate", False)
 
+# Tworzenie zakładek
+tab1, tab2, tab3, tab4 = st.tabs(["Przygotowanie opowiadania", "Opowiadanie", "Tworzenie pdf i epub", "Tworzenie audio"])
 
+with tab1:
+    # KROK 2: Generowanie i edycja tytułu/opisu
+    if st.session_state.stage >= 1:
+        st.header("Krok 1: Tytuł i Zarys Fabuły")
+        if st.session_state.stage == 1 and option("fast_plan", False):
+            with st.spinner("Czaruję tytuł, zarys fabuły i sceny... ✨"):
+                title, summary, scenes = generate_plan(option("topic", DEFAULT_TOPIC), refresh=regenerate)
+                if title and summary and scenes:
+                    st.session_state.title = title
+                    st.session_state.summary = summary
+                    st.session_state.scenes = scenes
+                    checkpoint("title_and_summary", [title, summary])
+                    checkpoint("scenes", [scene.model_dump() for scene in scenes])
+                    st.session_state.stage = 4 # Od razu do edycji scen; opowiadanie może zacząć się w tle
+                else:
+                    st.session_state.stage = 0 # Wróć jeśli błąd
+        elif 'title' not in st.session_state or st.session_state.stage == 1: # Generuj tylko raz lub gdy stage to wymusza
+            with st.spinner("Czaruję tytuł i zarys fabuły... ✨"):
+                title, summary = generate_title_and_summary(option("topic", DEFAULT_TOPIC), refresh=regenerate)
+                if title and summary:
+                    st.session_state.title = title
+                    st.session_state.summary = summary
+                    checkpoint("title_and_summary", [title, summary])
+                    st.session_state.stage = 2 # Automatyczne przejście do następnego etapu
+                else:
+                    st.session_state.stage = 0 # Wróć jeśli błąd
+        
+        if 'title' in st.session_state and 'summary' in st.session_state:
+            title_editor()
 
+            if st.button("Zatwierdź i generuj sceny ➡️", on_click=set_stage, args=(3,)):
+                pass
 
+    # KROK 3: Generowanie i edycja scen
+    if st.session_state.stage >= 3:
+        st.header("Krok 2: Kluczowe Sceny")
+        if 'scenes' not in st.session_state or st.session_state.stage == 3:
+            with st.spinner("Kreuję kluczowe sceny opowieści... 🎬"):
+                try:
+                    # Jeśli sceny były liczone w tle dla tych samych danych, wynik jest już gotowy
+                    scenes = scenes_job(st.session_state.title, st.session_state.summary, refresh=regenerate).wait()
+                except Exception as e:
+                    st.error(f"Błąd podczas generowania scen: {e}")
+                    scenes = []
+                prefetch.pop("scenes")
+                if scenes:
+                    st.session_state.scenes = scenes
+                    checkpoint("scenes", [scene.model_dump() for scene in scenes])
+                    st.session_state.stage = 4
+                else:
+                    st.session_state.stage = 2 # Wróć jeśli błąd
+        
+        if 'scenes' in st.session_state:
+            for i in range(len(st.session_state.scenes)):
+                scene_editor(i)
+
+            prefetch_from_scenes()
+            
+            if st.button("Zatwierdź i napisz opowiadanie ➡️", on_click=set_stage, args=(5,)):
+                pass
+
+    # KROK 4: Generowanie i edycja opowiadania
+    if st.session_state.stage >= 5:
+        st.header("Krok 3: Twoje Opowiadanie")
+        if st.session_state.stage == 5 and not regenerate and story_is_current(st.session_state.title, st.session_state.scenes):
+            # Sceny i styl bez zmian - zachowujemy dotychczasowe (być może edytowane) opowiadanie
+            st.session_state.stage = 6
+        if 'story' not in st.session_state or st.session_state.stage == 5:
+            # Opowiadanie mogło zacząć się pisać w tle już podczas edycji scen
+            job = story_job(st.session_state.title, st.session_state.scenes, refresh=regenerate)
+            try:
+                if option("stream_story_text", True):
+                    # Kliknięcie przerywa zadanie (zamyka strumień) i wraca do scen
+                    st.button("⏹️ Przerwij pisanie", on_click=stop_story)
+                    story_placeholder = st.empty()
+                    try:
+                        story = job.wait(on_progress=lambda parts: story_placeholder.markdown("".join(parts) + "▌"))
+                    finally:
+                        story_placeholder.empty()
+                else:
+                    with st.spinner("Pióro samo pisze historię... 📜"):
+                        story = job.wait()
+            except Exception as e:
+                st.error(f"Błąd podczas generowania opowiadania: {e}")
+                story = ""
+            prefetch.pop("story")
+            if story:
+                st.session_state.story = story
+                st.session_state.story_inputs = story_inputs(st.session_state.title, st.session_state.scenes)
+                checkpoint("story", {"text": story, "inputs": st.session_state.story_inputs})
+                st.session_state.stage = 6
+            else:
+                st.session_state.stage = 4 # Wróć jeśli błąd
+        
+        if 'story' in st.session_state:
+            story_editor()
+            col1, col2 = st.columns(2)
+            with col1:
+                if st.button("Zatwierdź i generuj ilustracje ➡️", on_click=set_stage, args=(7,)):
+                    pass
+            if st.session_state.stage == 6 and option("prefetch_next", PREFETCH_ENABLED):
+                illustrations_job(st.session_state.scenes, refresh=regenerate, speculative=True)
+            with col2:
+                # Przycisk do rozpoczęcia od nowa
+                st.markdown("---")
+                if st.button("✨ Stwórz nową historię od początku ✨"):
+                    prefetch.clear()
+                    st.session_state.cancel_token.cancel("nowa historia") # Nowy token powstanie po przeładowaniu
+                    artifacts.drop(artifact_session)
+                    if "job" in st.query_params:
+                        del st.query_params["job"] # Zadanie zostaje w bazie - można je otworzyć po ID
+                    keys_to_clear = list(st.session_state.keys())
+                    for key in keys_to_clear:
+                        if key not in ('stage', 'own_jobs'): # Zachowaj 'stage' (unika pętli) i listę historii
+                                del st.session_state[key]
+                    st.session_state.illustrations = [] # Wyraźnie wyczyść listę
+                    set_stage(0) # Zresetuj etap
+                    st.rerun()  
+
+
+    # KROK 5: Generowanie ilustracji
+    if st.session_state.stage >= 7:
+        st.header("Krok 4: Ilustracje")
+        # Generuj ilustracje tylko jeśli jeszcze nie istnieją lub jeśli etap został jawnie ustawiony na 7
+        if 'illustrations' not in st.session_state or not st.session_state.illustrations or st.session_state.stage == 7:
+            if 'scenes' in st.session_state:
+                with st.spinner("Artysta-mag maluje obrazy... 🎨 (To może chwilę potrwać)"):
+                    total_scenes = len(st.session_state.scenes)
+                    progress_bar = st.progress(0)
+                    st.info(f"Generowanie {total_scenes} ilustracji (do {ILLUSTRATION_WORKERS} jednocześnie)...")
+
+                    # Ilustracje mogły powstawać w tle od zatwierdzenia scen; pobrane bajty są w magazynie,
+                    # bo URL-e DALL-E wygasają, a PDF i podgląd korzystają z lokalnych kopii
+                    job = illustrations_job(st.session_state.scenes, refresh=regenerate)
+                    try:
+                        illustrations, illustration_blobs = job.wait(
+                            on_progress=lambda completed: progress_bar.progress(len(completed) / max(1, total_scenes)))
+                    except Exception as e:
+                        st.error(f"Błąd podczas generowania ilustracji: {e}")
+                        illustrations, illustration_blobs = ["error"] * total_scenes, [None] * total_scenes
+                    prefetch.pop("illustrations")
+                    progress_bar.progress(1.0)
+                    for i, error in sorted(job.progress, key=lambda item: item[0]):
+                        if error:
+                            scene_title = st.session_state.scenes[i].scene_title
+                            st.error(f"Błąd podczas generowania ilustracji do sceny {i+1} ({scene_title}): {error}")
+                    # Nawet jeśli ilustracja się nie powiedzie, lista zachowuje kolejność scen ("error" jako placeholder)
+                    st.session_state.illustrations = illustrations
+                    st.session_state.illustration_blobs = illustration_blobs
+                    # Indeks "treść sceny + styl -> ilustracja" pozwala później odtworzyć tylko zmienione sceny
+                    illustration_index = st.session_state.setdefault('illustration_index', {})
+                    story_style = current_story_style()
+                    for prompt, url in zip(scene_prompts(st.session_state.scenes), illustrations):
+                        if url != "error":
+                            illustration_index[illustration_key(prompt, story_style)] = url
+                    st.session_state.stage = 8 # Przejdź do następnego etapu po zakończeniu generowania
+                    if 'error' not in illustrations and st.session_state.get('job_id'):
+                        jobs.set_status(st.session_state.job_id, "done")
+                    prefetch_pdf() # PDF składa się w tle, zanim użytkownik poprosi o plik
+                    st.success("Wszystkie ilustracje zostały (lub próbowano je) wygenerować!")
+                    st.balloons()
+            else:
+                st.error("Brak scen do wygenerowania ilustracji.")
+                st.session_state.stage = 6 # Wróć, jeśli nie ma scen
+with tab2:
+    results_panel()
+with tab3:
+    pdf_panel()
+with tab4:
+    audio_panel()
+
+# Panel metryk na końcu skryptu, aby uwzględniał etapy wykonane w tym przebiegu
+with st.sidebar:
+    with st.expander("📊 Metryki wydajności i koszty", expanded=False):
+        metrics_summary = metrics.summary()
+        if metrics_summary:
+            total = metrics_summary["razem"]
+            col1, col2, col3 = st.columns(3)
+            col1.metric("Czas API", f"{total['seconds']:.1f} s")
+            col2.metric("Tokeny", total["tokens"])
+            col3.metric("Koszt", f"${total['cost_usd']:.4f}")
+            st.dataframe(
+                [{"etap": stage, **values} for stage, values in metrics_summary.items() if stage != "razem"],
+                hide_index=True,
+            )
+        else:
+            st.caption("Brak pomiarów w tej sesji.")
+        st.download_button(
+            label="Pobierz metryki (Prometheus)",
+            data=get_metrics_registry().render_prometheus(),
+            file_name="metrics.prom",
+            mime="text/plain"
+        )
+        st.caption(f"Log wszystkich etapów: {METRICS_LOG_PATH}")
@@ -0,0 +1,166 @@
+"""Pliki wynikowe sesji (audio, PDF) przechowywane na dysku zamiast w pamięci.
+
+Stan sesji Streamlit trzyma tylko nazwę artefaktu; bajty są zapisywane
+strumieniowo do katalogu sesji i czytane dopiero wtedy, gdy są potrzebne
+(odtwarzacz, pobranie pliku). Każda sesja ma limit zajętego miejsca - po jego
+przekroczeniu usuwane są najstarsze artefakty tej sesji - a katalogi sesji
+nieużywanych dłużej niż `idle_seconds` są kasowane.
+"""
+import os
+import shutil
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterable, Optional
+
+DEFAULT_ARTIFACT_ROOT = os.path.join(".cache", "sessions")
+
+
+class ArtifactStore:
+    """Katalog na artefakty każdej sesji z limitem rozmiaru i usuwaniem nieaktywnych sesji."""
+
+    def __init__(self, root: str = DEFAULT_ARTIFACT_ROOT, quota_bytes: int = 200 * 1024 * 1024,
+                 idle_seconds: float = 24 * 3600, sweep_interval: float = 600):
+        self.root = root
+        self.quota_bytes = quota_bytes
+        self.idle_seconds = idle_seconds
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0.0
+        self._lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _session_dir(self, session_id: str) -> str:
+        if not session_id or os.sep in session_id or session_id.startswith("."):
+            raise ValueError(f"Nieprawidłowy identyfikator sesji: {session_id!r}")
+        return os.path.join(self.root, session_id)
+
+    def path(self, session_id: str, name: str) -> str:
+        """Ścieżka artefaktu `name` sesji (plik może nie istnieć)."""
+        if not name or os.path.basename(name) != name or name.startswith("."):
+            raise ValueError(f"Nieprawidłowa nazwa artefaktu: {name!r}")
+        return os.path.join(self._session_dir(session_id), name)
+
+    def exists(self, session_id: str, name: Optional[str]) -> bool:
+        return bool(name) and os.path.exists(self.path(session_id, name))
+
+    def touch(self, session_id: str) -> None:
+        """Oznacza sesję jako aktywną (czas modyfikacji katalogu decyduje o usunięciu)."""
+        session_dir = self._session_dir(session_id)
+        if os.path.isdir(session_dir):
+            os.utime(session_dir)
+
+    @contextmanager
+    def writer(self, session_id: str, name: str):
+        """Otwiera plik do strumieniowego zapisu; artefakt pojawia się dopiero po udanym zamknięciu.
+
+        Zgłasza ValueError, jeśli sam artefakt przekracza limit sesji.
+        """
+        final_path = self.path(session_id, name)
+        os.makedirs(os.path.dirname(final_path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(final_path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                yield _QuotaFile(f, self.quota_bytes)
+            os.replace(tmp_path, final_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self._enforce_quota(session_id, keep=name)
+
+    def put(self, session_id: str, name: str, data) -> str:
+        """Zapisuje bajty (lub iterowalną sekwencję fragmentów) jako artefakt; zwraca jego nazwę."""
+        chunks: Iterable[bytes] = [data] if isinstance(data, (bytes, bytearray, memoryview)) else data
+        with self.writer(session_id, name) as f:
+            for chunk in chunks:
+                f.write(chunk)
+        return name
+
+    def open(self, session_id: str, name: str):
+        """Plik artefaktu do odczytu (np. dla `st.download_button`)."""
+        self.touch(session_id)
+        return open(self.path(session_id, name), "rb")
+
+    def read(self, session_id: str, name: str) -> bytes:
+        with self.open(session_id, name) as f:
+            return f.read()
+
+    def delete(self, session_id: str, name: str) -> None:
+        try:
+            os.remove(self.path(session_id, name))
+        except FileNotFoundError:
+            pass
+
+    def usage(self, session_id: str) -> int:
+        """Łączny rozmiar artefaktów sesji w bajtach."""
+        session_dir = self._session_dir(session_id)
+        if not os.path.isdir(session_dir):
+            return 0
+        return sum(entry.stat().st_size for entry in os.scandir(session_dir)
+                   if entry.is_file() and not entry.name.startswith("."))
+
+    def drop(self, session_id: str) -> None:
+        """Usuwa wszystkie artefakty sesji."""
+        shutil.rmtree(self._session_dir(session_id), ignore_errors=True)
+
+    def _enforce_quota(self, session_id: str, keep: Optional[str] = None) -> None:
+        session_dir = self._session_dir(session_id)
+        entries = sorted((entry for entry in os.scandir(session_dir)
+                          if entry.is_file() and not entry.name.startswith(".")),
+                         key=lambda entry: entry.stat().st_mtime)
+        total = sum(entry.stat().st_size for entry in entries)
+        for entry in entries:
+            if total <= self.quota_bytes:
+                break
+            if entry.name != keep:
+                total -= entry.stat().st_size
+                os.remove(entry.path)
+
+    def evict_idle(self, force: bool = False) -> int:
+        """Usuwa katalogi sesji nieaktywnych dłużej niż `idle_seconds`; zwraca ich liczbę.
+
+        Bez `force` przegląd wykonywany jest co najwyżej raz na `sweep_interval` sekund.
+        """
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_sweep < self.sweep_interval:
+                return 0
+            self._last_sweep = now
+        removed = 0
+        for entry in os.scandir(self.root):
+            if entry.is_dir() and now - entry.stat().st_mtime > self.idle_seconds:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                removed += 1
+        return removed
+
+
+class _QuotaFile:
+    """Opakowanie pliku przerywające zapis po przekroczeniu limitu rozmiaru.
+
+    Obsługuje też `tell`/`seek`, żeby np. `zipfile` mógł uzupełniać nagłówki wpisów.
+    """
+
+    def __init__(self, f, limit: int):
+        self._f = f
+        self._limit = limit
+        self.written = 0
+
+    def write(self, data) -> int:
+        end = self._f.tell() + len(data)
+        if end > self._limit:
+            raise ValueError(f"Artefakt przekracza limit sesji ({self._limit // (1024 * 1024)} MB).")
+        self.written = max(self.written, end)
+        return self._f.write(data)
+
+    def tell(self) -> int:
+        return self._f.tell()
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        return self._f.seek(offset, whence)
+
+    def seekable(self) -> bool:
+        return True
+
+    def flush(self) -> None:
+        self._f.flush()
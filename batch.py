@@ -0,0 +1,150 @@
+"""Wsadowe generowanie ebooków bez interfejsu Streamlit.
+
+Przykład:
+    python batch.py tematy.jsonl --output-dir ebooki --workers 8
+
+Plik wejściowy może być:
+- JSONL: jeden obiekt na linię z polem "topic" i opcjonalnie "style", "writer",
+  "image_style", "atmosphere",
+- CSV z nagłówkiem o tych samych kolumnach,
+- zwykłym plikiem tekstowym: jeden temat na linię (style domyślne).
+
+Każde opowiadanie przechodzi cały potok w osobnym procesie; `--workers` ogranicza
+liczbę opowiadań tworzonych jednocześnie. `--format` wybiera PDF, EPUB albo oba
+(EPUB jest znacznie tańszy w budowie przy dużych partiach). `--long-form` pisze
+osobny rozdział dla każdej sceny (rozdziały jednego opowiadania powstają
+równolegle). Podsumowanie trafia do `raport.jsonl`, a czasy, tokeny i koszty
+poszczególnych etapów do `metryki.jsonl`.
+
+Wyniki etapów każdego opowiadania są zapisywane jako punkty kontrolne w
+`zadania.sqlite3` w katalogu wyjściowym. Ponowne uruchomienie z tym samym plikiem
+wejściowym wznawia przerwane opowiadania bez powtarzania opłaconych zapytań.
+"""
+import argparse
+import csv
+import hashlib
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from dotenv import dotenv_values
+
+from blob_store import BlobStore
+from job_store import JobStore
+from llm_cache import LLMCache
+from metrics import MetricsRecorder
+from rate_limit import DEFAULT_LIMITS
+from story_engine import StoryEngine, StoryStyle, create_api_clients, create_rate_limiter, run_pipeline
+
+_engine = None # Silnik tworzony raz na proces roboczy
+_job_store = None
+
+
+def load_jobs(path: str):
+    """Wczytuje listę zadań (słowników z tematem i stylem) z pliku JSONL, CSV lub TXT."""
+    with open(path, encoding="utf-8") as f:
+        if path.endswith(".csv"):
+            jobs = [dict(row) for row in csv.DictReader(f)]
+        elif path.endswith((".jsonl", ".json")):
+            jobs = [json.loads(line) for line in f if line.strip()]
+        else:
+            jobs = [{"topic": line.strip()} for line in f if line.strip()]
+    return [job for job in jobs if job.get("topic")]
+
+
+def job_id_for(index: int, job: dict) -> str:
+    """Stały identyfikator zadania dla pozycji pliku wejściowego (ten sam przy ponownym uruchomieniu)."""
+    payload = json.dumps(job, ensure_ascii=False, sort_keys=True)
+    return f"{index:04d}-{hashlib.sha256(payload.encode('utf-8')).hexdigest()[:10]}"
+
+
+def _init_worker(api_key, base_url, illustration_workers, metrics_log, workers, jobs_db):
+    global _engine, _job_store
+    # Każdy proces dostaje równą część limitów konta, żeby razem nie przekroczyć ich w API
+    limits = {model: (max(1, rpm // workers), tpm // workers) for model, (rpm, tpm) in DEFAULT_LIMITS.items()}
+    clients = create_api_clients(api_key, base_url, rate_limiter=create_rate_limiter(limits))
+    _engine = StoryEngine(clients=clients, cache=LLMCache(), blob_store=BlobStore(),
+                          illustration_workers=illustration_workers,
+                          metrics=MetricsRecorder(session_id=f"batch-{os.getpid()}", log_path=metrics_log))
+    _job_store = JobStore(jobs_db)
+
+
+def _run_job(index: int, job: dict, output_dir: str, refresh: bool, long_form: bool = False,
+             smooth: bool = False, formats=("pdf",), fast_plan: bool = False) -> dict:
+    story_style = StoryStyle.from_options(
+        style=job.get("style") or "Fantasy",
+        writer=job.get("writer") or "Uniwersalność",
+        image_style=job.get("image_style") or "fantasy",
+        atmosphere=job.get("atmosphere") or "tajemniczy",
+    )
+    started = time.perf_counter()
+    job_id = _job_store.create(job["topic"], job, job_id=job_id_for(index, job))
+    try:
+        result = run_pipeline(_engine, job["topic"], story_style, output_dir=output_dir,
+                              pdf_prefix=f"{index:04d}_", refresh=refresh, long_form=long_form, smooth=smooth,
+                              formats=formats, job_store=_job_store, job_id=job_id, fast_plan=fast_plan)
+    except Exception as e:
+        return {"index": index, "job_id": job_id, "topic": job["topic"], "status": "error", "error": str(e),
+                "seconds": round(time.perf_counter() - started, 2)}
+    return {"index": index, "job_id": job_id, "topic": job["topic"], "status": "ok", "title": result.title,
+            "pdf": result.pdf_path, "epub": result.epub_path, "failed_illustrations": result.illustrations.count("error"),
+            "seconds": round(time.perf_counter() - started, 2)}
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Generuje ebooki PDF dla listy tematów.")
+    parser.add_argument("input", help="Plik z tematami (.jsonl, .csv lub .txt)")
+    parser.add_argument("--output-dir", default="ebooki", help="Katalog na pliki PDF/EPUB (domyślnie: ebooki)")
+    parser.add_argument("--format", choices=["pdf", "epub", "both"], default="pdf",
+                        help="Format ebooków (domyślnie: pdf)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2,
+                        help="Liczba opowiadań tworzonych jednocześnie (procesy)")
+    parser.add_argument("--illustration-workers", type=int, default=4,
+                        help="Liczba równoległych zapytań do DALL-E w jednym procesie")
+    parser.add_argument("--fast-plan", action="store_true",
+                        help="Tytuł, zarys i sceny jednym zapytaniem zamiast dwóch")
+    parser.add_argument("--long-form", action="store_true",
+                        help="Osobny rozdział dla każdej sceny, pisane równolegle (dłuższe ebooki)")
+    parser.add_argument("--smooth", action="store_true",
+                        help="W trybie --long-form wygładza przejścia między rozdziałami")
+    parser.add_argument("--refresh", action="store_true", help="Pomiń cache odpowiedzi LLM")
+    parser.add_argument("--base-url", default=None, help="Alternatywny adres API zgodnego z OpenAI")
+    args = parser.parse_args(argv)
+    formats = ("pdf", "epub") if args.format == "both" else (args.format,)
+
+    api_key = os.environ.get("OPENAI_API_KEY") or dotenv_values(".env").get("OPENAI_API_KEY")
+    if not api_key:
+        print("Brak klucza OPENAI_API_KEY (zmienna środowiskowa lub plik .env).", file=sys.stderr)
+        return 2
+    jobs = load_jobs(args.input)
+    if not jobs:
+        print("Brak tematów w pliku wejściowym.", file=sys.stderr)
+        return 2
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    failures = 0
+    report_path = os.path.join(args.output_dir, "raport.jsonl")
+    workers = max(1, min(args.workers, len(jobs)))
+    with open(report_path, "w", encoding="utf-8") as report, ProcessPoolExecutor(
+        max_workers=workers,
+        initializer=_init_worker,
+        initargs=(api_key, args.base_url, args.illustration_workers, os.path.join(args.output_dir, "metryki.jsonl"),
+                  workers, os.path.join(args.output_dir, "zadania.sqlite3")),
+    ) as executor:
+        futures = [executor.submit(_run_job, i, job, args.output_dir, args.refresh, args.long_form, args.smooth,
+                                   formats, args.fast_plan) for i, job in enumerate(jobs)]
+        for done, future in enumerate(as_completed(futures), start=1):
+            entry = future.result()
+            failures += entry["status"] != "ok"
+            report.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            report.flush()
+            print(f"[{done}/{len(jobs)}] {entry['status']}: {entry.get('pdf') or entry.get('epub') or entry.get('error')}")
+
+    print(f"Gotowe: {len(jobs) - failures} z {len(jobs)} opowiadań. Raport: {report_path}")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,100 @@
+"""Benchmark składania PDF dla długich książek.
+
+Przykład:
+    python benchmarks/bench_pdf.py --words 100000 --scenes 7 --compare-legacy
+
+Mierzy czas i szczytowe zużycie pamięci (tracemalloc, w osobnym przebiegu) `create_story_pdf` dla
+syntetycznego tekstu o zadanej liczbie słów. Z `--compare-legacy` mierzy też
+dawny sposób składu (cały tekst w jednym `multi_cell`) - uwaga, przy 100 tys.
+słów trwa to kilka minut. Wynik wypisywany jest jako JSON.
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from story_engine import Scene # noqa: E402
+from story_pdf import FONT_FILES, PDF, create_story_pdf # noqa: E402
+
+SENTENCE = "Zażółć gęślą jaźń, rzekł stary strażnik lasu, i ruszył ścieżką ku zapomnianemu artefaktowi."
+
+
+def synthetic_story(words: int, paragraph_words: int = 120) -> str:
+    """Tekst o zadanej liczbie słów, podzielony na akapity."""
+    sentence_words = SENTENCE.split()
+    tokens = [sentence_words[i % len(sentence_words)] for i in range(words)]
+    paragraphs = [" ".join(tokens[i:i + paragraph_words]) for i in range(0, words, paragraph_words)]
+    return "\n\n".join(paragraphs)
+
+
+def synthetic_image() -> bytes:
+    """PNG 1024x1024 z szumem - rozmiarem zbliżony do ilustracji z DALL-E."""
+    from PIL import Image, ImageFilter
+
+    noise = Image.frombytes("RGB", (1024, 1024), os.urandom(1024 * 1024 * 3))
+    buffer = BytesIO()
+    noise.filter(ImageFilter.GaussianBlur(2)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+def legacy_layout(title: str, story_text: str) -> bytes:
+    """Dawny skład: cały tekst w jednym wywołaniu `multi_cell`."""
+    pdf = PDF()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    pdf.alias_nb_pages()
+    for style, path in FONT_FILES.items():
+        pdf.add_font("DejaVu", style, path)
+    pdf.add_page()
+    pdf.set_font("DejaVu", "B", 20)
+    pdf.multi_cell(0, 10, title, 0, "C")
+    pdf.ln(10)
+    pdf.set_font("DejaVu", "", 12)
+    pdf.multi_cell(0, 10, story_text)
+    return bytes(pdf.output())
+
+
+def measure(fn, *args, **kwargs):
+    """Czas jednego wywołania oraz szczytowa pamięć z osobnego przebiegu pod tracemalloc."""
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    seconds = time.perf_counter() - started
+    tracemalloc.start()
+    fn(*args, **kwargs)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, {"seconds": round(seconds, 3), "peak_memory_mb": round(peak / 1e6, 2)}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--words", type=int, default=100_000)
+    parser.add_argument("--scenes", type=int, default=7)
+    parser.add_argument("--repeat", type=int, default=2, help="Liczba kolejnych budowań (pokazuje efekt cache czcionek)")
+    parser.add_argument("--compare-legacy", action="store_true")
+    args = parser.parse_args(argv)
+
+    story = synthetic_story(args.words)
+    images = [synthetic_image() for _ in range(args.scenes)]
+    scenes = [Scene(scene_title=f"Scena {i + 1}", scene_description=SENTENCE * 3) for i in range(args.scenes)]
+    report = {"benchmark": "pdf", "words": args.words, "scenes": args.scenes, "runs": []}
+
+    for _ in range(args.repeat):
+        pdf_bytes, stats = measure(create_story_pdf, "Benchmark", story, scenes, images)
+        stats["pdf_bytes"] = len(pdf_bytes)
+        report["runs"].append(stats)
+
+    if args.compare_legacy:
+        pdf_bytes, stats = measure(legacy_layout, "Benchmark", story)
+        stats["pdf_bytes"] = len(pdf_bytes)
+        report["legacy"] = stats
+
+    print(json.dumps(report, ensure_ascii=False, indent=2))
+
+
+if __name__ == "__main__":
+    main()
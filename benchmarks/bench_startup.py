@@ -0,0 +1,132 @@
+"""Benchmark zimnego startu: czas importu modułów i pierwszego wyświetlenia aplikacji.
+
+Przykład:
+    python benchmarks/bench_startup.py --repeat 5 --max-first-render 3 --output start.json
+
+Każdy pomiar działa w świeżym procesie Pythona (zimny import). Mierzy czas importu
+modułów aplikacji i ciężkich bibliotek oraz czas pierwszego i kolejnego przebiegu
+app.py w `streamlit.testing.v1.AppTest` (bez zapytań do API). Sprawdza też, że
+moduły ładowane leniwie (fpdf, tts, openai, instructor, requests) nie są
+importowane przy pierwszym wyświetleniu. Z `--max-first-render` lub przy
+przedwcześnie załadowanym module kończy się kodem 1 - nadaje się do CI.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Moduły, których import mierzymy osobno
+MODULES = ("streamlit", "pydantic", "httpx", "openai", "instructor", "requests", "fpdf",
+           "story_engine", "story_pdf", "story_epub", "tts", "blob_store", "job_store", "metrics")
+
+# Moduły, które nie powinny być ładowane przy pierwszym wyświetleniu aplikacji
+LAZY_MODULES = ("openai", "instructor", "requests", "fpdf", "story_pdf", "tts")
+
+_IMPORT_PROBE = """
+import sys, time
+sys.path.insert(0, {root!r})
+started = time.perf_counter()
+import {module}
+print(time.perf_counter() - started)
+"""
+
+_RENDER_PROBE = """
+import json, sys, time
+sys.path.insert(0, {root!r})
+started = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+imported = time.perf_counter()
+preloaded = set(sys.modules) # Moduły ładowane przez sam Streamlit nie obciążają aplikacji
+app = AppTest.from_file({app!r}, default_timeout=120)
+app.run()
+first = time.perf_counter()
+loaded = [name for name in {lazy!r} if name in sys.modules and name not in preloaded]
+app.run()
+second = time.perf_counter()
+print(json.dumps({{"streamlit_import": imported - started, "first_render": first - imported,
+                  "rerun": second - first, "lazy_loaded": loaded,
+                  "exceptions": [str(e.value) for e in app.exception]}}))
+"""
+
+
+def _python(code: str, cwd: str) -> str:
+    result = subprocess.run([sys.executable, "-c", code], cwd=cwd, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "błąd procesu")
+    return result.stdout.strip().splitlines()[-1]
+
+
+def measure_imports(repeat: int, cwd: str) -> dict:
+    """Mediana czasu zimnego importu każdego modułu (w sekundach); niedostępne moduły dają błąd."""
+    imports = {}
+    for module in MODULES:
+        try:
+            times = [float(_python(_IMPORT_PROBE.format(root=ROOT, module=module), cwd)) for _ in range(repeat)]
+            imports[module] = round(statistics.median(times), 4)
+        except RuntimeError as e:
+            imports[module] = {"error": str(e)}
+    return imports
+
+
+def measure_render(repeat: int, cwd: str) -> dict:
+    """Mediany czasów pierwszego i kolejnego przebiegu app.py oraz moduły załadowane przedwcześnie."""
+    runs = [json.loads(_python(_RENDER_PROBE.format(root=ROOT, app=os.path.join(ROOT, "app.py"),
+                                                    lazy=LAZY_MODULES), cwd))
+            for _ in range(repeat)]
+    return {
+        "streamlit_import": round(statistics.median(run["streamlit_import"] for run in runs), 4),
+        "first_render": round(statistics.median(run["first_render"] for run in runs), 4),
+        "first_render_max": round(max(run["first_render"] for run in runs), 4),
+        "rerun": round(statistics.median(run["rerun"] for run in runs), 4),
+        "lazy_loaded": sorted({name for run in runs for name in run["lazy_loaded"]}),
+        "exceptions": runs[-1]["exceptions"],
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--repeat", type=int, default=3, help="Liczba świeżych procesów na pomiar")
+    parser.add_argument("--max-first-render", type=float, help="Limit mediany pierwszego wyświetlenia (s)")
+    parser.add_argument("--skip-imports", action="store_true", help="Tylko pomiar pierwszego wyświetlenia")
+    parser.add_argument("--output", help="Plik JSON na wyniki (domyślnie tylko wypisanie)")
+    args = parser.parse_args(argv)
+
+    # Osobny katalog roboczy: własny .env (klucz-atrapa, bez rozgrzewania w tle, które
+    # ładuje leniwe moduły) i własny .cache, żeby pomiar nie zależał od stanu repozytorium
+    with tempfile.TemporaryDirectory() as cwd:
+        with open(os.path.join(cwd, ".env"), "w", encoding="utf-8") as f:
+            f.write("OPENAI_API_KEY=sk-benchmark\nWARM_UP_ENABLED=0\nPREFETCH_ENABLED=0\n")
+        report = {
+            "benchmark": "startup",
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "repeat": args.repeat,
+            "imports": {} if args.skip_imports else measure_imports(args.repeat, cwd),
+            "app": measure_render(args.repeat, cwd),
+        }
+
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+
+    problems = []
+    if report["app"]["lazy_loaded"]:
+        problems.append(f"Moduły załadowane przy pierwszym wyświetleniu: {', '.join(report['app']['lazy_loaded'])}")
+    if args.max_first_render and report["app"]["first_render"] > args.max_first_render:
+        problems.append(f"Pierwsze wyświetlenie {report['app']['first_render']:.2f} s > {args.max_first_render:g} s")
+    for problem in problems:
+        print(problem, file=sys.stderr)
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,218 @@
+"""Lokalny serwer udający API OpenAI (chat, obrazy, TTS) do benchmarków bez kosztów.
+
+Przykład samodzielnego uruchomienia:
+    python benchmarks/mock_openai.py --port 8765 --chat-latency 0.5 --image-latency 2
+
+Klient OpenAI łączy się z nim przez `base_url="http://127.0.0.1:8765/v1"`.
+Odpowiedzi czatu w trybie narzędzi (instructor) są wypełniane na podstawie
+schematu JSON modelu Pydantic, więc serwer obsługuje dowolny `response_model`.
+"""
+import argparse
+import json
+import os
+import threading
+import time
+import uuid
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+LOREM = ("Stary strażnik lasu podniósł latarnię i spojrzał w głąb ścieżki, gdzie między korzeniami "
+         "połyskiwał zapomniany artefakt. ").split()
+
+
+@dataclass
+class MockConfig:
+    """Opóźnienia (w sekundach) i rozmiary odpowiedzi serwera."""
+    chat_latency: float = 0.2
+    image_latency: float = 1.0
+    tts_latency: float = 0.5
+    story_words: int = 1500
+    stream_chunk_words: int = 5
+    list_items: int = 6
+    image_size: int = 1024 # Obrazy to PNG z szumem, rozmiarem zbliżone do ilustracji DALL-E
+    audio_bytes: int = 200_000
+
+
+def _words(count: int) -> str:
+    return " ".join(LOREM[i % len(LOREM)] for i in range(count))
+
+
+def fake_from_schema(schema: dict, defs: dict, list_items: int):
+    """Tworzy przykładową wartość zgodną ze schematem JSON (podzbiór używany przez Pydantic)."""
+    if "$ref" in schema:
+        return fake_from_schema(defs[schema["$ref"].split("/")[-1]], defs, list_items)
+    if "allOf" in schema:
+        return fake_from_schema(schema["allOf"][0], defs, list_items)
+    if "anyOf" in schema:
+        return fake_from_schema(schema["anyOf"][0], defs, list_items)
+    kind = schema.get("type")
+    if kind == "object" or "properties" in schema:
+        return {name: fake_from_schema(prop, defs, list_items) for name, prop in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [fake_from_schema(schema.get("items", {}), defs, list_items) for _ in range(list_items)]
+    if kind == "integer":
+        return 1
+    if kind == "number":
+        return 1.0
+    if kind == "boolean":
+        return True
+    return _words(12)
+
+
+def _noise_png(size: int) -> bytes:
+    from PIL import Image, ImageFilter
+
+    noise = Image.frombytes("RGB", (size, size), os.urandom(size * size * 3))
+    buffer = BytesIO()
+    noise.filter(ImageFilter.GaussianBlur(2)).save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = "MockOpenAI/1.0"
+
+    def log_message(self, format, *args): # Bez logowania każdego zapytania
+        pass
+
+    @property
+    def config(self) -> MockConfig:
+        return self.server.config
+
+    def _send_json(self, payload: dict, status: int = 200) -> None:
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_json(self) -> dict:
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def do_GET(self):
+        if self.path.startswith("/images/"):
+            # Kolejne obrazy są różne (pula wariantów), żeby deduplikacja nie zaniżała rozmiaru PDF
+            index = int(self.path.split("/")[-1].split("-")[0])
+            body = self.server.image_variants[index % len(self.server.image_variants)]
+            self.send_response(200)
+            self.send_header("Content-Type", "image/png")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self._send_json({"error": {"message": "not found"}}, 404)
+
+    def do_POST(self):
+        request = self._read_json()
+        request_number = self.server.count(self.path)
+        if self.path.endswith("/chat/completions"):
+            self._chat(request)
+        elif self.path.endswith("/images/generations"):
+            time.sleep(self.config.image_latency)
+            host, port = self.server.server_address[:2]
+            index = request_number
+            self._send_json({"created": int(time.time()),
+                             "data": [{"url": f"http://{host}:{port}/images/{index}-{uuid.uuid4().hex}.png"}]})
+        elif self.path.endswith("/audio/speech"):
+            time.sleep(self.config.tts_latency)
+            body = os.urandom(self.config.audio_bytes)
+            self.send_response(200)
+            self.send_header("Content-Type", "audio/mpeg")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self._send_json({"error": {"message": "not found"}}, 404)
+
+    def _chat(self, request: dict) -> None:
+        time.sleep(self.config.chat_latency)
+        prompt_tokens = sum(len(str(m.get("content", "")).split()) for m in request.get("messages", []))
+        base = {"id": f"chatcmpl-{uuid.uuid4().hex}", "created": int(time.time()), "model": request.get("model", "mock")}
+        if request.get("tools"):
+            function = request["tools"][0]["function"]
+            schema = function.get("parameters", {})
+            arguments = json.dumps(fake_from_schema(schema, schema.get("$defs", {}), self.config.list_items),
+                                   ensure_ascii=False)
+            message = {"role": "assistant", "content": None, "tool_calls": [{
+                "id": f"call_{uuid.uuid4().hex[:12]}", "type": "function",
+                "function": {"name": function["name"], "arguments": arguments}}]}
+            completion_tokens = len(arguments.split())
+            self._send_json({**base, "object": "chat.completion", "choices": [
+                {"index": 0, "message": message, "finish_reason": "tool_calls"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                          "total_tokens": prompt_tokens + completion_tokens}})
+            return
+        text = _words(self.config.story_words)
+        if not request.get("stream"):
+            self._send_json({**base, "object": "chat.completion", "choices": [
+                {"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": self.config.story_words,
+                          "total_tokens": prompt_tokens + self.config.story_words}})
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+        words = text.split(" ")
+        step = self.config.stream_chunk_words
+        for i in range(0, len(words), step):
+            chunk = {**base, "object": "chat.completion.chunk", "choices": [
+                {"index": 0, "delta": {"content": " ".join(words[i:i + step]) + " "}, "finish_reason": None}]}
+            self.wfile.write(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+
+
+class MockOpenAIServer(ThreadingHTTPServer):
+    """Serwer w wątku tła; używany jako kontekst `with MockOpenAIServer(config) as server:`."""
+
+    daemon_threads = True
+
+    def __init__(self, config: MockConfig = None, host: str = "127.0.0.1", port: int = 0):
+        super().__init__((host, port), _Handler)
+        self.config = config or MockConfig()
+        self.image_variants = [_noise_png(self.config.image_size) for _ in range(max(1, self.config.list_items))]
+        self.requests = {}
+        self._count_lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def base_url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def count(self, path: str) -> int:
+        with self._count_lock:
+            self.requests[path] = self.requests.get(path, 0) + 1
+            return self.requests[path]
+
+    def __enter__(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.shutdown()
+        self.server_close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Lokalny serwer udający API OpenAI.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--chat-latency", type=float, default=MockConfig.chat_latency)
+    parser.add_argument("--image-latency", type=float, default=MockConfig.image_latency)
+    parser.add_argument("--tts-latency", type=float, default=MockConfig.tts_latency)
+    parser.add_argument("--story-words", type=int, default=MockConfig.story_words)
+    args = parser.parse_args(argv)
+    config = MockConfig(chat_latency=args.chat_latency, image_latency=args.image_latency,
+                        tts_latency=args.tts_latency, story_words=args.story_words)
+    server = MockOpenAIServer(config, port=args.port)
+    print(f"Mock OpenAI API: {server.base_url}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
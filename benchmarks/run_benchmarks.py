@@ -0,0 +1,165 @@
+"""Benchmark całego potoku na lokalnym serwerze udającym OpenAI (bez kosztów API).
+
+Przykład:
+    python benchmarks/run_benchmarks.py --sessions 8 --image-latency 2 --output wyniki.json
+
+Mierzy czas każdego etapu pojedynczej sesji (tytuł, sceny lub wspólny plan,
+opowiadanie, ilustracje, TTS, PDF, EPUB), rozmiar i szczytową pamięć
+`create_story_pdf` oraz przepustowość przy N równoległych sesjach. Wynik zapisywany jest jako JSON,
+dzięki czemu można porównywać przebiegi między wersjami.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from blob_store import BlobStore # noqa: E402
+from story_engine import StoryEngine, StoryStyle, create_api_clients, scene_prompts # noqa: E402
+from story_epub import create_story_epub # noqa: E402
+from story_pdf import create_story_pdf # noqa: E402
+from tts import split_for_tts, synthesize_chunks # noqa: E402
+
+from mock_openai import MockConfig, MockOpenAIServer # noqa: E402
+
+
+def _timed(stages: dict, name: str, fn, *args, **kwargs):
+    started = time.perf_counter()
+    result = fn(*args, **kwargs)
+    stages[name] = round(time.perf_counter() - started, 4)
+    return result
+
+
+def run_session(engine: StoryEngine, story_style: StoryStyle, with_audio: bool = True, long_form: bool = False,
+                fast_plan: bool = False) -> dict:
+    """Jeden pełny przebieg potoku; zwraca czasy etapów w sekundach."""
+    stages = {}
+    started = time.perf_counter()
+    topic = "Zaginiony artefakt w magicznym lesie"
+    if fast_plan:
+        title, summary, scenes = _timed(stages, "plan", engine.generate_plan, topic, story_style)
+    else:
+        title, summary = _timed(stages, "title_and_summary", engine.generate_title_and_summary, topic, story_style)
+        scenes = _timed(stages, "scenes", engine.generate_scenes, title, summary, story_style)
+    if long_form:
+        story = _timed(stages, "story", engine.generate_long_story, title, summary, scenes, story_style)
+    else:
+        story = _timed(stages, "story", engine.generate_story, title, scenes, story_style)
+    urls = _timed(stages, "illustrations", engine.generate_illustrations, scene_prompts(scenes), story_style)
+    digests = _timed(stages, "illustration_download", engine.blob_store.fetch_many, urls)
+    images = [engine.blob_store.get(digest) for digest in digests]
+    if with_audio:
+        _timed(stages, "tts", lambda: b"".join(synthesize_chunks(engine.client, split_for_tts(story), "alloy")))
+    pdf_bytes = _timed(stages, "pdf", create_story_pdf, title, story, scenes, images)
+    epub_bytes = _timed(stages, "epub", create_story_epub, title, story, scenes,
+                        [engine.blob_store.path(digest) if digest else None for digest in digests])
+    stages["total"] = round(time.perf_counter() - started, 4)
+    return {"stages": stages, "scenes": len(scenes), "story_words": len(story.split()), "pdf_bytes": len(pdf_bytes),
+            "epub_bytes": len(epub_bytes), "images": images, "title": title, "story": story, "scene_objects": scenes}
+
+
+def measure_pdf(session: dict) -> dict:
+    """Czas, rozmiar i szczytowa pamięć `create_story_pdf` dla wyników sesji."""
+    args = (session["title"], session["story"], session["scene_objects"], session["images"])
+    started = time.perf_counter()
+    pdf_bytes = create_story_pdf(*args)
+    seconds = time.perf_counter() - started
+    tracemalloc.start()
+    create_story_pdf(*args)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {"seconds": round(seconds, 4), "bytes": len(pdf_bytes), "peak_memory_mb": round(peak / 1e6, 2)}
+
+
+def _percentile(values, pct):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1)))]
+
+
+def _git_revision() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=4, help="Liczba równoległych sesji w teście przepustowości")
+    parser.add_argument("--chat-latency", type=float, default=MockConfig.chat_latency)
+    parser.add_argument("--image-latency", type=float, default=MockConfig.image_latency)
+    parser.add_argument("--tts-latency", type=float, default=MockConfig.tts_latency)
+    parser.add_argument("--story-words", type=int, default=MockConfig.story_words)
+    parser.add_argument("--scenes", type=int, default=MockConfig.list_items, help="Liczba scen zwracanych przez serwer")
+    parser.add_argument("--image-size", type=int, default=MockConfig.image_size)
+    parser.add_argument("--illustration-workers", type=int, default=4)
+    parser.add_argument("--long-form", action="store_true", help="Opowiadanie jako rozdział na scenę (równolegle)")
+    parser.add_argument("--fast-plan", action="store_true", help="Tytuł, zarys i sceny jednym zapytaniem")
+    parser.add_argument("--output", help="Plik JSON na wyniki (domyślnie tylko wypisanie)")
+    args = parser.parse_args(argv)
+
+    config = MockConfig(chat_latency=args.chat_latency, image_latency=args.image_latency,
+                        tts_latency=args.tts_latency, story_words=args.story_words,
+                        list_items=args.scenes, image_size=args.image_size)
+    story_style = StoryStyle.from_options()
+    with MockOpenAIServer(config) as server, tempfile.TemporaryDirectory() as blob_dir:
+        # Jak w aplikacji: klienci (pula połączeń) wspólni dla wszystkich sesji
+        clients = create_api_clients("mock", server.base_url)
+
+        def new_engine():
+            # Bez cache LLM - każdy przebieg ma mierzyć rzeczywiste zapytania
+            return StoryEngine(clients=clients, blob_store=BlobStore(blob_dir),
+                               illustration_workers=args.illustration_workers)
+
+        single_engine = new_engine()
+        single = run_session(single_engine, story_style, long_form=args.long_form, fast_plan=args.fast_plan)
+        pdf = measure_pdf(single)
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=args.sessions) as executor:
+            sessions = list(executor.map(lambda _: run_session(new_engine(), story_style, with_audio=False,
+                                                                   long_form=args.long_form, fast_plan=args.fast_plan),
+                                         range(args.sessions)))
+        wall = time.perf_counter() - started
+        totals = [s["stages"]["total"] for s in sessions]
+        requests_served = dict(server.requests)
+
+    report = {
+        "benchmark": "pipeline",
+        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "git_revision": _git_revision(),
+        "python": platform.python_version(),
+        "config": vars(args),
+        "single_session": {k: single[k] for k in ("stages", "scenes", "story_words", "pdf_bytes", "epub_bytes")},
+        "pdf": pdf,
+        "single_session_metrics": single_engine.metrics.summary(),
+        "concurrency": {
+            "sessions": args.sessions,
+            "wall_seconds": round(wall, 3),
+            "stories_per_minute": round(args.sessions / wall * 60, 2),
+            "session_seconds_p50": round(statistics.median(totals), 3),
+            "session_seconds_p95": round(_percentile(totals, 95), 3),
+            "session_seconds_max": round(max(totals), 3),
+        },
+        "mock_requests": requests_served,
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(output + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,161 @@
+"""Lokalny magazyn bajtów ilustracji adresowany skrótem zawartości.
+
+Adresy URL z DALL-E wygasają po pewnym czasie, dlatego obrazy pobieramy raz,
+zaraz po wygenerowaniu, i dalej (PDF, podgląd, eksport) korzystamy z kopii na dysku.
+Trafiają tu też fragmenty audio. Bloby, do których nie odwołuje się żadne zadanie,
+są usuwane po `max_age_seconds` albo wcześniej (od najstarszych), gdy magazyn
+przekracza `max_bytes`.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Optional
+
+DEFAULT_BLOB_ROOT = os.path.join(".cache", "blobs")
+
+
+class BlobStore:
+    """Magazyn plików na dysku; kluczem jest SHA-256 zawartości, z indeksem URL -> skrót."""
+
+    def __init__(self, root: str = DEFAULT_BLOB_ROOT, max_bytes: Optional[int] = None,
+                 max_age_seconds: Optional[float] = None, min_age_seconds: float = 3600, sweep_interval: float = 600):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.max_age_seconds = max_age_seconds
+        self.min_age_seconds = min_age_seconds # Świeże bloby mogą jeszcze nie mieć punktu kontrolnego zadania
+        self.sweep_interval = sweep_interval
+        self._last_sweep = 0.0
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(root, "urls"), exist_ok=True)
+
+    def path(self, digest: str) -> str:
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _url_index_path(self, url: str) -> str:
+        return os.path.join(self.root, "urls", hashlib.sha256(url.encode("utf-8")).hexdigest())
+
+    def _write_atomic(self, path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    def put(self, data: bytes) -> str:
+        """Zapisuje bajty i zwraca ich skrót."""
+        digest = hashlib.sha256(data).hexdigest()
+        try:
+            os.utime(self.path(digest)) # Ponownie zapisany blob liczy się jako świeży
+        except FileNotFoundError:
+            self._write_atomic(self.path(digest), data)
+        return digest
+
+    def get(self, digest: Optional[str]) -> Optional[bytes]:
+        """Zwraca bajty dla skrótu albo None, jeśli ich nie ma."""
+        if not digest:
+            return None
+        try:
+            with open(self.path(digest), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def digest_for_url(self, url: str) -> Optional[str]:
+        """Zwraca skrót zawartości pobranej wcześniej z danego URL-a."""
+        try:
+            with open(self._url_index_path(url), "r", encoding="ascii") as f:
+                digest = f.read().strip()
+        except FileNotFoundError:
+            return None
+        return digest if os.path.exists(self.path(digest)) else None
+
+    def fetch(self, url: str, timeout: float = 20) -> str:
+        """Pobiera URL (o ile nie był już pobrany) i zwraca skrót zawartości."""
+        digest = self.digest_for_url(url)
+        if digest:
+            return digest
+        import requests # Ładowane przy pierwszym pobraniu, nie przy starcie aplikacji
+
+        response = requests.get(url, timeout=timeout)
+        response.raise_for_status()
+        digest = self.put(response.content)
+        self._write_atomic(self._url_index_path(url), digest.encode("ascii"))
+        return digest
+
+    def fetch_many(self, urls: List[Optional[str]], max_workers: int = 8, timeout: float = 20):
+        """Pobiera równolegle listę URL-i; zwraca skróty w tej samej kolejności.
+
+        Puste wpisy, placeholdery "error" oraz nieudane pobrania dają None.
+        """
+        import requests
+
+        def fetch_one(url):
+            if not url or url == "error":
+                return None
+            try:
+                return self.fetch(url, timeout=timeout)
+            except requests.exceptions.RequestException:
+                return None
+
+        if not urls:
+            return []
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(urls)))) as executor:
+            return list(executor.map(fetch_one, urls))
+
+    def evict(self, referenced: Callable[[], Iterable[str]], force: bool = False) -> int:
+        """Usuwa bloby spoza `referenced()` (skróty używane przez zadania); zwraca ich liczbę.
+
+        Usuwane są bloby starsze niż `max_age_seconds`, a jeśli magazyn nadal przekracza
+        `max_bytes` - kolejne od najstarszych, ale nie młodsze niż `min_age_seconds`.
+        Bez `force` przegląd wykonywany jest co najwyżej raz na `sweep_interval` sekund.
+        """
+        now = time.time()
+        with self._lock:
+            if not force and now - self._last_sweep < self.sweep_interval:
+                return 0
+            self._last_sweep = now
+        keep = set(referenced())
+        total, candidates = 0, []
+        for directory in os.scandir(self.root):
+            if not directory.is_dir() or directory.name == "urls":
+                continue
+            for entry in os.scandir(directory.path):
+                if not entry.is_file() or len(entry.name) != 64: # Pomijamy pliki tymczasowe zapisu
+                    continue
+                stat = entry.stat()
+                total += stat.st_size
+                if entry.name not in keep and now - stat.st_mtime > self.min_age_seconds:
+                    candidates.append((stat.st_mtime, stat.st_size, entry.path))
+        removed = 0
+        for mtime, size, path in sorted(candidates):
+            expired = self.max_age_seconds is not None and now - mtime > self.max_age_seconds
+            if not expired and (self.max_bytes is None or total <= self.max_bytes):
+                break # Pozostałe są młodsze, a limit rozmiaru jest spełniony
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                continue
+            total -= size
+            removed += 1
+        if removed:
+            self._evict_url_index()
+        return removed
+
+    def _evict_url_index(self) -> None:
+        # Wpisy indeksu URL wskazujące na usunięte bloby
+        for entry in os.scandir(os.path.join(self.root, "urls")):
+            try:
+                with open(entry.path, "r", encoding="ascii") as f:
+                    digest = f.read().strip()
+                if not os.path.exists(self.path(digest)):
+                    os.remove(entry.path)
+            except (FileNotFoundError, ValueError):
+                continue
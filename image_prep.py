@@ -0,0 +1,54 @@
+"""Przygotowanie ilustracji do osadzenia w PDF: zmniejszenie do docelowego DPI i kompresja JPEG."""
+from io import BytesIO
+from typing import Optional
+
+DEFAULT_IMAGE_DPI = 150
+DEFAULT_JPEG_QUALITY = 80
+
+# Sygnatury (magic bytes) obsługiwanych formatów
+_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "PNG"),
+    (b"\xff\xd8\xff", "JPEG"),
+    (b"GIF87a", "GIF"),
+    (b"GIF89a", "GIF"),
+)
+
+
+def detect_image_format(data: bytes) -> Optional[str]:
+    """Rozpoznaje format obrazu na podstawie zawartości (a nie rozszerzenia w URL-u)."""
+    for signature, image_format in _SIGNATURES:
+        if data.startswith(signature):
+            return image_format
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "WEBP"
+    return None
+
+
+def prepare_for_pdf(data: bytes, width_mm: float, dpi: int = DEFAULT_IMAGE_DPI,
+                    quality: int = DEFAULT_JPEG_QUALITY) -> bytes:
+    """Zmniejsza obraz do rozdzielczości potrzebnej przy wydruku o szerokości `width_mm`
+    i zapisuje go jako JPEG o podanej jakości.
+
+    Obrazy mniejsze od docelowego rozmiaru nie są powiększane. Przezroczystość jest
+    spłaszczana na białe tło. Zgłasza ValueError dla nierozpoznanego formatu.
+    """
+    if detect_image_format(data) is None:
+        raise ValueError("Nieobsługiwany lub uszkodzony format obrazu.")
+    from PIL import Image
+
+    with Image.open(BytesIO(data)) as image:
+        target_width = max(1, round(width_mm / 25.4 * dpi))
+        if image.width > target_width:
+            target_height = max(1, round(image.height * target_width / image.width))
+            image.draft("RGB", (target_width, target_height)) # Szybsze dekodowanie dużych JPEG-ów
+            image = image.resize((target_width, target_height), Image.LANCZOS)
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        output = BytesIO()
+        image.save(output, "JPEG", quality=quality, optimize=True)
+    return output.getvalue()
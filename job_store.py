@@ -0,0 +1,147 @@
+"""Trwałe zadania tworzenia opowiadań z punktami kontrolnymi (SQLite).
+
+Każde opowiadanie to zadanie z identyfikatorem, tematem i ustawieniami stylu.
+Po każdym zakończonym etapie (tytuł i zarys, sceny, opowiadanie, pojedyncza
+ilustracja, audio) jego wynik trafia do bazy jako punkt kontrolny. Po zamknięciu
+karty, restarcie serwera lub błędzie w połowie etapu zadanie jest wznawiane od
+ostatniego punktu kontrolnego, a gotowe zadanie można otworzyć ponownie po ID -
+opłacone wywołania API nie są powtarzane. Zadania nieaktualizowane dłużej niż
+ustalony czas wygasają (`expire`) - wtedy ich ilustracje i audio w magazynie
+blobów (`blob_digests`) mogą zostać usunięte.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Dict, Optional, Set
+
+DEFAULT_JOB_DB_PATH = os.path.join(".cache", "jobs.sqlite3")
+
+# Przedrostki nazw punktów kontrolnych zapisywanych osobno dla każdej ilustracji i fragmentu audio
+ILLUSTRATION_PREFIX = "illustration:"
+AUDIO_SEGMENT_PREFIX = "audio_segment:"
+
+
+def audio_segment_name(text: str, voice: str, model: str) -> str:
+    """Nazwa punktu kontrolnego segmentu audio (zależy od tekstu fragmentu, głosu i modelu)."""
+    payload = json.dumps([text, voice, model], ensure_ascii=False)
+    return AUDIO_SEGMENT_PREFIX + hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class JobStore:
+    """Zadania i ich punkty kontrolne w pliku SQLite, bezpieczne dla wielu wątków."""
+
+    def __init__(self, path: str = DEFAULT_JOB_DB_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL") # Zapis z jednego procesu nie blokuje odczytów
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                "id TEXT PRIMARY KEY, topic TEXT NOT NULL, options TEXT NOT NULL, status TEXT NOT NULL, "
+                "created REAL NOT NULL, updated REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS checkpoints ("
+                "job_id TEXT NOT NULL, name TEXT NOT NULL, value TEXT NOT NULL, updated REAL NOT NULL, "
+                "PRIMARY KEY (job_id, name))"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_updated ON jobs(updated)")
+
+    def create(self, topic: str, options: Optional[dict] = None, job_id: Optional[str] = None) -> str:
+        """Zakłada zadanie (lub zwraca istniejące o podanym `job_id`) i zwraca jego ID."""
+        job_id = job_id or uuid.uuid4().hex[:12]
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR IGNORE INTO jobs (id, topic, options, status, created, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                (job_id, topic, json.dumps(options or {}, ensure_ascii=False), "running", now, now),
+            )
+        return job_id
+
+    def get(self, job_id: Optional[str]) -> Optional[dict]:
+        """Zadanie jako słownik (id, topic, options, status, created, updated) albo None."""
+        if not job_id:
+            return None
+        with self._lock:
+            row = self._conn.execute("SELECT id, topic, options, status, created, updated FROM jobs WHERE id = ?",
+                                     (job_id,)).fetchone()
+        return _job(row) if row else None
+
+    def set_status(self, job_id: str, status: str) -> None:
+        """Ustawia status zadania ("running", "done")."""
+        with self._lock, self._conn:
+            self._conn.execute("UPDATE jobs SET status = ?, updated = ? WHERE id = ?", (status, time.time(), job_id))
+
+    def save(self, job_id: str, name: str, value) -> None:
+        """Zapisuje punkt kontrolny `name` (wartość serializowalna do JSON), nadpisując poprzedni."""
+        data = json.dumps(value, ensure_ascii=False)
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO checkpoints (job_id, name, value, updated) VALUES (?, ?, ?, ?)",
+                               (job_id, name, data, now))
+            self._conn.execute("UPDATE jobs SET updated = ? WHERE id = ?", (now, job_id))
+
+    def load(self, job_id: str, name: str, default=None):
+        """Wartość punktu kontrolnego `name` albo `default`, jeśli go nie ma."""
+        with self._lock:
+            row = self._conn.execute("SELECT value FROM checkpoints WHERE job_id = ? AND name = ?",
+                                     (job_id, name)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def checkpoints(self, job_id: str, prefix: str = "") -> Dict[str, object]:
+        """Wszystkie punkty kontrolne zadania (opcjonalnie tylko o nazwach zaczynających się od `prefix`)."""
+        with self._lock:
+            rows = self._conn.execute("SELECT name, value FROM checkpoints WHERE job_id = ? AND substr(name, 1, ?) = ?",
+                                      (job_id, len(prefix), prefix)).fetchall()
+        return {name: json.loads(value) for name, value in rows}
+
+    def save_illustration(self, job_id: str, key: str, url: str, blob: Optional[str]) -> None:
+        """Zapisuje gotową ilustrację sceny (`key` z `story_engine.illustration_key`) i skrót jej lokalnej kopii."""
+        self.save(job_id, ILLUSTRATION_PREFIX + key, {"url": url, "blob": blob})
+
+    def illustrations(self, job_id: str) -> Dict[str, dict]:
+        """Zapisane ilustracje zadania: klucz ilustracji -> {"url", "blob"}."""
+        return {name[len(ILLUSTRATION_PREFIX):]: value
+                for name, value in self.checkpoints(job_id, ILLUSTRATION_PREFIX).items()}
+
+    def blob_digests(self) -> Set[str]:
+        """Skróty blobów wszystkich zadań: lokalne kopie ilustracji i fragmenty audio."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT name, value FROM checkpoints WHERE substr(name, 1, ?) = ? OR substr(name, 1, ?) = ?",
+                (len(ILLUSTRATION_PREFIX), ILLUSTRATION_PREFIX, len(AUDIO_SEGMENT_PREFIX), AUDIO_SEGMENT_PREFIX),
+            ).fetchall()
+        digests = set()
+        for name, value in rows:
+            value = json.loads(value)
+            digest = value.get("blob") if name.startswith(ILLUSTRATION_PREFIX) else value
+            if digest:
+                digests.add(digest)
+        return digests
+
+    def expire(self, max_age_seconds: float) -> int:
+        """Usuwa zadania nieaktualizowane dłużej niż `max_age_seconds` (z punktami kontrolnymi); zwraca ich liczbę."""
+        cutoff = time.time() - max_age_seconds
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM checkpoints WHERE job_id IN (SELECT id FROM jobs WHERE updated < ?)",
+                               (cutoff,))
+            return self._conn.execute("DELETE FROM jobs WHERE updated < ?", (cutoff,)).rowcount
+
+    def delete(self, job_id: str) -> None:
+        """Usuwa zadanie razem z punktami kontrolnymi."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM checkpoints WHERE job_id = ?", (job_id,))
+            self._conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+
+def _job(row) -> dict:
+    job_id, topic, options, status, created, updated = row
+    return {"id": job_id, "topic": topic, "options": json.loads(options), "status": status,
+            "created": created, "updated": updated}
@@ -0,0 +1,88 @@
+"""Trwały cache wyników etapów LLM (tytuł i zarys, sceny, opowiadanie).
+
+Wpisy są adresowane skrótem SHA-256 z modelu, promptu systemowego i wiadomości
+użytkownika, więc ten sam temat w tym samym stylu nie kosztuje ponownie tokenów.
+Cache trzymany jest w pliku SQLite, ma limit rozmiaru (eviction LRU) oraz TTL.
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_PATH = os.path.join(".cache", "llm_cache.sqlite3")
+DEFAULT_MAX_BYTES = 50 * 1024 * 1024 # 50 MB
+DEFAULT_TTL_SECONDS = 7 * 24 * 3600 # 7 dni
+
+
+def make_cache_key(kind: str, model: str, system_prompt: str, user_message: str) -> str:
+    """Zwraca klucz cache dla danego rodzaju odpowiedzi, modelu i promptów."""
+    payload = json.dumps([kind, model, system_prompt, user_message], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """Cache na dysku z ograniczeniem rozmiaru (LRU) i czasem życia wpisów."""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_bytes: int = DEFAULT_MAX_BYTES,
+                 ttl_seconds: float = DEFAULT_TTL_SECONDS):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created REAL NOT NULL, accessed REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed ON entries(accessed)")
+
+    def get(self, key: str):
+        """Zwraca zapisaną wartość (obiekt JSON) albo None, jeśli brak lub wpis wygasł."""
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute("SELECT value, created FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            value, created = row
+            if self.ttl_seconds and now - created > self.ttl_seconds:
+                self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+                return None
+            self._conn.execute("UPDATE entries SET accessed = ? WHERE key = ?", (now, key))
+        return json.loads(value)
+
+    def set(self, key: str, value) -> None:
+        """Zapisuje wartość (serializowalną do JSON) i usuwa najdawniej używane wpisy ponad limit."""
+        data = json.dumps(value, ensure_ascii=False)
+        size = len(data.encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, created, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, data, size, now, now),
+            )
+            self._evict()
+
+    def _evict(self) -> None:
+        if self.ttl_seconds:
+            self._conn.execute("DELETE FROM entries WHERE created < ?", (time.time() - self.ttl_seconds,))
+        total = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self._conn.execute("SELECT key, size FROM entries ORDER BY accessed").fetchall():
+            self._conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self) -> None:
+        """Usuwa wszystkie wpisy."""
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM entries")
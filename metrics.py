@@ -0,0 +1,239 @@
+"""Pomiary czasu, zużycia tokenów i kosztu poszczególnych etapów tworzenia opowiadania.
+
+`MetricsRecorder` zbiera rekordy jednej sesji (lub jednego przebiegu wsadowego)
+i dopisuje je do logu JSONL. `MetricsRegistry` agreguje rekordy ze wszystkich
+sesji procesu i udostępnia je w formacie tekstowym Prometheusa (liczniki
+i histogramy czasu etapów), z którego można liczyć percentyle opóźnień.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import Dict, List, Optional
+
+# Orientacyjne ceny w USD (cennik OpenAI); modele spoza tabeli mają koszt 0.
+PRICES = {
+    "gpt-4o-mini": {"input_token": 0.15 / 1e6, "output_token": 0.60 / 1e6},
+    "gpt-4o": {"input_token": 2.50 / 1e6, "output_token": 10.00 / 1e6},
+    "dall-e-3": {"image": 0.040}, # 1024x1024, jakość standard
+    "tts-1": {"character": 15.00 / 1e6},
+    "tts-1-hd": {"character": 30.00 / 1e6},
+}
+
+DURATION_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+
+# Rekord etapu wykonywanego w bieżącym wątku (wspólny dla wszystkich sesji, bo klienci HTTP są współdzieleni)
+_current = threading.local()
+
+
+@dataclass
+class StageRecord:
+    """Pomiar pojedynczego wywołania etapu."""
+    stage: str
+    session_id: str
+    model: Optional[str] = None
+    started_at: float = field(default_factory=time.time)
+    seconds: float = 0.0
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    images: int = 0
+    characters: int = 0
+    retries: int = 0
+    hedges: int = 0 # Duplikaty wysłane dla wolnych zapytań
+    queued_seconds: float = 0.0 # Czas oczekiwania na limit zapytań/tokenów
+    cached: bool = False
+    cancelled: bool = False # Przerwany po anulowaniu sesji
+    error: Optional[str] = None
+    cost_usd: float = 0.0
+
+    def add_usage(self, usage) -> None:
+        """Dodaje zużycie tokenów z obiektu `usage` odpowiedzi API (jeśli jest)."""
+        if usage is not None:
+            self.prompt_tokens += getattr(usage, "prompt_tokens", 0) or 0
+            self.completion_tokens += getattr(usage, "completion_tokens", 0) or 0
+
+    def estimate_cost(self) -> float:
+        prices = PRICES.get(self.model or "", {})
+        # Duplikat (hedging) zapytania o obraz jest generowany i płatny, choć jego wynik odrzucamy
+        images = self.images + (self.hedges if prices.get("image") else 0)
+        return (self.prompt_tokens * prices.get("input_token", 0)
+                + self.completion_tokens * prices.get("output_token", 0)
+                + images * prices.get("image", 0)
+                + self.characters * prices.get("character", 0))
+
+
+class MetricsRegistry:
+    """Agregaty wszystkich sesji w procesie, eksportowane w formacie Prometheusa."""
+
+    def __init__(self, prometheus_path: Optional[str] = None):
+        self.prometheus_path = prometheus_path
+        self._lock = threading.Lock()
+        self._counters: Dict[tuple, float] = {}
+        self._histograms: Dict[str, List[int]] = {}
+        self._duration_sums: Dict[str, float] = {}
+
+    def _inc(self, name: str, stage: str, value: float) -> None:
+        self._counters[(name, stage)] = self._counters.get((name, stage), 0) + value
+
+    def observe(self, record: StageRecord) -> None:
+        with self._lock:
+            stage = record.stage
+            self._inc("story_stage_calls_total", stage, 1)
+            self._inc("story_stage_errors_total", stage, 1 if record.error else 0)
+            self._inc("story_stage_cache_hits_total", stage, 1 if record.cached else 0)
+            self._inc("story_stage_retries_total", stage, record.retries)
+            self._inc("story_stage_hedges_total", stage, record.hedges)
+            self._inc("story_stage_cancellations_total", stage, 1 if record.cancelled else 0)
+            self._inc("story_stage_queued_seconds_total", stage, record.queued_seconds)
+            self._inc("story_stage_prompt_tokens_total", stage, record.prompt_tokens)
+            self._inc("story_stage_completion_tokens_total", stage, record.completion_tokens)
+            self._inc("story_stage_images_total", stage, record.images)
+            self._inc("story_stage_cost_usd_total", stage, record.cost_usd)
+            buckets = self._histograms.setdefault(stage, [0] * len(DURATION_BUCKETS))
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if record.seconds <= bound:
+                    buckets[i] += 1
+            self._duration_sums[stage] = self._duration_sums.get(stage, 0) + record.seconds
+            text = self._render()
+        if self.prometheus_path:
+            _write_atomic(self.prometheus_path, text)
+
+    def render_prometheus(self) -> str:
+        with self._lock:
+            return self._render()
+
+    def _render(self) -> str:
+        lines = []
+        for name in sorted({name for name, _ in self._counters}):
+            lines.append(f"# TYPE {name} counter")
+            for (counter, stage), value in sorted(self._counters.items()):
+                if counter == name:
+                    lines.append(f'{name}{{stage="{stage}"}} {value:g}')
+        lines.append("# TYPE story_stage_duration_seconds histogram")
+        for stage, buckets in sorted(self._histograms.items()):
+            for bound, count in zip(DURATION_BUCKETS, buckets):
+                lines.append(f'story_stage_duration_seconds_bucket{{stage="{stage}",le="{bound:g}"}} {count}')
+            total = self._counters.get(("story_stage_calls_total", stage), 0)
+            lines.append(f'story_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {total:g}')
+            lines.append(f'story_stage_duration_seconds_sum{{stage="{stage}"}} {self._duration_sums[stage]:.4f}')
+            lines.append(f'story_stage_duration_seconds_count{{stage="{stage}"}} {total:g}')
+        return "\n".join(lines) + "\n"
+
+
+class MetricsRecorder:
+    """Rekordy etapów jednej sesji; każdy rekord trafia też do logu JSONL i rejestru procesu."""
+
+    def __init__(self, session_id: Optional[str] = None, log_path: Optional[str] = None,
+                 registry: Optional[MetricsRegistry] = None):
+        self.session_id = session_id or uuid.uuid4().hex[:12]
+        self.log_path = log_path
+        self.registry = registry
+        self.records: List[StageRecord] = []
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str, model: Optional[str] = None):
+        """Mierzy blok kodu jako etap `name`; zwraca rekord do uzupełnienia (tokeny, obrazy...)."""
+        record = StageRecord(stage=name, session_id=self.session_id, model=model)
+        previous = current_record()
+        _current.record = record
+        started = time.perf_counter()
+        try:
+            yield record
+        except BaseException as e:
+            record.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            record.seconds = round(time.perf_counter() - started, 4)
+            record.cost_usd = round(record.estimate_cost(), 6)
+            _current.record = previous
+            self._add(record)
+
+    def _add(self, record: StageRecord) -> None:
+        with self._lock:
+            self.records.append(record)
+            if self.log_path:
+                if os.path.dirname(self.log_path):
+                    os.makedirs(os.path.dirname(self.log_path), exist_ok=True)
+                with open(self.log_path, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(asdict(record), ensure_ascii=False) + "\n")
+        if self.registry is not None:
+            self.registry.observe(record)
+
+    def summary(self) -> Dict[str, dict]:
+        """Sumy dla każdego etapu oraz łącznie (klucz "razem")."""
+        with self._lock:
+            records = list(self.records)
+        summary: Dict[str, dict] = {}
+        for record in records:
+            for key in (record.stage, "razem"):
+                entry = summary.setdefault(key, {"calls": 0, "seconds": 0.0, "tokens": 0, "images": 0,
+                                                 "retries": 0, "hedges": 0, "queued_seconds": 0.0, "errors": 0,
+                                                 "cancelled": 0, "cost_usd": 0.0})
+                entry["calls"] += 1
+                entry["seconds"] = round(entry["seconds"] + record.seconds, 3)
+                entry["tokens"] += record.prompt_tokens + record.completion_tokens
+                entry["images"] += record.images
+                entry["retries"] += record.retries
+                entry["hedges"] += record.hedges
+                entry["queued_seconds"] = round(entry["queued_seconds"] + record.queued_seconds, 3)
+                entry["errors"] += 1 if record.error else 0
+                entry["cancelled"] += 1 if record.cancelled else 0
+                entry["cost_usd"] = round(entry["cost_usd"] + record.cost_usd, 6)
+        return summary
+
+
+def current_record() -> Optional[StageRecord]:
+    """Rekord etapu mierzonego w bieżącym wątku (None poza `MetricsRecorder.stage`)."""
+    return getattr(_current, "record", None)
+
+
+@contextmanager
+def use_record(record: Optional[StageRecord]):
+    """Przypisuje rekord etapu do bieżącego wątku (np. wątku puli wykonującego zapytanie etapu)."""
+    previous = current_record()
+    _current.record = record
+    try:
+        yield record
+    finally:
+        _current.record = previous
+
+
+def note_retry() -> None:
+    """Zlicza ponowienie zapytania w bieżącym etapie (wywoływane z wątku, który go wykonuje)."""
+    record = current_record()
+    if record is not None:
+        record.retries += 1
+
+
+def note_hedge() -> None:
+    """Zlicza duplikat wolnego zapytania w bieżącym etapie."""
+    record = current_record()
+    if record is not None:
+        record.hedges += 1
+
+
+def note_cancelled() -> None:
+    """Oznacza bieżący etap jako przerwany po anulowaniu sesji."""
+    record = current_record()
+    if record is not None:
+        record.cancelled = True
+
+
+def note_queue_wait(seconds: float) -> None:
+    """Dolicza czas oczekiwania w kolejce limitów do bieżącego etapu."""
+    record = current_record()
+    if record is not None:
+        record.queued_seconds = round(record.queued_seconds + seconds, 4)
+
+
+def _write_atomic(path: str, text: str) -> None:
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
@@ -0,0 +1,198 @@
+"""Spekulatywne wykonywanie kolejnych etapów w tle.
+
+Gdy użytkownik przegląda wynik jednego kroku (np. tytuł i zarys), następny krok
+(sceny) jest już liczony w tle na podstawie bieżących danych. Każde zadanie ma
+klucz wyliczony z danych wejściowych - jeśli użytkownik je zmieni, klucz się
+zmienia, a stary wynik jest odrzucany. Po zatwierdzeniu kroku interfejs odbiera
+gotowy (lub prawie gotowy) wynik zamiast zaczynać zapytanie od zera.
+
+Zadanie może mieć własny `CancelToken` (powiązany z tokenem sesji) - odrzucenie
+zadania anuluje go, więc jego zapytania w kolejce i ponowienia nie są wysyłane.
+Zapytania, które nowe zadanie i tak by powtórzyło (np. ilustracja niezmienionej
+sceny), przejmuje przez `SharedCalls` zamiast wysyłać je drugi raz.
+"""
+import hashlib
+import json
+import threading
+from concurrent.futures import Executor, Future
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional
+
+from pydantic import BaseModel
+
+from request_policy import CancelToken, RequestCancelled
+
+
+def job_key(*parts) -> str:
+    """Skrót danych wejściowych zadania (modele Pydantic, dataclassy i wartości JSON)."""
+    def default(value):
+        if isinstance(value, BaseModel):
+            return value.model_dump()
+        if hasattr(value, "__dataclass_fields__"):
+            return vars(value)
+        raise TypeError(f"Nieobsługiwany typ w kluczu zadania: {type(value).__name__}")
+
+    payload = json.dumps(parts, default=default, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+@dataclass
+class Job:
+    """Zadanie w tle: klucz danych wejściowych, future z wynikiem i lista postępu."""
+    key: str
+    future: Optional[Future] = None
+    progress: list = field(default_factory=list) # Np. kolejne fragmenty strumienia
+    cancelled: threading.Event = field(default_factory=threading.Event)
+    token: Optional[CancelToken] = None # Token zapytań zadania; anulowany razem z zadaniem
+
+    def wait(self, on_progress: Optional[Callable[[list], None]] = None, poll_seconds: float = 0.1):
+        """Czeka na wynik, co `poll_seconds` wywołując `on_progress(progress)`; zgłasza wyjątek zadania."""
+        while True:
+            try:
+                return self.future.result(timeout=poll_seconds)
+            except FutureTimeoutError:
+                if on_progress:
+                    on_progress(self.progress)
+
+
+class Prefetcher:
+    """Zadania w tle jednej sesji, po jednym na nazwę etapu ("scenes", "story"...).
+
+    Pula wątków jest wspólna dla procesu; obiekt tej klasy trzymamy w stanie sesji.
+    """
+
+    def __init__(self, executor: Executor):
+        self.executor = executor
+        self._jobs: Dict[str, Job] = {}
+        self._dismissed: Dict[str, str] = {} # Klucze zadań przerwanych przez użytkownika
+        self._lock = threading.Lock()
+
+    def start(self, name: str, key: str, fn, *args, stream: bool = False, progress: Optional[list] = None,
+              speculative: bool = False, token: Optional[CancelToken] = None) -> Optional[Job]:
+        """Uruchamia `fn(*args)` jako zadanie `name`, chyba że zadanie z tym samym kluczem już istnieje.
+
+        Zadanie o innym kluczu jest odrzucane. Dla `stream=True` funkcja zwraca iterator
+        fragmentów tekstu, które trafiają do `job.progress`, a wynikiem jest ich złączenie.
+        Zadanie spekulatywne nie jest wznawiane, jeśli użytkownik przerwał je dla tych samych danych.
+        `token` (używany przez `fn`) jest anulowany, gdy zadanie zostanie zastąpione lub odrzucone.
+        """
+        with self._lock:
+            job = self._jobs.get(name)
+            if job is not None and job.key == key:
+                return job
+            if speculative and self._dismissed.get(name) == key:
+                return None
+            self._dismissed.pop(name, None)
+            if job is not None:
+                self._cancel(job)
+            job = Job(key=key, progress=progress if progress is not None else [], token=token)
+            if stream:
+                job.future = self.executor.submit(self._consume, job, fn, args)
+            else:
+                job.future = self.executor.submit(fn, *args)
+            self._jobs[name] = job
+            return job
+
+    def get(self, name: str, key: str) -> Optional[Job]:
+        """Zadanie `name`, jeśli zostało uruchomione dla tych samych danych wejściowych."""
+        with self._lock:
+            job = self._jobs.get(name)
+        return job if job is not None and job.key == key else None
+
+    def pop(self, name: str) -> None:
+        """Zapomina zadanie po odebraniu wyniku (bez przerywania)."""
+        with self._lock:
+            self._jobs.pop(name, None)
+
+    def discard(self, name: str) -> None:
+        """Przerywa zadanie (np. na prośbę użytkownika) i nie wznawia go spekulatywnie."""
+        with self._lock:
+            job = self._jobs.pop(name, None)
+            if job is not None:
+                self._dismissed[name] = job.key
+                self._cancel(job)
+
+    def clear(self) -> None:
+        """Odrzuca wszystkie zadania sesji (nowa historia)."""
+        with self._lock:
+            for job in self._jobs.values():
+                self._cancel(job)
+            self._jobs.clear()
+            self._dismissed.clear()
+
+    @staticmethod
+    def _cancel(job: Job) -> None:
+        # Zadanie w kolejce nie wystartuje; jego kolejne zapytania, ponowienia i duplikaty nie są
+        # wysyłane, trwające zapytanie kończy się (wynik przejmuje `SharedCalls` albo jest ignorowany),
+        # a strumień zostaje zamknięty przy następnym fragmencie
+        job.cancelled.set()
+        if job.token is not None:
+            job.token.cancel("zadanie w tle odrzucone")
+        job.future.cancel()
+
+    @staticmethod
+    def _consume(job: Job, fn, args) -> str:
+        iterator = fn(*args)
+        try:
+            for part in iterator:
+                if job.cancelled.is_set():
+                    break
+                job.progress.append(part)
+        finally:
+            close = getattr(iterator, "close", None)
+            if close:
+                close()
+        return "".join(job.progress)
+
+
+@dataclass
+class _SharedCall:
+    future: Future = field(default_factory=Future)
+    waiters: List[CancelToken] = field(default_factory=list)
+
+    def wanted(self) -> bool:
+        """Czy na wynik czeka jeszcze choć jedno nieanulowane zadanie."""
+        return any(not token.cancelled for token in self.waiters)
+
+
+class SharedCalls:
+    """Wywołania w locie współdzielone przez kolejne zadania jednej sesji.
+
+    Zadanie, które zastąpiło poprzednie, dołącza do trwającego wywołania z tym samym
+    kluczem zamiast wysyłać nowe. Wywołanie ma własny token: jego ponowienia i duplikaty
+    są wstrzymywane dopiero wtedy, gdy anulowano wszystkie czekające na nie zadania.
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, _SharedCall] = {}
+        self._lock = threading.Lock()
+
+    def run(self, key: str, token: CancelToken, fn: Callable[[CancelToken], object], poll_seconds: float = 0.1):
+        """Zwraca wynik `fn(token_wywołania)` dla `key`, dołączając do trwającego wywołania, jeśli jest."""
+        while True:
+            token.raise_if_cancelled()
+            with self._lock:
+                call = self._calls.get(key)
+                owner = call is None
+                if owner:
+                    call = self._calls[key] = _SharedCall()
+                call.waiters.append(token)
+            if owner:
+                try:
+                    call.future.set_result(fn(CancelToken(alive=call.wanted)))
+                except BaseException as e:
+                    call.future.set_exception(e)
+                finally:
+                    with self._lock:
+                        self._calls.pop(key, None)
+            try:
+                while True:
+                    try:
+                        return call.future.result(timeout=poll_seconds)
+                    except FutureTimeoutError:
+                        token.raise_if_cancelled()
+            except RequestCancelled:
+                if token.cancelled:
+                    raise
+                # Wywołanie przerwano tuż przed dołączeniem tego zadania - wysyłamy własne
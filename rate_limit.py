@@ -0,0 +1,173 @@
+"""Wspólny dla całego procesu limit zapytań i tokenów na minutę dla każdego modelu.
+
+Wszystkie sesje korzystają z tych samych klientów HTTP, a `RateLimiter` jest
+podpięty pod ich hooki: przed wysłaniem zapytania czeka, aż w "wiaderkach"
+(token bucket) modelu będzie miejsce na jedno zapytanie i szacowaną liczbę
+tokenów. Oczekujący są obsługiwani po kolei, ale pierwszeństwo ma właściciel
+(sesja), który w bieżącej kolejce dostał dotąd najmniej przydziałów - jedna
+sesja generująca wiele ilustracji nie zablokuje pozostałych. Odpowiedź 429
+wstrzymuje wszystkie zapytania do modelu na czas z nagłówka Retry-After.
+"""
+import email.utils
+import itertools
+import json
+import threading
+import time
+from typing import Callable, Dict, Optional, Tuple
+
+import httpx
+
+# Orientacyjne limity (zapytania/min, tokeny/min) dla konta z pierwszego poziomu; 0 = bez limitu.
+# Nadpisywane w aplikacji przez zmienną RATE_LIMITS.
+DEFAULT_LIMITS: Dict[str, Tuple[int, int]] = {
+    "gpt-4o-mini": (500, 200_000),
+    "gpt-4o": (500, 30_000),
+    "dall-e-3": (50, 0),
+    "tts-1": (50, 0),
+    "tts-1-hd": (50, 0),
+}
+
+DEFAULT_COMPLETION_TOKENS = 2000 # Szacunek długości odpowiedzi, gdy zapytanie nie podaje max_tokens
+DEFAULT_RETRY_AFTER = 1.0
+
+
+class TokenBucket:
+    """Wiaderko uzupełniane równomiernie do `per_minute` jednostek na minutę (0 = bez limitu)."""
+
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Ile sekund trzeba poczekać na `amount` jednostek (większe żądania są przycinane do pojemności)."""
+        if not self.capacity:
+            return 0.0
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount: float) -> None:
+        if self.capacity:
+            self.tokens -= min(amount, self.capacity)
+
+
+class RateLimiter:
+    """Limity zapytań i tokenów na minutę dla modeli, z kolejką sprawiedliwą między sesjami.
+
+    `owner()` zwraca identyfikator sesji bieżącego wątku, a `on_wait(seconds)`
+    dostaje czas spędzony w kolejce (np. do metryk).
+    """
+
+    def __init__(self, limits: Optional[Dict[str, Tuple[int, int]]] = None,
+                 owner: Optional[Callable[[], Optional[str]]] = None,
+                 on_wait: Optional[Callable[[float], None]] = None):
+        limits = DEFAULT_LIMITS if limits is None else limits
+        self._buckets = {model: (TokenBucket(rpm), TokenBucket(tpm)) for model, (rpm, tpm) in limits.items()}
+        self.owner = owner or (lambda: None)
+        self.on_wait = on_wait
+        self._cond = threading.Condition()
+        self._waiting: Dict[str, list] = {}
+        self._served: Dict[str, Dict[Optional[str], int]] = {}
+        self._blocked_until: Dict[str, float] = {}
+        self._sequence = itertools.count()
+
+    def _next_ticket(self, model: str):
+        served = self._served.get(model, {})
+        return min(self._waiting[model], key=lambda ticket: (served.get(ticket[1], 0), ticket[0]))
+
+    def acquire(self, model: str, tokens: int = 0, owner: Optional[str] = None) -> float:
+        """Czeka na przydział jednego zapytania i `tokens` tokenów; zwraca czas oczekiwania w sekundach."""
+        buckets = self._buckets.get(model)
+        if buckets is None:
+            return 0.0
+        requests_bucket, tokens_bucket = buckets
+        ticket = (next(self._sequence), owner)
+        started = time.monotonic()
+        with self._cond:
+            waiting = self._waiting.setdefault(model, [])
+            waiting.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    delay = max(0.0, self._blocked_until.get(model, 0) - now)
+                    if not delay and self._next_ticket(model) is ticket:
+                        delay = max(requests_bucket.wait_time(1, now), tokens_bucket.wait_time(tokens, now))
+                        if not delay:
+                            requests_bucket.take(1)
+                            tokens_bucket.take(tokens)
+                            served = self._served.setdefault(model, {})
+                            served[owner] = served.get(owner, 0) + 1
+                            return time.monotonic() - started
+                    # Bez opóźnienia czekamy na swoją kolej (powiadomienie od obsłużonego zapytania)
+                    self._cond.wait(timeout=delay or 1.0)
+            finally:
+                waiting.remove(ticket)
+                if not waiting:
+                    self._served.pop(model, None) # Kolejka pusta - liczniki sprawiedliwości od zera
+                self._cond.notify_all()
+
+    def penalize(self, model: str, seconds: float) -> None:
+        """Wstrzymuje zapytania do modelu na `seconds` sekund (odpowiedź 429)."""
+        with self._cond:
+            self._blocked_until[model] = max(self._blocked_until.get(model, 0), time.monotonic() + seconds)
+            self._cond.notify_all()
+
+    def before_request(self, request: httpx.Request) -> None:
+        """Hook httpx: czeka na limit modelu, którego dotyczy zapytanie."""
+        model, tokens = request_budget(request)
+        if model:
+            waited = self.acquire(model, tokens, owner=self.owner())
+            if waited > 0.001 and self.on_wait:
+                self.on_wait(waited)
+
+    def after_response(self, response: httpx.Response) -> None:
+        """Hook httpx: po odpowiedzi 429 wstrzymuje model dla wszystkich sesji."""
+        if response.status_code == 429:
+            model, _ = request_budget(response.request)
+            if model:
+                self.penalize(model, retry_after(response.headers))
+
+    def event_hooks(self) -> dict:
+        return {"request": [self.before_request], "response": [self.after_response]}
+
+
+def request_budget(request: httpx.Request) -> Tuple[Optional[str], int]:
+    """Model i szacowana liczba tokenów zapytania (prompt ~ 4 znaki na token plus odpowiedź)."""
+    try:
+        body = json.loads(request.content or b"{}")
+    except (ValueError, httpx.RequestNotRead):
+        return None, 0
+    if not isinstance(body, dict):
+        return None, 0
+    model = body.get("model")
+    if "messages" not in body:
+        return model, 0
+    prompt_chars = sum(len(str(message.get("content") or "")) for message in body["messages"])
+    prompt_chars += len(json.dumps(body.get("tools") or []))
+    return model, prompt_chars // 4 + (body.get("max_tokens") or DEFAULT_COMPLETION_TOKENS)
+
+
+def retry_after(headers: httpx.Headers) -> float:
+    """Czas oczekiwania z nagłówków Retry-After / Retry-After-Ms (sekundy lub data HTTP)."""
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            pass
+    return DEFAULT_RETRY_AFTER
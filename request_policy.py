@@ -0,0 +1,273 @@
+"""Terminy, ponowienia, zapytania zabezpieczające (hedging) i anulowanie wywołań API.
+
+Każde wywołanie API przechodzi przez `RequestRunner.run(etap, fn)`. Etap ma
+politykę (`StagePolicy`): łączny termin na wszystkie próby, limit czasu jednej
+próby, liczbę prób z wykładniczym odstępem (z losowym rozrzutem) oraz opcjonalny
+czas, po którym wolne zapytanie dostaje równoległy duplikat - wygrywa pierwsza
+odpowiedź. Automatyczne ponowienia klienta OpenAI są wyłączone, żeby termin
+obejmował wszystkie próby.
+
+`CancelToken` sesji przerywa pracę po resecie historii lub odejściu użytkownika
+(odejście nie jest zapamiętywane - po ponownym połączeniu z tą samą sesją token znów działa):
+hook HTTP nie wysyła już żadnego zapytania (także z wątków tła), oczekiwanie na
+ponowienie zostaje przerwane, a strumienie są zamykane przy kolejnym fragmencie.
+Zadania w tle dostają tokeny potomne (`parent`), anulowane także osobno - razem z zadaniem.
+Anulowania, ponowienia i duplikaty trafiają do metryk etapu.
+"""
+import functools
+import queue
+import random
+import threading
+import time
+from dataclasses import dataclass, replace
+from typing import Callable, Dict, Optional, Tuple
+
+import httpx
+
+from metrics import current_record, note_cancelled, note_hedge, note_retry, use_record
+
+
+class RequestCancelled(Exception):
+    """Zapytanie przerwane, bo jego sesja została zresetowana lub zamknięta."""
+
+
+class DeadlineExceeded(TimeoutError):
+    """Etap nie zakończył się w terminie (łącznie ze wszystkimi próbami)."""
+
+
+@dataclass(frozen=True)
+class StagePolicy:
+    """Termin, ponowienia i hedging dla jednego etapu (czasy w sekundach)."""
+    deadline: float = 120.0 # Łączny czas na wszystkie próby
+    attempt_timeout: float = 60.0 # Limit jednej próby
+    max_attempts: int = 3
+    backoff: float = 1.0 # Odstęp przed drugą próbą; każdy kolejny dwukrotnie dłuższy
+    backoff_max: float = 20.0
+    hedge_after: Optional[float] = None # Po tylu sekundach bez odpowiedzi wysyłany jest duplikat
+
+
+DEFAULT_POLICIES: Dict[str, StagePolicy] = {
+    "title_and_summary": StagePolicy(deadline=60, attempt_timeout=30),
+    "scenes": StagePolicy(deadline=90, attempt_timeout=45),
+    "plan": StagePolicy(deadline=120, attempt_timeout=60),
+    "story": StagePolicy(deadline=600, attempt_timeout=300, max_attempts=2),
+    "chapter": StagePolicy(deadline=300, attempt_timeout=150, max_attempts=2),
+    "smoothing": StagePolicy(deadline=60, attempt_timeout=30, max_attempts=2),
+    "illustration": StagePolicy(deadline=240, attempt_timeout=120),
+    "tts": StagePolicy(deadline=180, attempt_timeout=90),
+}
+
+@functools.lru_cache(maxsize=None)
+def retryable_errors() -> Tuple[type, ...]:
+    """Błędy przejściowe, po których warto spróbować ponownie (openai ładowany przy pierwszym użyciu)."""
+    import openai
+
+    return (openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError, openai.InternalServerError)
+
+
+def load_policies(overrides: Optional[dict] = None, hedge_illustrations_after: Optional[float] = None) -> Dict[str, StagePolicy]:
+    """Polityki domyślne nadpisane słownikiem {etap: {pole: wartość}} (np. z pliku .env)."""
+    policies = dict(DEFAULT_POLICIES)
+    for stage, fields in (overrides or {}).items():
+        policies[stage] = replace(policies.get(stage, StagePolicy()), **fields)
+    if hedge_illustrations_after:
+        policies["illustration"] = replace(policies["illustration"], hedge_after=hedge_illustrations_after)
+    return policies
+
+
+class CancelToken:
+    """Flaga anulowania pracy jednej sesji; `alive()` może zgłaszać, że sesja już nie istnieje.
+
+    Token z `parent` (np. token jednego zadania w tle) jest anulowany także razem z rodzicem.
+    """
+
+    def __init__(self, alive: Optional[Callable[[], bool]] = None, parent: Optional["CancelToken"] = None):
+        self._event = threading.Event()
+        self._alive = alive
+        self._parent = parent
+        self.reason: Optional[str] = None
+
+    def cancel(self, reason: str = "anulowano") -> None:
+        self.reason = self.reason or reason
+        self._event.set()
+
+    def cancel_reason(self) -> Optional[str]:
+        """Powód anulowania albo None. Brak sesji (`alive()`) nie jest zapamiętywany - po ponownym
+        połączeniu karty z tą samą sesją kolejne zapytania znowu przechodzą."""
+        if self._event.is_set():
+            return self.reason
+        if self._parent is not None:
+            reason = self._parent.cancel_reason()
+            if reason is not None:
+                return reason
+        if self._alive is not None:
+            try:
+                if not self._alive():
+                    return "sesja zamknięta"
+            except Exception:
+                pass # Brak informacji o sesji nie jest powodem do anulowania
+        return None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_reason() is not None
+
+    def raise_if_cancelled(self) -> None:
+        reason = self.cancel_reason()
+        if reason is not None:
+            raise RequestCancelled(reason)
+
+    def sleep(self, seconds: float, poll_seconds: float = 0.2) -> None:
+        """Czeka `seconds` sekund, przerywając oczekiwanie po anulowaniu (także rodzica lub sesji)."""
+        deadline = time.monotonic() + seconds
+        while True:
+            self.raise_if_cancelled()
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return
+            self._event.wait(min(remaining, poll_seconds))
+
+
+# Token etapu wykonywanego w bieżącym wątku - czytany przez hook HTTP wspólnych klientów
+_current = threading.local()
+
+
+def current_token() -> Optional[CancelToken]:
+    return getattr(_current, "token", None)
+
+
+def check_cancelled(request: httpx.Request) -> None:
+    """Hook httpx: nie wysyła zapytania sesji, która została anulowana."""
+    token = current_token()
+    if token is not None:
+        token.raise_if_cancelled()
+
+
+def note_sent(request: httpx.Request) -> None:
+    """Hook httpx (ostatni na liście): zapytanie przeszło kolejkę limitów i zaraz zostanie wysłane.
+
+    Od tej chwili liczy się czas do wysłania duplikatu (`StagePolicy.hedge_after`).
+    """
+    on_sent = getattr(_current, "on_sent", None)
+    if on_sent is not None:
+        on_sent()
+
+
+class RequestRunner:
+    """Wykonuje wywołania API zgodnie z polityką etapu i tokenem anulowania sesji."""
+
+    def __init__(self, policies: Optional[Dict[str, StagePolicy]] = None, token: Optional[CancelToken] = None):
+        self.policies = policies or DEFAULT_POLICIES
+        self.token = token or CancelToken()
+
+    def with_token(self, token: CancelToken) -> "RequestRunner":
+        """Runner z tymi samymi politykami i innym tokenem (np. tokenem zadania w tle)."""
+        return RequestRunner(self.policies, token=token)
+
+    def policy(self, stage: str) -> StagePolicy:
+        return self.policies.get(stage) or StagePolicy()
+
+    def run(self, stage: str, fn: Callable[[float], object], hedge_slots: Optional[threading.Semaphore] = None):
+        """Wywołuje `fn(timeout)` z ponowieniami w terminie etapu i zwraca wynik.
+
+        `fn` dostaje limit czasu bieżącej próby (do przekazania jako `timeout=` w kliencie
+        OpenAI). Zgłasza RequestCancelled po anulowaniu sesji, DeadlineExceeded po upływie
+        terminu, a błędy nieprzejściowe (np. 400) od razu. Duplikat (hedging) jest wysyłany
+        tylko, gdy uda się zająć miejsce w `hedge_slots` (limit zapytań "w locie" etapu), a czas
+        `hedge_after` liczy się od wysłania zapytania (hook `note_sent`), nie od czekania w kolejce limitów.
+        """
+        policy = self.policy(stage)
+        deadline = time.monotonic() + policy.deadline
+        previous = current_token()
+        _current.token = self.token
+        try:
+            for attempt in range(policy.max_attempts):
+                self.token.raise_if_cancelled()
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise DeadlineExceeded(f"Etap {stage} przekroczył termin {policy.deadline:g} s")
+                try:
+                    return self._attempt(policy, fn, min(policy.attempt_timeout, remaining), hedge_slots)
+                except retryable_errors() as e:
+                    reason = self.token.cancel_reason()
+                    if reason is not None:
+                        raise RequestCancelled(reason) from e
+                    if attempt + 1 == policy.max_attempts:
+                        raise
+                    delay = min(policy.backoff_max, policy.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+                    if time.monotonic() + delay >= deadline:
+                        raise DeadlineExceeded(f"Etap {stage} przekroczył termin {policy.deadline:g} s") from e
+                    note_retry()
+                    self.token.sleep(delay)
+        except RequestCancelled:
+            note_cancelled()
+            raise
+        finally:
+            _current.token = previous
+
+    def _attempt(self, policy: StagePolicy, fn, timeout: float, hedge_slots: Optional[threading.Semaphore]):
+        if not policy.hedge_after or policy.hedge_after >= timeout:
+            return fn(timeout)
+        record = current_record()
+        results = queue.Queue()
+        lock = threading.Lock()
+        state = {"running": 0, "slot": False, "sent": None}
+
+        def sent() -> None:
+            with lock:
+                state["sent"] = state["sent"] or time.monotonic()
+
+        def call(attempt_timeout: float, primary: bool):
+            # Wątek próby dostaje token i rekord metryk wątku wywołującego
+            _current.token = self.token
+            _current.on_sent = sent if primary else None
+            try:
+                with use_record(record):
+                    results.put((True, fn(attempt_timeout)))
+            except BaseException as e:
+                results.put((False, e))
+            finally:
+                _current.token = None
+                _current.on_sent = None
+                with lock:
+                    state["running"] -= 1
+                    release = state["running"] == 0 and state["slot"]
+                if release:
+                    # Dodatkowe miejsce wraca dopiero po obu próbach: wywołujący zwalnia swoje
+                    # po pierwszej odpowiedzi, a druga próba może jeszcze trwać
+                    hedge_slots.release()
+
+        def start(attempt_timeout: float, slot: bool = False, primary: bool = False) -> None:
+            # Własny wątek zamiast wspólnej puli: próba rusza od razu, bez kolejki i limitu procesu,
+            # a wątek wywołujący może zwrócić pierwszą odpowiedź (druga kończy się w tle)
+            with lock:
+                state["running"] += 1
+                state["slot"] = state["slot"] or slot
+            threading.Thread(target=call, args=(attempt_timeout, primary), name="hedge", daemon=True).start()
+
+        start(timeout, primary=True)
+        started = time.monotonic()
+        pending, hedged, error = 1, False, None
+        while pending:
+            try:
+                ok, value = results.get(timeout=0.2)
+            except queue.Empty:
+                self.token.raise_if_cancelled()
+                now = time.monotonic()
+                elapsed, sent_at = now - started, state["sent"]
+                # Próba czekająca jeszcze w kolejce limitów (RateLimiter) nie jest wolna - duplikat
+                # stanąłby w tej samej kolejce, więc czas do niego liczy się od wysłania zapytania
+                if (not hedged and error is None and sent_at is not None and policy.hedge_after <= now - sent_at
+                        and elapsed < timeout):
+                    # Duplikat zajmuje własne miejsce w limicie etapu; bez wolnego miejsca czekamy dalej
+                    if hedge_slots is None or hedge_slots.acquire(blocking=False):
+                        hedged = True
+                        note_hedge()
+                        start(timeout - elapsed, slot=hedge_slots is not None)
+                        pending += 1
+                continue
+            pending -= 1
+            if ok:
+                return value
+            error = value
+        raise error
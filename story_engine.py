@@ -0,0 +1,658 @@
+"""Silnik generowania opowiadań niezależny od interfejsu Streamlit.
+
+Zawiera modele danych, prompty oraz wywołania API dla kolejnych etapów:
+temat -> tytuł i zarys -> sceny -> opowiadanie -> ilustracje. Funkcje silnika
+nie wyświetlają błędów same - zgłaszają wyjątki, a interfejs (app.py) lub
+narzędzie wsadowe (batch.py) decydują, co z nimi zrobić.
+
+Biblioteki `openai` i `instructor` są ładowane dopiero przy tworzeniu klientów,
+więc import modułu (np. przy pierwszym wyświetleniu aplikacji) jest szybki.
+"""
+import copy
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Union
+
+import httpx
+from pydantic import BaseModel, Field
+
+from blob_store import BlobStore
+from llm_cache import LLMCache, make_cache_key
+from metrics import MetricsRecorder, current_record, note_queue_wait
+from rate_limit import RateLimiter
+from request_policy import CancelToken, RequestRunner, check_cancelled, note_sent
+
+if TYPE_CHECKING:
+    import instructor
+    from openai import OpenAI
+
+    from prefetch import SharedCalls
+
+# --- Modele Pydantic do strukturyzacji danych ---
+
+class TitleAndSummary(BaseModel):
+    """Model do przechowywania tytułu i zarysu fabuły."""
+    title: str = Field(..., description="Kreatywny i chwytliwy tytuł opowiadania.")
+    summary: str = Field(..., description="Zwięzły, jednoakapitowy opis fabuły opowiadania.")
+
+class Scene(BaseModel):
+    """Model pojedynczej sceny w opowiadaniu."""
+    scene_title: str = Field(..., description="Tytuł sceny, np. 'Tajemnicze odkrycie'.")
+    scene_description: str = Field(..., description="Szczegółowy opis tego, co dzieje się w scenie, kto bierze w niej udział i gdzie się rozgrywa.")
+
+class StoryScenes(BaseModel):
+    """Lista kluczowych scen w opowiadaniu."""
+    scenes: List[Scene] = Field(..., description="Lista 5 do 7 kluczowych scen, które tworzą spójną historię.")
+
+class StoryPlan(BaseModel):
+    """Tytuł, zarys fabuły i sceny zwracane razem w trybie szybkiego planu.
+
+    Pola są zadeklarowane wprost, bo ich kolejność w schemacie to kolejność pisania odpowiedzi:
+    najpierw tytuł i zarys, potem oparte na nich sceny (dziedziczenie stawiało sceny na początku).
+    """
+    title: str = Field(..., description="Kreatywny i chwytliwy tytuł opowiadania.")
+    summary: str = Field(..., description="Zwięzły, jednoakapitowy opis fabuły opowiadania.")
+    scenes: List[Scene] = Field(..., description="Lista 5 do 7 kluczowych scen, które tworzą spójną historię.")
+
+# --- Style i profile pisarzy ---
+
+STYLE_OPTIONS = ['Szekspira', 'Fantasy', 'Science-fiction', 'Norwida', 'Zbigniewa Herberta']
+IMAGE_STYLE_OPTIONS = ['fantasy', 'fcience-fiction', 'steampunk', 'cyberpunk', 'fotorealizm', 'akwarela', 'komiks', 'manga', 'anime', 'Van Gogha', 'Salvadora Dalego']
+ATMOSPHERE_OPTIONS = ["mroczny", "radosny", "tajemniczy", "epicki", "spokojny", "dynamiczny", "dramatyczny", "nostalgiczny"]
+
+WRITER_PROFILES = {
+    "Innowacyjność i wszechstronność": "Jesteś światowej klasy, wysoce kreatywnym pisarzem, zdolnym do generowania innowacyjnych treści w dowolnym stylu literackim. Twoje dzieła muszą być oryginalne, angażujące i inspirujące, przekraczając granice konwencji. Dąż do zaskoczenia i pobudzenia wyobraźni. Twórz w stylu {style}",
+    "Głębia i unikalność": "Jesteś geniuszem literackim i niezrównanym pisarzem. Twoją misją jest tworzenie hipnotyzujących i intrygujących fabuł, które wyróżniają się głębią, oryginalnością i emocjonalnym rezonansem. Każde dzieło powinno zawierać ziarno nowej, nieodkrytej historii, gotowej do rozwinięcia. Twórz w stylu {style}",
+    "Wizjonerstwo i dynamiczność": "Jesteś wizjonerskim i globalnie cenionym mistrzem pióra, który specjalizuje się w tworzeniu dynamicznych i porywających fabuł. Twoim zadaniem jest przekształcanie idei w iskrzące narracje, które natychmiastowo chwytają uwagę i pozostawiają niezatarte wrażenie. Skup się na innowacji i sile przekazu. Twórz w stylu {style}.",
+    "Uniwersalność": "Jesteś światowej sławy, niezmiernie kreatywnym pisarzem. Generujesz innowacyjne i porywające fabuły w stylu {style}, które inspirują i zaskakują swoją oryginalnością.",
+}
+
+def writer_description(writer: str, style: str) -> str:
+    """Zwraca prompt systemowy pisarza dla wybranego profilu i stylu (nieznany profil = "Uniwersalność")."""
+    return WRITER_PROFILES.get(writer, WRITER_PROFILES["Uniwersalność"]).format(style=style)
+
+@dataclass(frozen=True)
+class StoryStyle:
+    """Ustawienia stylu wpływające na prompty wszystkich etapów."""
+    style: str = "Fantasy"
+    writer_desc: str = ""
+    image_style: str = "fantasy"
+    atmosphere: str = "tajemniczy"
+
+    @classmethod
+    def from_options(cls, style: str = "Fantasy", writer: str = "Uniwersalność",
+                     image_style: str = "fantasy", atmosphere: str = "tajemniczy") -> "StoryStyle":
+        return cls(style=style, writer_desc=writer_description(writer, style),
+                   image_style=image_style, atmosphere=atmosphere)
+
+# --- Klienci API ---
+
+@dataclass
+class ApiClients:
+    """Klient OpenAI i nakładka instructor korzystające z jednej puli połączeń HTTP."""
+    client: "OpenAI"
+    instructor_client: "instructor.Instructor"
+
+def current_session_id() -> Optional[str]:
+    """Sesja, której etap wykonuje bieżący wątek (właściciel zapytania dla kolejki limitów)."""
+    record = current_record()
+    return record.session_id if record is not None else None
+
+def create_rate_limiter(limits=None) -> RateLimiter:
+    """Limiter zapytań/tokenów na minutę, raportujący czas oczekiwania do metryk etapu."""
+    return RateLimiter(limits, owner=current_session_id, on_wait=note_queue_wait)
+
+def create_api_clients(api_key: Optional[str] = None, base_url: Optional[str] = None,
+                       rate_limiter: Optional[RateLimiter] = None, max_connections: int = 100) -> ApiClients:
+    """Tworzy klientów do współdzielenia przez wiele sesji i wątków (połączenia keep-alive w puli).
+
+    Jeśli podano `rate_limiter`, każde zapytanie HTTP (także ponowienie) czeka na jego przydział.
+    Zapytania anulowanej sesji nie są wysyłane (sprawdzane też po czasie spędzonym w kolejce
+    limitów). Klient sam nie ponawia zapytań - robi to `RequestRunner` w terminie etapu; czas
+    do duplikatu wolnego zapytania liczy się od chwili, w której zapytanie przeszło kolejkę.
+    """
+    import instructor
+    from openai import DefaultHttpxClient, OpenAI
+
+    event_hooks = {"request": [check_cancelled], "response": []}
+    if rate_limiter is not None:
+        for name, hooks in rate_limiter.event_hooks().items():
+            event_hooks[name].extend(hooks)
+        event_hooks["request"].append(check_cancelled)
+    event_hooks["request"].append(note_sent) # Ostatni: zapytanie przeszło już kolejkę limitów
+    http_client = DefaultHttpxClient(
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections,
+                            keepalive_expiry=60),
+        event_hooks=event_hooks,
+    )
+    client = OpenAI(api_key=api_key, base_url=base_url, http_client=http_client, max_retries=0)
+    # Klient z biblioteką instructor umożliwia strukturyzowane odpowiedzi w formacie Pydantic
+    return ApiClients(client=client, instructor_client=instructor.from_openai(client))
+
+# --- Silnik ---
+
+class StoryEngine:
+    """Wywołania API dla kolejnych etapów tworzenia opowiadania."""
+
+    def __init__(self, api_key: Optional[str] = None, cache: Optional[LLMCache] = None,
+                 blob_store: Optional[BlobStore] = None, illustration_workers: int = 4,
+                 illustration_slots: Optional[threading.Semaphore] = None, base_url: Optional[str] = None,
+                 metrics: Optional[MetricsRecorder] = None,
+                 clients: Union[ApiClients, Callable[[], ApiClients], None] = None,
+                 chapter_workers: int = 8, runner: Optional[RequestRunner] = None):
+        self.metrics = metrics or MetricsRecorder()
+        # Silnik jest lekki; klienci (i ich połączenia) mogą pochodzić ze wspólnej puli procesu.
+        # `clients` może być funkcją - wtedy klienci powstają dopiero przy pierwszym zapytaniu.
+        self._clients = clients or (lambda: create_api_clients(api_key, base_url))
+        self.cache = cache
+        self.blob_store = blob_store or BlobStore()
+        self.illustration_workers = illustration_workers
+        self.illustration_slots = illustration_slots or threading.BoundedSemaphore(illustration_workers)
+        self.chapter_workers = chapter_workers
+        # Terminy, ponowienia i token anulowania sesji dla wszystkich wywołań API silnika
+        self.runner = runner or RequestRunner()
+
+    def with_token(self, token: CancelToken) -> "StoryEngine":
+        """Kopia silnika, której zapytania przerywa `token` (np. token jednego zadania w tle)."""
+        engine = copy.copy(self)
+        engine.runner = self.runner.with_token(token)
+        return engine
+
+    @property
+    def clients(self) -> ApiClients:
+        if callable(self._clients):
+            self._clients = self._clients()
+        return self._clients
+
+    @property
+    def client(self) -> "OpenAI":
+        return self.clients.client
+
+    @property
+    def instructor_client(self) -> "instructor.Instructor":
+        return self.clients.instructor_client
+
+    def _call(self, stage: str, create, hedge_slots: Optional[threading.Semaphore] = None, **kwargs):
+        """Wywołuje `create(**kwargs)` zgodnie z polityką etapu (termin, ponowienia, anulowanie)."""
+        return self.runner.run(stage, lambda timeout: create(timeout=timeout, **kwargs), hedge_slots=hedge_slots)
+
+    def _cached(self, cache_key: str, refresh: bool):
+        if self.cache is None or refresh:
+            return None
+        return self.cache.get(cache_key)
+
+    def _store(self, cache_key: str, value) -> None:
+        if self.cache is not None:
+            self.cache.set(cache_key, value)
+
+    def build_title_and_summary_request(self, topic: str, story_style: StoryStyle):
+        """Zwraca model, prompty i klucz cache dla zapytania o tytuł i zarys."""
+        model = "gpt-4o-mini"
+        system_prompt = f"{story_style.writer_desc}."
+        user_message = f"Wygeneruj tytuł i zarys fabuły dla opowiadania o tematyce: {topic}"
+        return model, system_prompt, user_message, make_cache_key("title_and_summary", model, system_prompt, user_message)
+
+    def generate_title_and_summary(self, topic: str, story_style: StoryStyle, refresh: bool = False):
+        """Generuje tytuł i podsumowanie na podstawie tematu."""
+        model, system_prompt, user_message, cache_key = self.build_title_and_summary_request(topic, story_style)
+        with self.metrics.stage("title_and_summary", model) as record:
+            cached = self._cached(cache_key, refresh)
+            if cached:
+                record.cached = True
+                response = TitleAndSummary.model_validate(cached)
+                return response.title, response.summary
+            response, completion = self._call(
+                "title_and_summary", self.instructor_client.chat.completions.create_with_completion,
+                model=model,
+                response_model=TitleAndSummary,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_message}
+                ]
+            )
+            record.add_usage(completion.usage)
+        self._store(cache_key, response.model_dump())
+        return response.title, response.summary
+
+    def build_scenes_request(self, title: str, summary: str, story_style: StoryStyle):
+        """Zwraca model, prompty i klucz cache dla zapytania o sceny."""
+        model = "gpt-4o-mini"
+        system_prompt = f"Jesteś scenarzystą. Twoim zadaniem jest podzielenie historii na kluczowe sceny. Zachowaj styl {story_style.style}"
+        user_message = f"Na podstawie poniższego tytułu i opisu, stwórz listę 5-7 kluczowych scen, które budują narrację.\n\nTytuł: {title}\n\nOpis: {summary}"
+        return model, system_prompt, user_message, make_cache_key("scenes", model, system_prompt, user_message)
+
+    def generate_scenes(self, title: str, summary: str, story_style: StoryStyle, refresh: bool = False) -> List[Scene]:
+        """Generuje listę scen na podstawie tytułu i podsumowania."""
+        model, system_prompt, user_message, cache_key = self.build_scenes_request(title, summary, story_style)
+        with self.metrics.stage("scenes", model) as record:
+            cached = self._cached(cache_key, refresh)
+            if cached:
+                record.cached = True
+                return StoryScenes.model_validate(cached).scenes
+            response, completion = self._call(
+                "scenes", self.instructor_client.chat.completions.create_with_completion,
+                model=model,
+                response_model=StoryScenes,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_message}
+                ]
+            )
+            record.add_usage(completion.usage)
+        self._store(cache_key, response.model_dump())
+        return response.scenes
+
+    def generate_plan(self, topic: str, story_style: StoryStyle, refresh: bool = False):
+        """Generuje tytuł, zarys i sceny jednym zapytaniem (tryb szybkiego planu).
+
+        Zwraca (tytuł, zarys, sceny). Wynik trafia też do cache pod kluczami zwykłych
+        etapów, więc np. "Zatwierdź i generuj sceny" bez edycji tytułu nie wysyła zapytania.
+        """
+        model = "gpt-4o-mini"
+        system_prompt = (f"{story_style.writer_desc}. Jednocześnie jesteś scenarzystą, który dzieli historię "
+                         f"na kluczowe sceny w stylu {story_style.style}.")
+        user_message = (f"Wygeneruj tytuł i zarys fabuły dla opowiadania o tematyce: {topic}\n\n"
+                        "Następnie na podstawie tego tytułu i zarysu stwórz listę 5-7 kluczowych scen, "
+                        "które budują narrację.")
+        cache_key = make_cache_key("plan", model, system_prompt, user_message)
+        with self.metrics.stage("plan", model) as record:
+            cached = self._cached(cache_key, refresh)
+            if cached:
+                record.cached = True
+                plan = StoryPlan.model_validate(cached)
+                return plan.title, plan.summary, plan.scenes
+            plan, completion = self._call(
+                "plan", self.instructor_client.chat.completions.create_with_completion,
+                model=model,
+                response_model=StoryPlan,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_message}
+                ]
+            )
+            record.add_usage(completion.usage)
+        self._store(cache_key, plan.model_dump())
+        self._store(self.build_title_and_summary_request(topic, story_style)[3],
+                    {"title": plan.title, "summary": plan.summary})
+        self._store(self.build_scenes_request(plan.title, plan.summary, story_style)[3],
+                    {"scenes": [scene.model_dump() for scene in plan.scenes]})
+        return plan.title, plan.summary, plan.scenes
+
+    def build_story_request(self, title: str, scenes: List[Scene], story_style: StoryStyle):
+        """Zwraca model, prompty i klucz cache dla zapytania o pełne opowiadanie."""
+        scenes_description = "\n".join([f"**Scena: {s.scene_title}**\n{s.scene_description}" for s in scenes])
+        model = "gpt-4o"
+        system_prompt = f"{story_style.writer_desc}."
+        user_message = f"Napisz pełne opowiadanie bez tytułu na podstawie poniższych wytycznych.\n\nTytuł: {title}\n\nSceny:\n{scenes_description}"
+        return model, system_prompt, user_message, make_cache_key("story", model, system_prompt, user_message)
+
+    def generate_story(self, title: str, scenes: List[Scene], story_style: StoryStyle, refresh: bool = False) -> str:
+        """Generuje pełne opowiadanie na podstawie scen."""
+        model, system_prompt, user_message, cache_key = self.build_story_request(title, scenes, story_style)
+        with self.metrics.stage("story", model) as record:
+            cached = self._cached(cache_key, refresh)
+            if cached:
+                record.cached = True
+                return cached
+            response = self._call(
+                "story", self.client.chat.completions.create,
+                model=model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_message}
+                ]
+            )
+            record.add_usage(response.usage)
+        story = response.choices[0].message.content
+        if story:
+            self._store(cache_key, story)
+        return story or ""
+
+    def stream_story(self, title: str, scenes: List[Scene], story_style: StoryStyle, refresh: bool = False):
+        """Generuje opowiadanie strumieniowo, zwracając kolejne fragmenty tekstu.
+
+        Pełny tekst trafia do cache dopiero po odebraniu całej odpowiedzi; przerwany
+        strumień (np. anulowanie przez użytkownika) zamyka połączenie i niczego nie zapisuje.
+        """
+        model, system_prompt, user_message, cache_key = self.build_story_request(title, scenes, story_style)
+        cached = self._cached(cache_key, refresh)
+        if cached:
+            with self.metrics.stage("story", model) as record:
+                record.cached = True
+            yield cached
+            return
+        parts = []
+        with self.metrics.stage("story", model) as record:
+            stream = self._call(
+                "story", self.client.chat.completions.create,
+                model=model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_message}
+                ],
+                stream=True,
+                stream_options={"include_usage": True} # Ostatni fragment zawiera zużycie tokenów
+            )
+            try:
+                for chunk in stream:
+                    self.runner.token.raise_if_cancelled() # Zamknięcie strumienia przerywa generowanie
+                    record.add_usage(getattr(chunk, "usage", None))
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        parts.append(chunk.choices[0].delta.content)
+                        yield chunk.choices[0].delta.content
+            finally:
+                stream.close()
+        story = "".join(parts)
+        if story:
+            self._store(cache_key, story)
+
+    def build_chapter_request(self, title: str, summary: str, scenes: List[Scene], index: int,
+                              story_style: StoryStyle):
+        """Zwraca model, prompty i klucz cache dla rozdziału opartego na scenie `index`.
+
+        Kontekst ciągłości jest zwarty: zarys fabuły i opisy sąsiednich scen zamiast
+        treści innych rozdziałów, więc wszystkie rozdziały mogą powstawać jednocześnie.
+        """
+        scene = scenes[index]
+        model = "gpt-4o"
+        system_prompt = f"{story_style.writer_desc}."
+        context = [f"Tytuł opowiadania: {title}", f"Zarys fabuły: {summary}"]
+        if index > 0:
+            previous = scenes[index - 1]
+            context.append(f"Poprzednia scena (już opisana): **{previous.scene_title}**\n{previous.scene_description}")
+        if index + 1 < len(scenes):
+            following = scenes[index + 1]
+            context.append(f"Następna scena (opisana w kolejnym rozdziale): **{following.scene_title}**\n{following.scene_description}")
+        if index == 0:
+            position = "To pierwszy rozdział - wprowadź bohaterów i świat."
+        elif index + 1 == len(scenes):
+            position = "To ostatni rozdział - domknij historię."
+        else:
+            position = "Nie zamykaj historii i nie powtarzaj wydarzeń z poprzedniej sceny."
+        user_message = (f"Napisz rozdział {index + 1} z {len(scenes)} opowiadania, bez tytułu rozdziału, "
+                        f"opisujący wyłącznie poniższą scenę w stylu {story_style.style}. {position}\n\n"
+                        + "\n\n".join(context)
+                        + f"\n\nScena tego rozdziału: **{scene.scene_title}**\n{scene.scene_description}")
+        return model, system_prompt, user_message, make_cache_key("chapter", model, system_prompt, user_message)
+
+    def generate_chapter(self, title: str, summary: str, scenes: List[Scene], index: int, story_style: StoryStyle,
+                         refresh: bool = False) -> str:
+        """Generuje jeden rozdział (jedna scena) opowiadania w trybie długiej formy."""
+        model, system_prompt, user_message, cache_key = self.build_chapter_request(title, summary, scenes, index,
+                                                                                   story_style)
+        with self.metrics.stage("chapter", model) as record:
+            cached = self._cached(cache_key, refresh)
+            if cached:
+                record.cached = True
+                return cached
+            response = self._call(
+                "chapter", self.client.chat.completions.create,
+                model=model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_message}
+                ]
+            )
+            record.add_usage(response.usage)
+        chapter = (response.choices[0].message.content or "").strip()
+        if not chapter:
+            raise ValueError(f"Model nie zwrócił treści rozdziału {index + 1}.")
+        self._store(cache_key, chapter)
+        return chapter
+
+    def smooth_transition(self, previous_chapter: str, chapter: str, story_style: StoryStyle,
+                          refresh: bool = False) -> str:
+        """Przepisuje pierwszy akapit rozdziału tak, by płynnie wynikał z końca poprzedniego.
+
+        Reszta rozdziału zostaje bez zmian, więc zapytanie jest krótkie niezależnie od długości książki.
+        """
+        ending = previous_chapter.strip().split("\n\n")[-1]
+        opening, *rest = chapter.strip().split("\n\n")
+        model = "gpt-4o-mini"
+        system_prompt = f"Jesteś redaktorem. Dbasz o płynne przejścia między rozdziałami. Zachowaj styl {story_style.style}."
+        user_message = ("Przepisz pierwszy akapit rozdziału tak, aby naturalnie nawiązywał do zakończenia "
+                        "poprzedniego rozdziału. Nie zmieniaj wydarzeń. Zwróć wyłącznie nowy akapit.\n\n"
+                        f"Koniec poprzedniego rozdziału:\n{ending}\n\nPierwszy akapit rozdziału:\n{opening}")
+        cache_key = make_cache_key("smoothing", model, system_prompt, user_message)
+        with self.metrics.stage("smoothing", model) as record:
+            cached = self._cached(cache_key, refresh)
+            if cached:
+                record.cached = True
+                return "\n\n".join([cached, *rest])
+            response = self._call(
+                "smoothing", self.client.chat.completions.create,
+                model=model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_message}
+                ]
+            )
+            record.add_usage(response.usage)
+        new_opening = (response.choices[0].message.content or "").strip()
+        if not new_opening:
+            return chapter # Przejście jest opcjonalne - zostawiamy rozdział bez zmian
+        self._store(cache_key, new_opening)
+        return "\n\n".join([new_opening, *rest])
+
+    def stream_long_story(self, title: str, summary: str, scenes: List[Scene], story_style: StoryStyle,
+                          refresh: bool = False, smooth: bool = False):
+        """Generuje opowiadanie w trybie długiej formy: rozdział na scenę, wszystkie równolegle.
+
+        Zwraca kolejne rozdziały (oddzielone pustą linią) w kolejności scen, gdy tylko
+        dany rozdział i wszystkie przed nim są gotowe. Z `smooth=True` początek każdego
+        rozdziału (poza pierwszym) jest dodatkowo wygładzany względem końca poprzedniego.
+        Zamknięcie generatora anuluje rozdziały, które jeszcze nie wystartowały.
+        """
+        workers = max(1, min(self.chapter_workers, len(scenes)))
+        executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="chapter")
+        try:
+            chapters = [executor.submit(self.generate_chapter, title, summary, scenes, i, story_style, refresh)
+                        for i in range(len(scenes))]
+            results = chapters
+            if smooth:
+                # Kolejka puli jest FIFO: wygładzanie startuje dopiero, gdy wszystkie rozdziały
+                # są już w trakcie, więc czekanie na nie nie blokuje wolnych wątków
+                def smoothed(i: int) -> str:
+                    previous, chapter = chapters[i - 1].result(), chapters[i].result()
+                    try:
+                        return self.smooth_transition(previous, chapter, story_style, refresh)
+                    except Exception:
+                        return chapter # Wygładzanie jest opcjonalne; błąd zostaje w metrykach etapu
+
+                results = chapters[:1] + [executor.submit(smoothed, i) for i in range(1, len(scenes))]
+            for i, future in enumerate(results):
+                yield ("\n\n" if i else "") + future.result()
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def generate_long_story(self, title: str, summary: str, scenes: List[Scene], story_style: StoryStyle,
+                            refresh: bool = False, smooth: bool = False) -> str:
+        """Pełne opowiadanie w trybie długiej formy (patrz `stream_long_story`)."""
+        return "".join(self.stream_long_story(title, summary, scenes, story_style, refresh=refresh, smooth=smooth))
+
+    def request_illustration(self, prompt: str, story_style: StoryStyle) -> str:
+        """Wysyła pojedyncze zapytanie do DALL-E 3 i zwraca URL."""
+        with self.illustration_slots, self.metrics.stage("illustration", "dall-e-3") as record:
+            response = self._call(
+                "illustration", self.client.images.generate,
+                hedge_slots=self.illustration_slots, # Duplikat wolnego zapytania też mieści się w limicie
+                model="dall-e-3",
+                prompt=f"Utwórz cyfrową ilustrację w stylu {story_style.image_style}, oddającą atmosferę i nastrój: {story_style.atmosphere}. Opis sceny: {prompt}",
+                n=1,
+                size="1024x1024", # Można zmienić na "1024x1792" lub "1792x1024" dla innych proporcji
+                quality="standard" # lub "hd" dla lepszej jakości (droższe)
+            )
+            record.images = len(response.data)
+        return response.data[0].url
+
+    def generate_illustrations(self, prompts: List[str], story_style: StoryStyle, on_done=None,
+                               previous: Optional[Dict[str, str]] = None, on_url=None,
+                               shared: Optional["SharedCalls"] = None) -> List[str]:
+        """Generuje ilustracje równolegle i zwraca listę URL-i w kolejności scen.
+
+        Nieudane sceny dostają placeholder "error". Opcjonalny callback
+        `on_done(index, completed, error)` jest wywoływany w wątku wywołującym
+        po zakończeniu każdej sceny (np. do aktualizacji paska postępu).
+        `previous` mapuje `illustration_key` na URL wcześniejszej ilustracji -
+        sceny, których treść i styl się nie zmieniły, nie są generowane ponownie.
+        `on_url(index, url)` dostaje każdą nowo wygenerowaną ilustrację zaraz po
+        odebraniu (np. do zapisania punktu kontrolnego zadania). Z `shared` sceny,
+        których ilustracja jest już generowana przez wcześniejsze zadanie, czekają
+        na tamto zapytanie zamiast wysyłać nowe.
+        """
+        results = ["error"] * len(prompts)
+        previous = previous or {}
+        completed = 0
+        pending = []
+        for i, prompt in enumerate(prompts):
+            url = previous.get(illustration_key(prompt, story_style))
+            if url and url != "error":
+                results[i] = url
+                completed += 1
+                if on_done:
+                    on_done(i, completed, None)
+            else:
+                pending.append(i)
+        if not pending:
+            return results
+
+        def illustrate(i: int) -> str:
+            if shared is None:
+                return self.request_illustration(prompts[i], story_style)
+            return shared.run(illustration_key(prompts[i], story_style), self.runner.token,
+                              lambda token: self.with_token(token).request_illustration(prompts[i], story_style))
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.illustration_workers, len(pending)))) as executor:
+            futures = {executor.submit(illustrate, i): i for i in pending}
+            for completed, future in enumerate(as_completed(futures), start=completed + 1):
+                i = futures[future]
+                error = None
+                try:
+                    results[i] = future.result() or "error"
+                    if on_url and results[i] != "error":
+                        on_url(i, results[i])
+                except Exception as e:
+                    error = e
+                if on_done:
+                    on_done(i, completed, error)
+        return results
+
+def scene_prompts(scenes: List[Scene]) -> List[str]:
+    """Opisy scen w formie używanej jako prompt ilustracji."""
+    return [f"{s.scene_title}: {s.scene_description}" for s in scenes]
+
+def illustration_key(prompt: str, story_style: StoryStyle) -> str:
+    """Skrót danych, od których zależy ilustracja sceny (opis sceny, styl i atmosfera)."""
+    payload = json.dumps([prompt, story_style.image_style, story_style.atmosphere], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def default_pdf_name(title: str) -> str:
+    """Nazwa pliku PDF na podstawie tytułu opowiadania."""
+    return f"{title.replace(' ', '_').replace('.', '').lower()}_opowiadanie.pdf"
+
+def default_epub_name(title: str) -> str:
+    """Nazwa pliku EPUB na podstawie tytułu opowiadania."""
+    return default_pdf_name(title)[:-len(".pdf")] + ".epub"
+
+@dataclass
+class StoryResult:
+    """Wynik pełnego przebiegu potoku dla jednego tematu."""
+    title: str
+    summary: str
+    scenes: List[Scene]
+    story: str
+    illustrations: List[str]
+    illustration_blobs: List[Optional[str]]
+    pdf_path: Optional[str] = None
+    epub_path: Optional[str] = None
+
+def run_pipeline(engine: StoryEngine, topic: str, story_style: StoryStyle, output_dir: Optional[str] = None,
+                 pdf_prefix: str = "", refresh: bool = False, long_form: bool = False,
+                 smooth: bool = False, formats=("pdf",), job_store=None, job_id: Optional[str] = None,
+                 fast_plan: bool = False) -> StoryResult:
+    """Przeprowadza cały potok: temat -> tytuł -> sceny -> opowiadanie -> ilustracje -> PDF/EPUB.
+
+    Jeśli podano `output_dir`, zapisuje w nim pliki w formatach `formats` ("pdf",
+    "epub"; nazwa z tytułu poprzedzona `pdf_prefix`) i zwraca ich ścieżki w wyniku.
+    `long_form` pisze osobny rozdział dla każdej sceny (równolegle), `smooth`
+    dodatkowo wygładza przejścia między nimi. Z `job_store` (job_store.JobStore)
+    wynik każdego etapu jest zapisywany jako punkt kontrolny zadania `job_id`,
+    a ponowne uruchomienie tego zadania zaczyna od ostatniego punktu kontrolnego.
+    `fast_plan` tworzy tytuł, zarys i sceny jednym zapytaniem zamiast dwóch.
+    """
+    from story_epub import create_story_epub
+    from story_pdf import create_story_pdf
+
+    def checkpoint(name: str, compute):
+        if job_store is None:
+            return compute()
+        value = None if refresh else job_store.load(job_id, name)
+        if value is None:
+            value = compute()
+            job_store.save(job_id, name, value)
+        return value
+
+    planned_scenes = [] # Sceny z szybkiego planu - bez osobnego zapytania o sceny
+    if fast_plan:
+        def plan():
+            title, summary, scenes = engine.generate_plan(topic, story_style, refresh=refresh)
+            planned_scenes.extend(scenes)
+            if job_store is not None:
+                job_store.save(job_id, "scenes", [scene.model_dump() for scene in scenes])
+            return [title, summary]
+
+        title, summary = checkpoint("title_and_summary", plan)
+    else:
+        title, summary = checkpoint("title_and_summary",
+                                    lambda: list(engine.generate_title_and_summary(topic, story_style, refresh=refresh)))
+    scenes = [Scene.model_validate(scene) for scene in checkpoint("scenes", lambda: [
+        scene.model_dump() for scene in planned_scenes or engine.generate_scenes(title, summary, story_style,
+                                                                                 refresh=refresh)])]
+    if not scenes:
+        raise ValueError("Model nie zwrócił żadnych scen.")
+    if long_form:
+        story = checkpoint("story", lambda: engine.generate_long_story(title, summary, scenes, story_style,
+                                                                        refresh=refresh, smooth=smooth))
+    else:
+        story = checkpoint("story", lambda: engine.generate_story(title, scenes, story_style, refresh=refresh))
+    if not story:
+        raise ValueError("Model nie zwrócił treści opowiadania.")
+
+    prompts = scene_prompts(scenes)
+    previous, on_url = None, None
+    if job_store is not None:
+        # Ilustracje gotowe przed przerwaniem nie są generowane ponownie; każda nowa jest zapisywana od razu
+        if not refresh:
+            previous = {key: value["url"] for key, value in job_store.illustrations(job_id).items()}
+
+        def on_url(i: int, url: str) -> None:
+            try:
+                blob = engine.blob_store.fetch(url)
+            except Exception:
+                blob = None # Pobranie zostanie ponowione niżej; URL jest już zapisany
+            job_store.save_illustration(job_id, illustration_key(prompts[i], story_style), url, blob)
+
+    illustrations = engine.generate_illustrations(prompts, story_style, previous=previous, on_url=on_url)
+    illustration_blobs = engine.blob_store.fetch_many(illustrations)
+    result = StoryResult(title, summary, scenes, story, illustrations, illustration_blobs)
+
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+        if "pdf" in formats:
+            images = [engine.blob_store.get(digest) for digest in illustration_blobs]
+            with engine.metrics.stage("pdf"):
+                result.pdf_path = create_story_pdf(title, story, scenes, images,
+                                                   output_path=os.path.join(output_dir, pdf_prefix + default_pdf_name(title)))
+        if "epub" in formats:
+            # EPUB dostaje ścieżki plików z magazynu - obrazy kopiowane są bez wczytywania do pamięci
+            image_files = [engine.blob_store.path(digest) if digest else None for digest in illustration_blobs]
+            with engine.metrics.stage("epub"):
+                result.epub_path = create_story_epub(title, story, scenes, image_files,
+                                                     output=os.path.join(output_dir, pdf_prefix + default_epub_name(title)))
+    if job_store is not None and "error" not in illustrations:
+        job_store.set_status(job_id, "done")
+    return result
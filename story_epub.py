@@ -0,0 +1,164 @@
+"""Eksport opowiadania do EPUB 3, zapisywanego strumieniowo jako archiwum ZIP.
+
+Układ treści jest taki sam jak w PDF (story_pdf.py): tytuł i tekst opowiadania,
+a po nich rozdziały ze scenami i ilustracjami. Tekst trafia do archiwum akapit
+po akapicie, a ilustracje są kopiowane z plików lokalnego magazynu bez ponownego
+kodowania, więc w pamięci nigdy nie ma całej książki. EPUB jest przepływowy
+i znacznie tańszy w budowie niż składany PDF.
+"""
+import hashlib
+import logging
+import uuid
+import zipfile
+from html import escape
+from io import BytesIO
+from typing import List, Optional
+
+from image_prep import detect_image_format
+
+logger = logging.getLogger(__name__)
+
+_MEDIA_TYPES = {"PNG": ("image/png", "png"), "JPEG": ("image/jpeg", "jpg"),
+                "GIF": ("image/gif", "gif"), "WEBP": ("image/webp", "webp")}
+
+# Stała data wpisów archiwum i metadanych, a identyfikator książki to skrót treści -
+# ta sama treść (tekst, sceny, ilustracje, język) daje ten sam plik
+_ZIP_DATE = (1980, 1, 1, 0, 0, 0)
+_MODIFIED = "1980-01-01T00:00:00Z"
+
+_XHTML_HEAD = ('<?xml version="1.0" encoding="utf-8"?>\n'
+               '<!DOCTYPE html>\n'
+               '<html xmlns="http://www.w3.org/1999/xhtml" xmlns:epub="http://www.idpf.org/2007/ops" '
+               'lang="{lang}" xml:lang="{lang}">\n'
+               '<head><meta charset="utf-8"/><title>{title}</title>'
+               '<link rel="stylesheet" type="text/css" href="style.css"/></head>\n<body>\n')
+_XHTML_TAIL = "</body>\n</html>\n"
+
+_STYLE = """body { font-family: "DejaVu Sans", sans-serif; line-height: 1.5; margin: 0 5%; }
+h1 { text-align: center; margin: 2em 0 1em; }
+p { margin: 0 0 0.8em; }
+figure { margin: 1em 0; text-align: center; }
+img { max-width: 100%; height: auto; }
+"""
+
+_CONTAINER = """<?xml version="1.0" encoding="utf-8"?>
+<container version="1.0" xmlns="urn:oasis:names:tc:opendocument:xmlns:container">
+  <rootfiles>
+    <rootfile full-path="OEBPS/content.opf" media-type="application/oebps-package+xml"/>
+  </rootfiles>
+</container>
+"""
+
+
+def _entry(name: str, compress: bool = True) -> zipfile.ZipInfo:
+    info = zipfile.ZipInfo(name, date_time=_ZIP_DATE)
+    info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    return info
+
+
+def _paragraphs(text: str):
+    """Akapity XHTML z niepustych wierszy tekstu (jak wiersze w PDF)."""
+    for line in text.split("\n"):
+        if line.strip():
+            yield f"<p>{escape(line.strip())}</p>\n"
+
+
+def _image_type(path: str):
+    with open(path, "rb") as f:
+        return _MEDIA_TYPES.get(detect_image_format(f.read(16)) or "")
+
+
+def create_story_epub(title, story_text, scenes, illustration_files: List[Optional[str]], output=None,
+                      on_warning=None, language: str = "pl"):
+    """Buduje EPUB z opowiadaniem.
+
+    `illustration_files` to ścieżki plików obrazów (lub None) w kolejności scen -
+    bajty są kopiowane do archiwum bez dekodowania. `output` to ścieżka albo plik
+    binarny otwarty do zapisu (funkcja go zwraca); bez `output` zwracane są bajty.
+    Pominięte ilustracje zgłaszane są przez `on_warning`, domyślnie do `logging`.
+    """
+    on_warning = on_warning or logger.warning
+    target = BytesIO() if output is None else output
+    content_hash = hashlib.sha256()
+    documents = [("story", "story.xhtml", title)]
+    images = []
+    lang = escape(language)
+
+    with zipfile.ZipFile(target, "w") as epub:
+        # "mimetype" musi być pierwszym, nieskompresowanym wpisem archiwum
+        epub.writestr(_entry("mimetype", compress=False), "application/epub+zip")
+        epub.writestr(_entry("META-INF/container.xml"), _CONTAINER)
+        epub.writestr(_entry("OEBPS/style.css"), _STYLE)
+
+        # Tytuł i tekst opowiadania
+        with epub.open(_entry("OEBPS/story.xhtml"), "w") as f:
+            for part in (_XHTML_HEAD.format(lang=lang, title=escape(title)), f"<h1>{escape(title)}</h1>\n",
+                         *_paragraphs(story_text), _XHTML_TAIL):
+                data = part.encode("utf-8")
+                content_hash.update(data)
+                f.write(data)
+
+        # Rozdziały i ilustracje
+        for i, scene in enumerate(scenes):
+            heading = f"{i+1}. {scene.scene_title}"
+            figure = ""
+            path = illustration_files[i] if i < len(illustration_files) else None
+            if path:
+                try:
+                    image_type = _image_type(path)
+                    if image_type is None:
+                        raise ValueError("nieobsługiwany format obrazu")
+                    media_type, extension = image_type
+                    image_name = f"images/scene_{i+1}.{extension}"
+                    # Obrazy są już skompresowane - kopiujemy je bez kompresji i bez dekodowania
+                    with open(path, "rb") as src, epub.open(_entry(f"OEBPS/{image_name}", compress=False), "w") as dst:
+                        for block in iter(lambda: src.read(1024 * 1024), b""):
+                            content_hash.update(block)
+                            dst.write(block)
+                    images.append((f"img{i+1}", image_name, media_type))
+                    alt = escape(f"Ilustracja do sceny: {scene.scene_title}")
+                    figure = f'<figure><img src="{image_name}" alt="{alt}"/></figure>\n'
+                except (OSError, ValueError) as e:
+                    on_warning(f"Pominięto ilustrację do sceny '{scene.scene_title}': {e}")
+            name = f"chapter_{i+1}.xhtml"
+            body = (f"<h2>{escape(heading)}</h2>\n"
+                    + "".join(_paragraphs(scene.scene_description))
+                    + figure)
+            chapter = (_XHTML_HEAD.format(lang=lang, title=escape(heading)) + body + _XHTML_TAIL).encode("utf-8")
+            content_hash.update(chapter)
+            epub.writestr(_entry(f"OEBPS/{name}"), chapter)
+            documents.append((f"chapter{i+1}", name, heading))
+
+        nav_items = "".join(f'<li><a href="{href}">{escape(label)}</a></li>\n' for _, href, label in documents)
+        epub.writestr(_entry("OEBPS/nav.xhtml"),
+                      _XHTML_HEAD.format(lang=lang, title="Spis treści")
+                      + f'<nav epub:type="toc" id="toc"><h1>Spis treści</h1>\n<ol>\n{nav_items}</ol></nav>\n'
+                      + _XHTML_TAIL)
+
+        manifest = ['<item id="nav" href="nav.xhtml" media-type="application/xhtml+xml" properties="nav"/>',
+                    '<item id="css" href="style.css" media-type="text/css"/>']
+        manifest += [f'<item id="{item_id}" href="{href}" media-type="application/xhtml+xml"/>'
+                     for item_id, href, _ in documents]
+        manifest += [f'<item id="{item_id}" href="{href}" media-type="{media_type}"/>'
+                     for item_id, href, media_type in images]
+        manifest = "\n    ".join(manifest)
+        spine = "".join(f'<itemref idref="{item_id}"/>' for item_id, _, _ in documents)
+        book_id = uuid.UUID(content_hash.hexdigest()[:32]) # Identyfikator ze skrótu treści, nie losowy
+        epub.writestr(_entry("OEBPS/content.opf"), f"""<?xml version="1.0" encoding="utf-8"?>
+<package xmlns="http://www.idpf.org/2007/opf" version="3.0" unique-identifier="book-id" xml:lang="{lang}">
+  <metadata xmlns:dc="http://purl.org/dc/elements/1.1/">
+    <dc:identifier id="book-id">urn:uuid:{book_id}</dc:identifier>
+    <dc:title>{escape(title)}</dc:title>
+    <dc:language>{lang}</dc:language>
+    <meta property="dcterms:modified">{_MODIFIED}</meta>
+  </metadata>
+  <manifest>
+    {manifest}
+  </manifest>
+  <spine>{spine}</spine>
+</package>
+""")
+
+    if output is None:
+        return target.getvalue()
+    return output
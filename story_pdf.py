@@ -0,0 +1,221 @@
+"""Składanie opowiadania z ilustracjami w plik PDF (fpdf2)."""
+import copy
+import logging
+import os
+import threading
+from io import BytesIO # Do obsługi obrazów w pamięci
+
+from fpdf import FPDF, FPDF_VERSION # Do generowania PDF
+
+from image_prep import DEFAULT_IMAGE_DPI, DEFAULT_JPEG_QUALITY, prepare_for_pdf
+
+logger = logging.getLogger(__name__)
+
+# Ścieżki do plików czcionek (pliki .ttf leżą w katalogu ze skryptem)
+FONT_DIR = os.path.dirname(os.path.abspath(__file__))
+FONT_FILES = {
+    "": os.path.join(FONT_DIR, "DejaVuSans.ttf"),
+    "B": os.path.join(FONT_DIR, "DejaVuSans-Bold.ttf"),
+    "I": os.path.join(FONT_DIR, "DejaVuSans-Oblique.ttf"),
+}
+
+# Wersje fpdf2, dla których sprawdzono, które pola TTFFont są stanem dokumentu (kopiowane
+# w `add_cached_font`). Inna wersja może dodać nowe pole - wtedy zwykłe `add_font`.
+SHARED_FONT_FPDF_VERSIONS = ("2.8.9",)
+
+# Sparsowane czcionki współdzielone przez wszystkie dokumenty w procesie
+_font_templates = {}
+_font_templates_lock = threading.Lock()
+
+
+def add_cached_font(pdf: FPDF, family: str, style: str, path: str) -> None:
+    """Dodaje czcionkę TTF do dokumentu, parsując plik tylko raz na proces.
+
+    fpdf2 przy każdym `add_font` wylicza od nowa szerokości i mapę znaków (tysiące
+    glifów). Te tabele są niezmienne, więc trzymamy je w szablonie; dla każdego
+    dokumentu tworzymy tylko lekką kopię z własnym obiektem fontTools (ładowanym
+    leniwie i modyfikowanym przy osadzaniu podzbioru), deskryptorem i mapą podzbioru.
+    Przy wersji fpdf2 spoza `SHARED_FONT_FPDF_VERSIONS` wraca do zwykłego `add_font`.
+    """
+    if FPDF_VERSION not in SHARED_FONT_FPDF_VERSIONS:
+        pdf.add_font(family, style, path)
+        return
+    try:
+        from fontTools import ttLib
+        from fpdf.fonts import SubsetMap, TTFFont
+
+        fontkey = f"{family.lower()}{style}"
+        with _font_templates_lock:
+            template = _font_templates.get((fontkey, path))
+            if template is None:
+                template = TTFFont(pdf, path, fontkey, style)
+                _font_templates[(fontkey, path)] = template
+        if template.color_font is not None:
+            raise TypeError("Czcionki kolorowe nie są współdzielone")
+        font = copy.copy(template)
+        font.i = len(pdf.fonts) + 1
+        font.desc = copy.copy(template.desc) # Deskryptor dostaje przy zapisie numer obiektu dokumentu
+        font.ttfont = ttLib.TTFont(path, recalcTimestamp=False, lazy=True)
+        font._hbfont = None
+        font.missing_glyphs = []
+        font.biggest_size_pt = 0
+        font.subset = SubsetMap(font)
+        pdf.fonts[fontkey] = font
+    except (ImportError, AttributeError, TypeError):
+        pdf.add_font(family, style, path)
+
+
+def warm_fonts() -> None:
+    """Parsuje czcionki DejaVu z wyprzedzeniem (np. w tle przy starcie procesu), żeby pierwszy PDF nie czekał."""
+    if all(os.path.exists(path) for path in FONT_FILES.values()):
+        pdf = FPDF()
+        for style, path in FONT_FILES.items():
+            add_cached_font(pdf, "DejaVu", style, path)
+
+
+def write_paragraphs(pdf: FPDF, text: str, line_height: float) -> None:
+    """Składa tekst akapit po akapicie, samodzielnie łamiąc wiersze.
+
+    `multi_cell` w fpdf2 przelicza szerokość bieżącego wiersza po każdym znaku, co
+    przy długich książkach zajmuje minuty. Tutaj szerokość każdego słowa liczona
+    jest raz, a gotowe wiersze trafiają do `cell`. Wiersze są wyrównane do lewej;
+    pusty wiersz w tekście daje odstęp jak w `multi_cell`.
+    """
+    width = pdf.epw
+    space_width = pdf.get_string_width(" ")
+    word_widths = {}
+
+    def emit(words):
+        pdf.cell(width, line_height, " ".join(words), new_x="LMARGIN", new_y="NEXT")
+
+    for paragraph in text.split("\n"):
+        line, line_width = [], 0.0
+        for word in paragraph.split():
+            word_width = word_widths.get(word)
+            if word_width is None:
+                word_width = word_widths[word] = pdf.get_string_width(word)
+            while word_width > width: # Słowo dłuższe niż wiersz - tniemy po znakach
+                if line:
+                    emit(line)
+                    line, line_width = [], 0.0
+                cut = len(word)
+                while cut > 1 and pdf.get_string_width(word[:cut]) > width:
+                    cut -= 1
+                emit([word[:cut]])
+                word = word[cut:]
+                word_width = pdf.get_string_width(word)
+            if line and line_width + space_width + word_width > width:
+                emit(line)
+                line, line_width = [], 0.0
+            line_width += (space_width if line else 0) + word_width
+            line.append(word)
+        if line or not paragraph.strip():
+            emit(line)
+
+# --- Funkcja do generowania PDF ---
+class PDF(FPDF):
+    def header(self):
+        pass # Można dodać niestandardowy nagłówek
+
+    def footer(self):
+        self.set_y(-15)
+        # Użycie czcionki dodanej w `create_story_pdf`
+        # Sprawdzenie czy czcionka DejaVu została dodana
+        font_name = "DejaVu" if "dejavu" in self.font_family.lower() else self.font_family
+        self.set_font(font_name, "I", 8)
+        self.cell(0, 10, f"Strona {self.page_no()}/{{nb}}", 0, 0, "C")
+
+def create_story_pdf(title, story_text, scenes, illustration_images, on_warning=None, output_path=None,
+                     image_dpi=DEFAULT_IMAGE_DPI, image_quality=DEFAULT_JPEG_QUALITY):
+    """Buduje PDF z opowiadaniem i zwraca jego bajty.
+
+    `illustration_images` to bajty obrazów (lub None) w kolejności scen. Ostrzeżenia
+    (np. brak czcionek) trafiają do `on_warning`, domyślnie do modułu `logging`.
+    Jeśli podano `output_path`, dokument jest zapisywany prosto do pliku, a funkcja
+    zwraca ścieżkę zamiast bajtów. Ilustracje są zmniejszane do `image_dpi` dla
+    wydrukowanej szerokości i kompresowane do JPEG o jakości `image_quality`.
+    """
+    on_warning = on_warning or logger.warning
+    pdf = PDF()
+    pdf.set_auto_page_break(auto=True, margin=15)
+    pdf.alias_nb_pages()
+
+    font_to_use = "Arial" # Domyślna, jeśli DejaVu nie jest dostępna
+
+    try:
+        if all(os.path.exists(path) for path in FONT_FILES.values()):
+            for font_style, path in FONT_FILES.items():
+                add_cached_font(pdf, "DejaVu", font_style, path)
+            font_to_use = "DejaVu"
+        else:
+            on_warning(
+                "Nie znaleziono plików czcionek DejaVu (np. DejaVuSans.ttf) w katalogu projektu. "
+                "Polskie znaki w PDF mogą nie być wyświetlane poprawnie. "
+                "Pobierz czcionki DejaVu i umieść je w głównym katalogu projektu."
+            )
+    except RuntimeError as e:
+        on_warning(f"Błąd podczas ładowania czcionki DejaVu: {e}. Używam domyślnej czcionki (Arial).")
+
+    pdf.add_page()
+
+    # Tytuł opowiadania
+    pdf.set_font(font_to_use, "B", 20)
+    pdf.multi_cell(0, 10, title, 0, "C")
+    pdf.ln(10)
+
+    # Tekst opowiadania
+    pdf.set_font(font_to_use, "", 12)
+    write_paragraphs(pdf, story_text, 10)
+    pdf.ln(10)
+    if pdf.get_y() > (pdf.h - pdf.b_margin - 270 ): # Sprawdzenie miejsca przed nową sceną (wysokość orientacyjna)
+             pdf.add_page()
+    # Sceny i Ilustracje
+    pdf.set_font(font_to_use, "B", 16)
+    pdf.multi_cell(0, 10, "Rozdziały i Ilustracje", 0, "L")
+    pdf.ln(5)
+
+    for i, scene in enumerate(scenes):
+        if pdf.get_y() > (pdf.h - pdf.b_margin - 70): # Sprawdzenie miejsca przed nową sceną (wysokość orientacyjna)
+             pdf.add_page()
+
+        # Tytuł sceny
+        pdf.set_font(font_to_use, "B", 14)
+        pdf.multi_cell(0, 10, f"{i+1}. {scene.scene_title}", 0, "L")
+        pdf.ln(2)
+
+        # Opis sceny
+        pdf.set_font(font_to_use, "", 12)
+        pdf.multi_cell(0, 8, scene.scene_description)
+        pdf.ln(5)
+
+        # Ilustracja
+        if i < len(illustration_images) and illustration_images[i]:
+            try:
+                if pdf.get_y() > (pdf.h - pdf.b_margin - 80): # Sprawdzenie miejsca na obraz (orientacyjnie 80mm)
+                    pdf.add_page()
+
+                img_max_width = pdf.w - pdf.l_margin - pdf.r_margin - 10 # Z marginesami
+
+                # Obraz zmniejszony do rozmiaru wydruku; format rozpoznawany z zawartości
+                img_bytes = BytesIO(prepare_for_pdf(illustration_images[i], img_max_width, image_dpi, image_quality))
+                pdf.image(img_bytes, x=None, y=None, w=img_max_width)
+                pdf.ln(5)
+            except Exception as e: # Błędy związane z obrazem
+                pdf.set_font(font_to_use, "I", 10)
+                pdf.multi_cell(0, 8, f"[Błąd podczas przetwarzania ilustracji: {e}]")
+                pdf.ln(5)
+        pdf.ln(5) # Dodatkowy odstęp po scenie
+
+    if output_path:
+        pdf.output(output_path)
+        return output_path
+
+    # Zwraca bajty PDF
+    output = pdf.output(dest="S")
+    if isinstance(output, bytearray):
+        return bytes(output) # Konwersja bytearray na bytes
+    if isinstance(output, str): # Na wypadek, gdyby zwracał string (mało prawdopodobne z dest="S" w fpdf2)
+        return output.encode('latin1')
+    if isinstance(output, bytes):
+        return output # Już jest w poprawnym formacie
+    raise TypeError(f"Nieoczekiwany typ danych z pdf.output: {type(output)}")
@@ -0,0 +1,50 @@
+"""Testy magazynu blobów: zapis, indeks URL i usuwanie nieużywanych blobów."""
+import os
+import time
+
+from blob_store import BlobStore
+
+
+def age(store: BlobStore, digest: str, seconds: float) -> None:
+    past = time.time() - seconds
+    os.utime(store.path(digest), (past, past))
+
+
+def test_put_and_get(tmp_path):
+    store = BlobStore(str(tmp_path))
+    digest = store.put(b"obraz")
+    assert store.get(digest) == b"obraz"
+    assert store.put(b"obraz") == digest
+    assert store.get("0" * 64) is None and store.get(None) is None
+
+
+def test_evict_keeps_referenced_and_fresh_blobs(tmp_path):
+    store = BlobStore(str(tmp_path), max_age_seconds=24 * 3600, min_age_seconds=3600)
+    used, old, recent, fresh = (store.put(data) for data in (b"zadanie", b"stary", b"niedawny", b"nowy"))
+    for digest in (used, old):
+        age(store, digest, 48 * 3600)
+    age(store, recent, 2 * 3600)
+    assert store.evict(lambda: {used}, force=True) == 1
+    assert store.get(old) is None
+    assert store.get(used) and store.get(recent) and store.get(fresh)
+
+
+def test_evict_oldest_over_size_limit(tmp_path):
+    store = BlobStore(str(tmp_path), max_bytes=250, min_age_seconds=3600)
+    digests = [store.put(bytes([i]) * 100) for i in range(4)]
+    for i, digest in enumerate(digests):
+        age(store, digest, (10 - i) * 3600) # Pierwszy jest najstarszy
+    assert store.evict(lambda: {digests[0]}, force=True) == 2
+    assert [store.get(digest) is not None for digest in digests] == [True, False, False, True]
+
+
+def test_evict_is_throttled_and_cleans_url_index(tmp_path):
+    store = BlobStore(str(tmp_path), max_age_seconds=60, min_age_seconds=0, sweep_interval=600)
+    digest = store.put(b"obraz")
+    store._write_atomic(store._url_index_path("https://img/1"), digest.encode("ascii"))
+    age(store, digest, 120)
+    assert store.evict(set, force=True) == 1
+    assert store.digest_for_url("https://img/1") is None
+    assert os.listdir(os.path.join(str(tmp_path), "urls")) == []
+    store.put(b"inny")
+    assert store.evict(set) == 0 # Kolejny przegląd dopiero po `sweep_interval`
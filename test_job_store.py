@@ -0,0 +1,95 @@
+"""Testy trwałych zadań i punktów kontrolnych."""
+import pytest
+
+from job_store import ILLUSTRATION_PREFIX, JobStore, audio_segment_name
+
+
+@pytest.fixture
+def store(tmp_path):
+    return JobStore(str(tmp_path / "jobs.sqlite3"))
+
+
+def test_create_and_get(store):
+    job_id = store.create("Zaginiony artefakt", {"style": "Fantasy", "fast_plan": True})
+    job = store.get(job_id)
+    assert job["topic"] == "Zaginiony artefakt"
+    assert job["options"] == {"style": "Fantasy", "fast_plan": True}
+    assert job["status"] == "running"
+    assert store.get("brak") is None and store.get(None) is None
+
+
+def test_create_with_existing_id_keeps_job(store):
+    store.create("Pierwszy", job_id="zadanie")
+    assert store.create("Drugi", job_id="zadanie") == "zadanie"
+    assert store.get("zadanie")["topic"] == "Pierwszy"
+
+
+def test_checkpoints_round_trip(tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    store = JobStore(path)
+    job_id = store.create("temat")
+    scenes = [{"scene_title": "Źródło", "scene_description": "Zażółć gęślą jaźń"}]
+    store.save(job_id, "title_and_summary", ["Tytuł", "Zarys"])
+    store.save(job_id, "scenes", scenes)
+    store.save(job_id, "stage", 3)
+    store.save(job_id, "stage", 4) # Nadpisuje poprzedni
+
+    reopened = JobStore(path) # Po restarcie serwera
+    assert reopened.load(job_id, "title_and_summary") == ["Tytuł", "Zarys"]
+    assert reopened.load(job_id, "scenes") == scenes
+    assert reopened.load(job_id, "stage") == 4
+    assert reopened.load(job_id, "story", default="brak") == "brak"
+
+
+def test_checkpoints_by_prefix(store):
+    job_id = store.create("temat")
+    store.save(job_id, "a_b:1", 1)
+    store.save(job_id, "a%b:2", 2)
+    store.save(job_id, "axb:3", 3) # Znaki specjalne LIKE nie mogą dopasować innych nazw
+    assert store.checkpoints(job_id, "a_b:") == {"a_b:1": 1}
+    assert store.checkpoints(job_id, "a%") == {"a%b:2": 2}
+    assert len(store.checkpoints(job_id)) == 3
+
+
+def test_illustrations(store):
+    job_id = store.create("temat")
+    other = store.create("inny")
+    store.save_illustration(job_id, "klucz1", "https://img/1", "abc")
+    store.save_illustration(job_id, "klucz2", "https://img/2", None)
+    store.save_illustration(other, "klucz3", "https://img/3", "def")
+    store.save(job_id, "scenes", [])
+    assert store.illustrations(job_id) == {"klucz1": {"url": "https://img/1", "blob": "abc"},
+                                           "klucz2": {"url": "https://img/2", "blob": None}}
+    assert store.load(job_id, ILLUSTRATION_PREFIX + "klucz1")["blob"] == "abc"
+
+
+def test_status_and_delete(store):
+    job_id = store.create("temat")
+    store.save(job_id, "stage", 2)
+    store.set_status(job_id, "done")
+    assert store.get(job_id)["status"] == "done"
+    store.delete(job_id)
+    assert store.get(job_id) is None
+    assert store.checkpoints(job_id) == {}
+
+
+def test_audio_segment_name():
+    name = audio_segment_name("Dawno temu", "alloy", "tts-1")
+    assert name == audio_segment_name("Dawno temu", "alloy", "tts-1")
+    assert name != audio_segment_name("Dawno temu", "nova", "tts-1")
+    assert name != audio_segment_name("Dawno temu", "alloy", "tts-1-hd")
+
+
+def test_blob_digests_and_expire(store):
+    job_id = store.create("temat")
+    old = store.create("stary")
+    store.save_illustration(job_id, "klucz1", "https://img/1", "abc")
+    store.save_illustration(job_id, "klucz2", "https://img/2", None)
+    store.save(job_id, audio_segment_name("Dawno temu", "alloy", "tts-1"), "def")
+    store.save_illustration(old, "klucz3", "https://img/3", "ghi")
+    assert store.blob_digests() == {"abc", "def", "ghi"}
+    with store._conn:
+        store._conn.execute("UPDATE jobs SET updated = 0 WHERE id = ?", (old,))
+    assert store.expire(3600) == 1
+    assert store.get(old) is None and store.get(job_id) is not None
+    assert store.blob_digests() == {"abc", "def"}
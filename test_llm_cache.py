@@ -0,0 +1,71 @@
+"""Testy cache odpowiedzi LLM: klucze, TTL i usuwanie najdawniej używanych wpisów."""
+import pytest
+
+import llm_cache
+from llm_cache import LLMCache, make_cache_key
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(llm_cache.time, "time", clock)
+    return clock
+
+
+def test_make_cache_key():
+    key = make_cache_key("story", "gpt-4o", "system", "user")
+    assert key == make_cache_key("story", "gpt-4o", "system", "user")
+    assert key != make_cache_key("scenes", "gpt-4o", "system", "user")
+    assert key != make_cache_key("story", "gpt-4o-mini", "system", "user")
+    assert key != make_cache_key("story", "gpt-4o", "system", "user2")
+
+
+def test_round_trip_survives_reopen(tmp_path):
+    path = str(tmp_path / "cache.sqlite3")
+    LLMCache(path).set("k", {"title": "Tytuł", "scenes": [1, 2]})
+    assert LLMCache(path).get("k") == {"title": "Tytuł", "scenes": [1, 2]}
+    assert LLMCache(path).get("brak") is None
+
+
+def test_ttl_expiry(tmp_path, clock):
+    cache = LLMCache(str(tmp_path / "cache.sqlite3"), ttl_seconds=60)
+    cache.set("k", "wartość")
+    clock.now += 59
+    assert cache.get("k") == "wartość"
+    clock.now += 2 # TTL liczony od zapisu, nie od odczytu
+    assert cache.get("k") is None
+
+
+def test_lru_eviction(tmp_path, clock):
+    cache = LLMCache(str(tmp_path / "cache.sqlite3"), max_bytes=25, ttl_seconds=0)
+    cache.set("a", "x" * 8) # 10 bajtów z cudzysłowami
+    clock.now += 1
+    cache.set("b", "y" * 8)
+    clock.now += 1
+    assert cache.get("a") is not None # "a" używane niedawno, "b" najdawniej
+    clock.now += 1
+    cache.set("c", "z" * 8)
+    assert cache.get("b") is None
+    assert cache.get("a") == "x" * 8
+    assert cache.get("c") == "z" * 8
+
+
+def test_oversized_value_is_not_stored(tmp_path):
+    cache = LLMCache(str(tmp_path / "cache.sqlite3"), max_bytes=10)
+    cache.set("k", "x" * 100)
+    assert cache.get("k") is None
+
+
+def test_clear(tmp_path):
+    cache = LLMCache(str(tmp_path / "cache.sqlite3"))
+    cache.set("k", 1)
+    cache.clear()
+    assert cache.get("k") is None
@@ -0,0 +1,59 @@
+"""Testy zadań w tle: anulowanie zastąpionych zadań i współdzielenie wywołań w locie."""
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from prefetch import Prefetcher, SharedCalls
+from request_policy import CancelToken, RequestCancelled
+
+
+def test_replaced_job_cancels_its_token():
+    prefetch = Prefetcher(ThreadPoolExecutor(max_workers=2))
+    first, second = CancelToken(), CancelToken()
+    prefetch.start("illustrations", "a", time.sleep, 0.2, token=first)
+    prefetch.start("illustrations", "b", time.sleep, 0, token=second)
+    assert first.cancelled and not second.cancelled
+    prefetch.discard("illustrations")
+    assert second.cancelled
+
+
+def test_new_job_joins_call_in_flight():
+    shared, calls = SharedCalls(), []
+    release = threading.Event()
+
+    def illustrate(token):
+        calls.append(token)
+        release.wait(5)
+        token.raise_if_cancelled() # Tak jak ponowienie po przejściowym błędzie
+        return "url"
+
+    old, new = CancelToken(), CancelToken()
+    results = {}
+    owner = threading.Thread(target=lambda: results.setdefault("old", shared.run("scena", old, illustrate)))
+    owner.start()
+    while not calls:
+        time.sleep(0.01)
+    joined = threading.Thread(target=lambda: results.setdefault("new", shared.run("scena", new, illustrate)))
+    joined.start()
+    time.sleep(0.05)
+    old.cancel("zadanie w tle odrzucone") # Zastąpione zadanie nie przerywa wywołania, na które czeka nowe
+    release.set()
+    owner.join(5)
+    joined.join(5)
+    assert len(calls) == 1
+    assert results["new"] == "url"
+
+
+def test_call_nobody_waits_for_is_cancelled():
+    shared = SharedCalls()
+    token = CancelToken()
+
+    def illustrate(call_token):
+        token.cancel()
+        call_token.raise_if_cancelled()
+        return "url"
+
+    with pytest.raises(RequestCancelled):
+        shared.run("scena", token, illustrate)
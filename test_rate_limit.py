@@ -0,0 +1,88 @@
+"""Testy kolejki limitów: sprawiedliwa kolejność sesji, Retry-After i szacowanie budżetu zapytań."""
+import threading
+import time
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+
+import httpx
+import pytest
+
+from rate_limit import DEFAULT_COMPLETION_TOKENS, DEFAULT_RETRY_AFTER, RateLimiter, request_budget, retry_after
+
+
+def chat_request(model: str = "m", content: str = "x" * 400, **extra) -> httpx.Request:
+    return httpx.Request("POST", "https://api.example/v1/chat/completions",
+                         json={"model": model, "messages": [{"role": "user", "content": content}], **extra})
+
+
+def wait_until(condition, timeout: float = 5.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "warunek nie został spełniony w czasie"
+        time.sleep(0.005)
+
+
+def test_waiting_sessions_are_served_fairly():
+    limiter = RateLimiter({"m": (0, 0)})
+    limiter.penalize("m", 0.3) # Wszyscy czekają, aż kolejka się zapełni
+    served = []
+
+    def acquire(owner):
+        limiter.acquire("m", owner=owner)
+        served.append(owner)
+
+    threads = []
+    # Sesja A ustawia się w kolejce trzy razy, zanim pojawi się jedyne zapytanie sesji B
+    for owner in ("A", "A", "A", "B"):
+        thread = threading.Thread(target=acquire, args=(owner,))
+        thread.start()
+        threads.append(thread)
+        wait_until(lambda: len(limiter._waiting.get("m", [])) == len(threads))
+    for thread in threads:
+        thread.join(5)
+
+    assert served == ["A", "B", "A", "A"]
+
+
+def test_requests_bucket_limits_rate():
+    limiter = RateLimiter({"m": (60, 0)}) # 1 zapytanie na sekundę po wyczerpaniu pojemności
+    limiter._buckets["m"][0].tokens = 1
+    assert limiter.acquire("m") < 0.05
+    assert limiter.acquire("m") == pytest.approx(1.0, abs=0.2)
+
+
+def test_unknown_model_is_not_limited():
+    assert RateLimiter({"m": (1, 1)}).acquire("other", tokens=10_000) == 0.0
+
+
+def test_429_blocks_model_for_retry_after():
+    limiter = RateLimiter({"m": (0, 0), "n": (0, 0)})
+    limiter.after_response(httpx.Response(429, headers={"retry-after": "0.3"}, request=chat_request("m")))
+
+    assert limiter.acquire("n") < 0.05 # Inne modele nie są wstrzymane
+    assert limiter.acquire("m") >= 0.25
+
+
+def test_before_request_reports_wait_time():
+    waits = []
+    limiter = RateLimiter({"m": (0, 0)}, owner=lambda: "sesja", on_wait=waits.append)
+    limiter.penalize("m", 0.2)
+    limiter.before_request(chat_request("m"))
+    assert len(waits) == 1 and waits[0] >= 0.15
+
+
+def test_retry_after_headers():
+    assert retry_after(httpx.Headers({"retry-after-ms": "1500", "retry-after": "9"})) == 1.5
+    assert retry_after(httpx.Headers({"retry-after": "2"})) == 2.0
+    date = format_datetime(datetime.now(timezone.utc) + timedelta(seconds=30), usegmt=True)
+    assert retry_after(httpx.Headers({"retry-after": date})) == pytest.approx(30, abs=2)
+    assert retry_after(httpx.Headers({"retry-after": "jutro"})) == DEFAULT_RETRY_AFTER
+    assert retry_after(httpx.Headers()) == DEFAULT_RETRY_AFTER
+
+
+def test_request_budget():
+    assert request_budget(chat_request("m", "x" * 400)) == ("m", 100 + DEFAULT_COMPLETION_TOKENS)
+    assert request_budget(chat_request("m", "x" * 400, max_tokens=50)) == ("m", 150)
+    image = httpx.Request("POST", "https://api.example/v1/images/generations", json={"model": "dall-e-3"})
+    assert request_budget(image) == ("dall-e-3", 0)
+    assert request_budget(httpx.Request("GET", "https://api.example/v1/models")) == (None, 0)
@@ -0,0 +1,183 @@
+"""Testy terminów, ponowień, anulowania i zapytań zabezpieczających (hedging)."""
+import threading
+import time
+
+import httpx
+import openai
+import pytest
+
+from metrics import StageRecord
+from request_policy import (CancelToken, DeadlineExceeded, RequestCancelled, RequestRunner, StagePolicy,
+                            check_cancelled, load_policies, note_sent)
+
+REQUEST = httpx.Request("POST", "https://api.example/v1/chat/completions")
+
+
+def runner(token=None, **policy) -> RequestRunner:
+    policy.setdefault("backoff", 0.01)
+    return RequestRunner({"stage": StagePolicy(**policy)}, token=token)
+
+
+def failing(errors, result="ok"):
+    """Funkcja zgłaszająca kolejno błędy z listy, a potem zwracająca `result`; zapisuje limity prób."""
+    timeouts = []
+
+    def fn(timeout):
+        timeouts.append(timeout)
+        if errors:
+            raise errors.pop(0)
+        return result
+    fn.timeouts = timeouts
+    return fn
+
+
+def test_retries_transient_errors():
+    fn = failing([openai.APIConnectionError(request=REQUEST), openai.APITimeoutError(REQUEST)])
+    assert runner(max_attempts=3).run("stage", fn) == "ok"
+    assert len(fn.timeouts) == 3
+
+
+def test_gives_up_after_max_attempts():
+    fn = failing([openai.APIConnectionError(request=REQUEST)] * 3)
+    with pytest.raises(openai.APIConnectionError):
+        runner(max_attempts=2).run("stage", fn)
+    assert len(fn.timeouts) == 2
+
+
+def test_other_errors_are_not_retried():
+    fn = failing([ValueError("400")])
+    with pytest.raises(ValueError):
+        runner(max_attempts=3).run("stage", fn)
+    assert len(fn.timeouts) == 1
+
+
+def test_attempt_timeout_is_capped_by_deadline():
+    fn = failing([])
+    runner(deadline=5, attempt_timeout=60).run("stage", fn)
+    assert 4.5 < fn.timeouts[0] <= 5
+
+
+def test_deadline_stops_retries():
+    fn = failing([openai.APITimeoutError(REQUEST)] * 5)
+    started = time.monotonic()
+    with pytest.raises(DeadlineExceeded):
+        runner(deadline=0.5, backoff=2, max_attempts=5).run("stage", fn)
+    assert time.monotonic() - started < 0.5 # Nie czeka na ponowienie, które i tak nie zmieściłoby się w terminie
+    assert len(fn.timeouts) == 1
+
+
+def test_cancelled_token_blocks_requests():
+    token = CancelToken()
+    token.cancel("nowa historia")
+    fn = failing([])
+    with pytest.raises(RequestCancelled, match="nowa historia"):
+        runner(token).run("stage", fn)
+    assert fn.timeouts == []
+
+
+def test_cancel_interrupts_backoff():
+    token = CancelToken()
+    fn = failing([openai.APIConnectionError(request=REQUEST)] * 3)
+    threading.Timer(0.1, token.cancel).start()
+    started = time.monotonic()
+    with pytest.raises(RequestCancelled):
+        runner(token, backoff=5, backoff_max=5, deadline=60).run("stage", fn)
+    assert time.monotonic() - started < 2
+
+
+def test_http_hook_refuses_requests_of_cancelled_session():
+    token = CancelToken()
+
+    def fn(timeout):
+        check_cancelled(REQUEST) # Tak jak hook wspólnego klienta HTTP
+        token.cancel()
+        check_cancelled(REQUEST)
+
+    with pytest.raises(RequestCancelled):
+        runner(token).run("stage", fn)
+    check_cancelled(REQUEST) # Poza etapem hook niczego nie blokuje
+
+
+def test_closed_session_is_not_latched():
+    state = {"alive": True}
+    token = CancelToken(alive=lambda: state["alive"])
+    state["alive"] = False
+    assert token.cancelled
+    with pytest.raises(RequestCancelled, match="sesja zamknięta"):
+        token.raise_if_cancelled()
+    state["alive"] = True # Karta połączyła się ponownie z tą samą sesją
+    assert not token.cancelled
+    assert runner(token).run("stage", failing([])) == "ok"
+
+
+def test_job_token_follows_session_token():
+    session = CancelToken()
+    job, other = CancelToken(parent=session), CancelToken(parent=session)
+    job.cancel("zadanie w tle odrzucone")
+    assert job.cancelled and not other.cancelled and not session.cancelled
+    fn = failing([openai.APIConnectionError(request=REQUEST)] * 3)
+    threading.Timer(0.1, session.cancel, args=("nowa historia",)).start()
+    with pytest.raises(RequestCancelled, match="nowa historia"):
+        runner(other, backoff=5, backoff_max=5, deadline=60).run("stage", fn) # Przerywa też odstęp ponowienia
+    assert len(fn.timeouts) == 1
+
+
+def slow_first(delay: float, queued: float = 0):
+    """Pierwsze wywołanie czeka `queued` s w kolejce limitów, a potem trwa `delay` s; kolejne odpowiadają od razu."""
+    calls = []
+
+    def fn(timeout):
+        calls.append(timeout)
+        time.sleep(queued if len(calls) == 1 else 0)
+        note_sent(REQUEST) # Tak jak ostatni hook wspólnego klienta HTTP
+        if len(calls) == 1:
+            time.sleep(delay)
+            return "wolna"
+        return "szybka"
+    fn.calls = calls
+    return fn
+
+
+def test_hedged_request_returns_first_answer():
+    fn = slow_first(1.0)
+    started = time.monotonic()
+    assert runner(hedge_after=0.2).run("stage", fn) == "szybka"
+    assert len(fn.calls) == 2
+    assert time.monotonic() - started < 0.8
+
+
+def test_hedge_waits_until_request_leaves_rate_limit_queue():
+    fn = slow_first(0.1, queued=0.6)
+    assert runner(hedge_after=0.3).run("stage", fn) == "wolna"
+    assert len(fn.calls) == 1 # Czas w kolejce limitów nie liczy się do `hedge_after`
+
+
+def test_hedged_images_are_billed():
+    record = StageRecord(stage="illustration", session_id="s", model="dall-e-3", images=1, hedges=1)
+    assert record.estimate_cost() == pytest.approx(0.08)
+    assert StageRecord(stage="story", session_id="s", model="gpt-4o", hedges=1).estimate_cost() == 0
+
+
+def test_hedge_respects_slots():
+    slots = threading.BoundedSemaphore(2)
+    fn = slow_first(0.8)
+    with slots: # Miejsce zapytania podstawowego, jak w StoryEngine.request_illustration
+        assert runner(hedge_after=0.2).run("stage", fn, hedge_slots=slots) == "szybka"
+    assert slots._value == 1 # Wolna próba wciąż trwa i zajmuje miejsce duplikatu
+    time.sleep(1.0)
+    assert slots._value == 2
+
+    full = threading.BoundedSemaphore(1)
+    fn = slow_first(0.5)
+    with full: # Brak wolnego miejsca - bez duplikatu
+        assert runner(hedge_after=0.1).run("stage", fn, hedge_slots=full) == "wolna"
+    assert len(fn.calls) == 1
+
+
+def test_load_policies_overrides():
+    policies = load_policies({"story": {"deadline": 900}, "custom": {"max_attempts": 1}}, hedge_illustrations_after=15)
+    assert policies["story"].deadline == 900
+    assert policies["story"].max_attempts == 2 # Pozostałe pola bez zmian
+    assert policies["custom"] == StagePolicy(max_attempts=1)
+    assert policies["illustration"].hedge_after == 15
+    assert load_policies()["illustration"].hedge_after is None
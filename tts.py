@@ -0,0 +1,108 @@
+"""Synteza mowy dla długich opowiadań: podział na fragmenty i równoległe zapytania TTS."""
+import re
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, List, Optional
+
+TTS_MAX_CHARS = 4096 # Limit długości pola `input` w API OpenAI TTS
+TTS_CHUNK_CHARS = 1500 # Docelowa długość fragmentu (mniejsze fragmenty = więcej równoległości)
+TTS_FIRST_CHUNK_CHARS = 400 # Krótki pierwszy fragment, aby odtwarzanie mogło ruszyć szybko
+
+_SENTENCE_END = re.compile(r"(?<=[.!?…])\s+")
+
+
+def _split_long(text: str, max_chars: int) -> List[str]:
+    """Dzieli zbyt długi akapit na zdania, a w ostateczności na słowa lub twarde cięcia."""
+    pieces = []
+    for sentence in _SENTENCE_END.split(text):
+        while len(sentence) > max_chars:
+            cut = sentence.rfind(" ", 0, max_chars)
+            if cut <= 0:
+                cut = max_chars
+            pieces.append(sentence[:cut].strip())
+            sentence = sentence[cut:].strip()
+        if sentence:
+            pieces.append(sentence)
+    return pieces
+
+
+def split_for_tts(text: str, chunk_chars: int = TTS_CHUNK_CHARS, first_chunk_chars: int = TTS_FIRST_CHUNK_CHARS,
+                  max_chars: int = TTS_MAX_CHARS) -> List[str]:
+    """Dzieli tekst na fragmenty na granicach akapitów i zdań, każdy krótszy niż limit TTS."""
+    chunk_chars = min(chunk_chars, max_chars)
+    pieces = []
+    for paragraph in re.split(r"\n\s*\n", text):
+        paragraph = paragraph.strip()
+        if not paragraph:
+            continue
+        # Pierwszy akapit dzielimy na zdania już powyżej `first_chunk_chars`, żeby start był szybki
+        if len(paragraph) > (first_chunk_chars if not pieces else chunk_chars):
+            pieces.extend(_split_long(paragraph, chunk_chars))
+        else:
+            pieces.append(paragraph)
+
+    chunks = []
+    current = ""
+    for piece in pieces:
+        limit = first_chunk_chars if not chunks else chunk_chars
+        if current and len(current) + 2 + len(piece) > limit:
+            chunks.append(current)
+            current = piece
+        else:
+            current = f"{current}\n\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def synthesize_chunk(client, text: str, voice: str, model: str = "tts-1", metrics=None, runner=None) -> bytes:
+    """Syntezuje jeden fragment i zwraca bajty MP3 (opcjonalnie mierząc etap "tts").
+
+    Z `runner` (request_policy.RequestRunner) zapytanie ma termin, ponowienia i anulowanie sesji.
+    """
+    def request():
+        if runner is None:
+            response = client.audio.speech.create(model=model, voice=voice, input=text)
+        else:
+            response = runner.run("tts", lambda timeout: client.audio.speech.create(
+                model=model, voice=voice, input=text, timeout=timeout))
+        return b"".join(response.iter_bytes(chunk_size=4096))
+
+    if metrics is None:
+        return request()
+    with metrics.stage("tts", model) as record:
+        record.characters = len(text)
+        return request()
+
+
+def synthesize_chunks(client, chunks: List[str], voice: str, model: str = "tts-1",
+                      max_workers: int = 4, metrics=None,
+                      load_segment: Optional[Callable[[str], Optional[bytes]]] = None,
+                      save_segment: Optional[Callable[[str, bytes], None]] = None,
+                      runner=None) -> Iterator[bytes]:
+    """Syntezuje fragmenty równolegle i zwraca segmenty MP3 w kolejności tekstu.
+
+    Kolejny segment jest zwracany, gdy tylko on i wszystkie wcześniejsze są gotowe,
+    więc pierwszy można odtwarzać, zanim powstaną pozostałe. Błąd dowolnego
+    fragmentu przerywa syntezę i jest przekazywany wyżej. `load_segment(text)`
+    może zwrócić zapisany wcześniej segment (bez zapytania do API), a
+    `save_segment(text, segment)` dostaje każdy nowy segment zaraz po syntezie.
+    `runner` jest przekazywany do `synthesize_chunk`.
+    """
+    if not chunks:
+        return
+
+    def synthesize(chunk: str) -> bytes:
+        segment = load_segment(chunk) if load_segment else None
+        if segment is None:
+            segment = synthesize_chunk(client, chunk, voice, model, metrics, runner)
+            if save_segment:
+                save_segment(chunk, segment)
+        return segment
+
+    executor = ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(chunks))))
+    try:
+        futures = [executor.submit(synthesize, chunk) for chunk in chunks]
+        for future in futures:
+            yield future.result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)